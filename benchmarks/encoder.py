@@ -0,0 +1,82 @@
+""" Compares the BatchEncoder used by dbio.query with the previous per-row path of null
+	substitution followed by unicodecsv.writer.writerows.
+
+	Run from the repository root with: python benchmarks/encoder.py
+"""
+# Python standard library
+import datetime
+import decimal
+import random
+import time
+from cStringIO import StringIO
+
+# PyPI packages
+import unicodecsv
+
+# Local modules
+from dbio.databases.base import Importable
+from dbio.databases.mysql import MySQL
+from dbio.encoder import BatchEncoder
+
+
+BATCH_SIZE = 10000
+NUM_BATCHES = 20
+
+
+def narrow_row(i):
+	return (i, i * 7, random.random(), None if i % 10 == 0 else i % 3)
+
+
+def mixed_row(i):
+	return (i, u'customer_{0}'.format(i), decimal.Decimal('12.50'),
+			datetime.datetime(2015, 8, 4, 12, i % 60, 0), None if i % 5 == 0 else u'active',
+			'ascii text, with a comma')
+
+
+def wide_text_row(i):
+	return tuple(u'\xe9l\xe9ment {0} of row {1}'.format(j, i) for j in range(20))
+
+
+def unicodecsv_path(batches, csv_params, null_string):
+	f = StringIO()
+	csv_writer = unicodecsv.writer(f, **csv_params)
+	for rows in batches:
+		csv_writer.writerows(
+			[[null_string if field is None else field for field in row] for row in rows])
+	return f.getvalue()
+
+
+def batch_encoder_path(batches, csv_params, null_string):
+	f = StringIO()
+	encoder = BatchEncoder(csv_params, null_string)
+	for rows in batches:
+		f.write(encoder.encode(rows))
+	return f.getvalue()
+
+
+def timed(func, *args):
+	start = time.time()
+	result = func(*args)
+	return result, time.time() - start
+
+
+def main():
+	num_rows = BATCH_SIZE * NUM_BATCHES
+	print '{0:<14} {1:<8} {2:>14} {3:>14} {4:>8}'.format(
+		'rows', 'params', 'unicodecsv/s', 'encoder/s', 'speedup')
+	for make_row in (narrow_row, mixed_row, wide_text_row):
+		rows = [make_row(i) for i in xrange(num_rows)]
+		batches = [rows[i:i + BATCH_SIZE] for i in xrange(0, num_rows, BATCH_SIZE)]
+		for name, csv_params, null_string in (
+				('default', Importable.DEFAULT_CSV_PARAMS, Importable.DEFAULT_NULL_STRING),
+				('mysql', MySQL.DEFAULT_CSV_PARAMS, MySQL.DEFAULT_NULL_STRING)):
+			expected, old_time = timed(unicodecsv_path, batches, csv_params, null_string)
+			actual, new_time = timed(batch_encoder_path, batches, csv_params, null_string)
+			assert actual == expected
+			print '{0:<14} {1:<8} {2:>14,.0f} {3:>14,.0f} {4:>7.1f}x'.format(
+				make_row.__name__, name, num_rows / old_time, num_rows / new_time,
+				old_time / new_time)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,69 @@
+""" Compares the binary COPY encoder with the CSV encoder on wide numeric tables: encoding
+	rate on the client and the number of bytes sent to the server. The server side, which
+	no longer parses text in binary format, is not measured here.
+
+	Run from the repository root with: python benchmarks/pgcopy.py
+"""
+# Python standard library
+import datetime
+import decimal
+import random
+import time
+
+# Local modules
+from dbio.databases.postgresql import PostgreSQL
+from dbio.encoder import BatchEncoder
+from dbio.pgcopy import BinaryCopyEncoder
+
+
+BATCH_SIZE = 10000
+NUM_BATCHES = 5
+NUM_COLUMNS = 40
+
+
+def numeric_row(i):
+	return (i,) + tuple(decimal.Decimal(random.randint(-10 ** 9, 10 ** 9)).scaleb(-4)
+						for _ in range(NUM_COLUMNS - 1))
+
+
+def float_row(i):
+	return (i,) + tuple(random.random() * 10 ** 6 for _ in range(NUM_COLUMNS - 1))
+
+
+def metric_row(i):
+	timestamp = datetime.datetime(2015, 8, 4) + datetime.timedelta(seconds=i)
+	return (i, timestamp) + tuple(random.randint(0, 10 ** 6) for _ in range(NUM_COLUMNS - 2))
+
+
+COLUMN_TYPES = {
+	numeric_row : ['int8'] + ['numeric'] * (NUM_COLUMNS - 1),
+	float_row : ['int8'] + ['float8'] * (NUM_COLUMNS - 1),
+	metric_row : ['int8', 'timestamp'] + ['int4'] * (NUM_COLUMNS - 2)
+}
+
+
+def encode_all(encoder, batches):
+	start = time.time()
+	size = len(encoder.header) + len(encoder.trailer)
+	for rows in batches:
+		size += len(encoder.encode(rows))
+	return size, time.time() - start
+
+
+def main():
+	num_rows = BATCH_SIZE * NUM_BATCHES
+	print '{0:<12} {1:>12} {2:>12} {3:>12} {4:>12}'.format(
+		'rows', 'csv rows/s', 'binary rows/s', 'csv MB', 'binary MB')
+	for make_row in (numeric_row, float_row, metric_row):
+		rows = [make_row(i) for i in xrange(num_rows)]
+		batches = [rows[i:i + BATCH_SIZE] for i in xrange(0, num_rows, BATCH_SIZE)]
+		csv_size, csv_time = encode_all(
+			BatchEncoder(PostgreSQL.DEFAULT_CSV_PARAMS, PostgreSQL.DEFAULT_NULL_STRING), batches)
+		binary_size, binary_time = encode_all(BinaryCopyEncoder(COLUMN_TYPES[make_row]), batches)
+		print '{0:<12} {1:>12,.0f} {2:>12,.0f} {3:>12.1f} {4:>12.1f}'.format(
+			make_row.__name__, num_rows / csv_time, num_rows / binary_time,
+			csv_size / 1e6, binary_size / 1e6)
+
+
+if __name__ == '__main__':
+	main()
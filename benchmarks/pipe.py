@@ -0,0 +1,112 @@
+""" Compares replicating through a pipe of the default size, written PIPE_WRITE_BATCH rows at
+	a time, with pipes enlarged by F_SETPIPE_SZ and written in chunks of half their size.
+	The rows are encoded before timing starts, and a child process reads the pipe either as
+	raw bytes or through a CSV reader, as the SQLite loader does, so that only the transport
+	and the reader are measured.
+
+	Linux only. Sizes above /proc/sys/fs/pipe-max-size need root.
+
+	Run from the repository root with: python benchmarks/pipe.py
+"""
+# Python standard library
+import fcntl
+import os
+import time
+
+# PyPI packages
+import unicodecsv
+
+# Local modules
+from dbio import io
+from dbio.databases.sqlite import SQLite
+from dbio.encoder import BatchEncoder
+
+
+NUM_ROWS = 500000
+READ_SIZE = 1024 * 1024
+PIPE_SIZES = [None, 64 * 1024, 256 * 1024, 1024 * 1024, 4 * 1024 * 1024]
+
+
+def make_row(i):
+	return (i, 'sensor-{0}'.format(i % 1000), i * 0.25, '2015-08-04 00:00:00', None)
+
+
+def chunk(batches, size):
+	""" Joins encoded batches into chunks of at least size bytes. """
+	chunks = []
+	current = []
+	current_size = 0
+	for data in batches:
+		current.append(data)
+		current_size += len(data)
+		if current_size >= size:
+			chunks.append(''.join(current))
+			current = []
+			current_size = 0
+	if current:
+		chunks.append(''.join(current))
+	return chunks
+
+
+def read_raw(f):
+	while f.read(READ_SIZE):
+		pass
+
+
+def read_csv(f):
+	for _ in unicodecsv.reader(f, **SQLite.DEFAULT_CSV_PARAMS):
+		pass
+
+
+def transfer(chunks, pipe_size, read):
+	""" :returns: Seconds taken to write the chunks and for the child to read them all. """
+	read_fd, write_fd = os.pipe()
+	if pipe_size is not None:
+		fcntl.fcntl(write_fd, io.F_SETPIPE_SZ, pipe_size)
+	start = time.time()
+	pid = os.fork()
+	if pid == 0:
+		os.close(write_fd)
+		read(os.fdopen(read_fd, 'rb'))
+		os._exit(0)
+	os.close(read_fd)
+	for data in chunks:
+		write_all(write_fd, data)
+	os.close(write_fd)
+	os.waitpid(pid, 0)
+	return time.time() - start
+
+
+def write_all(fd, data):
+	view = memoryview(data)
+	while view:
+		view = view[os.write(fd, view):]
+
+
+def main():
+	encoder = BatchEncoder(SQLite.DEFAULT_CSV_PARAMS, SQLite.DEFAULT_NULL_STRING)
+	rows = [make_row(i) for i in xrange(NUM_ROWS)]
+	batches = [encoder.encode(rows[i:i + io.PIPE_WRITE_BATCH])
+			   for i in xrange(0, NUM_ROWS, io.PIPE_WRITE_BATCH)]
+	total_bytes = sum(len(data) for data in batches)
+
+	print '{0:<12} {1:>10} {2:>12} {3:>14}'.format('pipe size', 'writes', 'raw MB/s', 'csv rows/s')
+	for pipe_size in PIPE_SIZES:
+		if pipe_size is None:
+			name = 'default'
+			chunks = batches
+		else:
+			name = '{0}K'.format(pipe_size // 1024)
+			chunks = chunk(batches, pipe_size // 2)
+		try:
+			raw_time = transfer(chunks, pipe_size, read_raw)
+			csv_time = transfer(chunks, pipe_size, read_csv)
+		except IOError as e:
+			print '{0:<12} {1}'.format(name, e)
+			continue
+		print '{0:<12} {1:>10,} {2:>12,.0f} {3:>14,.0f}'.format(
+			name, len(chunks), total_bytes / raw_time / 1e6, NUM_ROWS / csv_time)
+
+
+if __name__ == '__main__':
+	main()
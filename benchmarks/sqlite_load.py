@@ -0,0 +1,89 @@
+""" Compares the SQLite loader with the previous one, which inserted batches of 100 rows as
+	literal SQL, on a CSV file of narrow rows.
+
+	Run from the repository root with: python benchmarks/sqlite_load.py [num_rows]
+	The default is 1,000,000 rows; pass 10000000 for the full-size comparison.
+"""
+# Python standard library
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+# PyPI packages
+import sqlalchemy
+import unicodecsv
+
+# Local modules
+import dbio
+from dbio.databases import DEFAULT_CSV_PARAMS, DEFAULT_NULL_STRING
+
+
+CREATE_CMD = "CREATE TABLE {table} (id integer, name varchar(20), value real, note text)"
+
+PREVIOUS_BATCH = 100
+
+
+def write_csv(filename, num_rows):
+	with open(filename, 'wb') as f:
+		writer = unicodecsv.writer(f, **DEFAULT_CSV_PARAMS)
+		for i in xrange(num_rows):
+			writer.writerow((i, 'name{0}'.format(i % 1000), i * 0.5,
+							 DEFAULT_NULL_STRING if i % 7 == 0 else 'note'))
+
+
+def previous_load(url, table, filename):
+	""" The loader as it was: literal VALUES lists, no parameters, 'NULL' loaded as text. """
+	engine = sqlalchemy.create_engine(url)
+	with engine.begin() as connection, open(filename, 'rb') as f:
+		values = []
+		for row in unicodecsv.reader(f, **DEFAULT_CSV_PARAMS):
+			values.append('(\'' + '\',\''.join(row) + '\')')
+			if len(values) == PREVIOUS_BATCH:
+				connection.execute("INSERT INTO {table} VALUES {values};".format(
+								   table=table, values=','.join(values)))
+				values = []
+		if values:
+			connection.execute("INSERT INTO {table} VALUES {values};".format(
+							   table=table, values=','.join(values)))
+
+
+def timed_load(load, filename, num_rows):
+	db_dir = tempfile.mkdtemp()
+	url = 'sqlite:///' + os.path.join(db_dir, 'bench.db')
+	engine = sqlalchemy.create_engine(url)
+	engine.execute(CREATE_CMD.format(table='bench'))
+	try:
+		start = time.time()
+		load(url, 'bench', filename)
+		elapsed = time.time() - start
+		assert engine.execute("SELECT COUNT(*) FROM bench").fetchone()[0] == num_rows
+	finally:
+		shutil.rmtree(db_dir)
+	return elapsed
+
+
+def main():
+	num_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+	csv_file = tempfile.NamedTemporaryFile(suffix='.csv')
+	write_csv(csv_file.name, num_rows)
+
+	loaders = [
+		('previous', previous_load),
+		('executemany', lambda url, table, filename: dbio.load(url, table, filename, True)),
+		('executemany + pragmas', lambda url, table, filename: dbio.load(
+			url, table, filename, True, bulk_pragmas=True))
+	]
+	print '{0:<24} {1:>10} {2:>12} {3:>8}'.format('loader', 'seconds', 'rows/s', 'speedup')
+	baseline = None
+	for name, load in loaders:
+		elapsed = timed_load(load, csv_file.name, num_rows)
+		baseline = baseline or elapsed
+		print '{0:<24} {1:>10.1f} {2:>12,.0f} {3:>7.1f}x'.format(
+			name, elapsed, num_rows / elapsed, baseline / elapsed)
+	csv_file.close()
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,64 @@
+""" Times cold starts of the dbio command: ``dbio --help``, which should import no database
+	module, and ``dbio query`` of one row from SQLite, which imports only what it uses. Each
+	command runs in a new interpreter, as replicate's subprocesses do. Also lists the heavy
+	modules imported by ``dbio --help``.
+
+	Run from the repository root with: python benchmarks/startup.py
+"""
+# Python standard library
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+
+RUNS = 10
+
+# Modules that dbio --help should not need.
+HEAVY_MODULES = ('sqlalchemy', 'unicodecsv', 'MySQLdb', 'psycopg2', 'vertica_python', 'pyodbc',
+				 'pkg_resources')
+
+LIST_IMPORTS = ("import sys\n"
+				"sys.argv = ['dbio', '--help']\n"
+				"import dbio.__main__\n"
+				"try:\n"
+				"	dbio.__main__.main()\n"
+				"except SystemExit:\n"
+				"	pass\n"
+				"sys.stderr.write(' '.join(sorted(set(name.split('.')[0] for name in sys.modules\n"
+				"	if name.split('.')[0] in {modules!r}))))\n")
+
+
+def median_seconds(args):
+	seconds = []
+	with open(os.devnull, 'w') as devnull:
+		for _ in range(RUNS):
+			start = time.time()
+			subprocess.check_call(args, stdout=devnull)
+			seconds.append(time.time() - start)
+	return sorted(seconds)[len(seconds) // 2]
+
+
+def main():
+	db_file = tempfile.NamedTemporaryFile(suffix='.db')
+	sqlite3.connect(db_file.name).close()
+	dbio = [sys.executable, '-m', 'dbio']
+
+	print '{0:<12} {1:>10}'.format('command', 'seconds')
+	for name, args in (('python', [sys.executable, '-c', 'pass']),
+					   ('--help', dbio + ['--help']),
+					   ('query', dbio + ['-q', 'query', 'sqlite:///' + db_file.name, 'SELECT 1',
+										 os.devnull])):
+		print '{0:<12} {1:>10.3f}'.format(name, median_seconds(args))
+
+	process = subprocess.Popen([sys.executable, '-c', LIST_IMPORTS.format(modules=HEAVY_MODULES)],
+							   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+	_, imported = process.communicate()
+	print 'imported by --help: ' + (imported or 'none')
+	db_file.close()
+
+
+if __name__ == '__main__':
+	main()
@@ -1,4 +1,7 @@
-from io import load, query, replicate, replicate_no_fifo
+from io import (load, query, replicate, replicate_no_fifo, replicate_threaded,
+				replicate_fanout, replicate_fanin, replicate_chunked, sync, query_snapshot)
+from jobs import run_jobs, run_manifest
+from databases.engines import configure_engines, dispose_engines
 
 __all__ = ['io', 'databases']
 __version__ = '0.5.3'
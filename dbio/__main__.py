@@ -1,39 +1,213 @@
 # Python standard library
 import argparse
+import csv
 import logging
-import unicodecsv
+import sys
 
 # Local modules
 from databases import DEFAULT_CSV_PARAMS, DEFAULT_NULL_STRING
+from databases.engines import configure_engines
+import compression
 import io
+import jobs
+import timing
+
+
+SIZE_SUFFIXES = {
+	'K' : 1024,
+	'M' : 1024 ** 2,
+	'G' : 1024 ** 3
+}
+
+# Replicate flags that do not apply with several targets or sources, by their dest.
+FAN_UNSUPPORTED_FLAGS = (
+	('watermark_column', '-wc'),
+	('watermark_key', '-wk'),
+	('pipeline_depth', '-pd'),
+	('pipe_size', '-ps'),
+	('native_export', '-ne'),
+	('profile', '-pr'),
+	('spool', '-sp'),
+	('chunk_by', '-cb')
+)
 
 
 def load(args):
 	csv_params = __get_csv_params(args)
-	io.load(args.db_url, args.table, args.filename, args.append, analyze=args.analyze,
-			disable_indices=args.disable_indices, csv_params=csv_params,  
-			null_string=args.null_string, create_staging=args.create_staging, 
-			expected_rowcount=args.expected_rowcount, direct=args.direct)
+	expected_rowcount = args.expected_rowcount
+	if args.expected_rowcount_file is not None:
+		# Only read once the file has been loaded, as the query writes it at the end.
+		expected_rowcount = lambda: __read_rowcount(args.expected_rowcount_file)
+	if args.watermark is not None:
+		watermark = dict(zip(('key', 'column', 'mark'), args.watermark))
+	else:
+		watermark = None
+	if args.merge_keys is not None:
+		merge_keys = args.merge_keys.split(',')
+	else:
+		merge_keys = None
+	timings = timing.Timings()
+	try:
+		timing.profiled(args.profile, io.load, args.db_url, args.table, args.filename,
+				args.append, analyze=args.analyze, disable_indices=args.disable_indices,
+				csv_params=csv_params, null_string=args.null_string,
+				create_staging=args.create_staging, expected_rowcount=expected_rowcount,
+				direct=args.direct, compression=args.compression, copy_format=args.copy_format,
+				bulk_pragmas=args.bulk_pragmas, watermark=watermark, merge=args.merge,
+				merge_keys=merge_keys, delete_missing=args.delete_missing, timings=timings)
+	finally:
+		if args.timings_file is not None:
+			timings.save(args.timings_file)
 
 
 def query(args):
 	csv_params = __get_csv_params(args)
-	io.query(args.db_url, args.query, args.filename, query_is_file=args.from_file, 
-				batch_size=args.batch_size, csv_params=csv_params, null_string=args.null_string)
+	if args.boundaries is not None:
+		boundaries = [__parse_boundary(boundary) for boundary in args.boundaries.split(',')]
+	else:
+		boundaries = None
+	if args.column_types is not None:
+		column_types = args.column_types.split(',')
+	else:
+		column_types = None
+	timings = timing.Timings()
+	try:
+		timing.profiled(args.profile, io.query, args.db_url, args.query, args.filename,
+					query_is_file=args.from_file, batch_size=args.batch_size,
+					csv_params=csv_params, null_string=args.null_string,
+					partition_by=args.partition_by, parallel=args.parallel,
+					partitions=args.partitions, boundaries=boundaries,
+					shard_files=args.shard_files, compression=args.compression,
+					compression_level=args.compression_level, batch_bytes=args.batch_bytes,
+					pipeline_depth=args.pipeline_depth, native_export=args.native_export,
+					copy_format=args.copy_format, column_types=column_types,
+					rowcount_file=args.rowcount_file, pipe_size=args.pipe_size, timings=timings)
+	finally:
+		if args.timings_file is not None:
+			timings.save(args.timings_file)
+
+
+def snapshot(args):
+	if len(args.queries) % 2:
+		raise SystemExit("snapshot takes pairs of a query and a filename.")
+	csv_params = __get_csv_params(args)
+	queries = zip(args.queries[::2], args.queries[1::2])
+	io.query_snapshot(args.db_url, queries, parallel=args.parallel, query_is_file=args.from_file,
+					  batch_size=args.batch_size, csv_params=csv_params,
+					  null_string=args.null_string, compression=args.compression,
+					  compression_level=args.compression_level, batch_bytes=args.batch_bytes,
+					  pipeline_depth=args.pipeline_depth, native_export=args.native_export,
+					  copy_format=args.copy_format)
 
 
 def replicate(args):
-	if args.fifo:
+	if ((args.compression is not None or args.compression_level is not None) and
+			(args.threaded or args.fifo or args.shards or args.targets)):
+		raise SystemExit("-c and -cl only apply with -nf.")
+	if args.shards or args.targets:
+		unsupported = [flag for dest, flag in FAN_UNSUPPORTED_FLAGS if getattr(args, dest)]
+		if args.copy_format != 'csv':
+			unsupported.append('-cf')
+		if unsupported:
+			raise SystemExit("{fan} does not support {flags}.".format(
+							 fan='-sh' if args.shards else '-tg', flags=', '.join(unsupported)))
+	if args.merge_keys is not None:
+		merge_keys = args.merge_keys.split(',')
+	else:
+		merge_keys = None
+	if args.shards:
+		if '{shard}' not in args.query_db_url:
+			raise SystemExit("With -sh, query_db_url needs a {shard} placeholder.")
+		query_db_urls = [args.query_db_url.replace('{shard}', shard) for shard in args.shards]
+		io.replicate_fanin(query_db_urls, args.load_db_url, args.query, args.table, args.append,
+						   query_is_file=args.from_file, analyze=args.analyze,
+						   disable_indices=args.disable_indices, create_staging=args.create_staging,
+						   do_rowcount_check=args.rowcount_check, batch_bytes=args.batch_bytes,
+						   direct=args.direct, bulk_pragmas=args.bulk_pragmas, merge=args.merge,
+						   merge_keys=merge_keys, delete_missing=args.delete_missing)
+	elif args.targets:
+		targets = [{'load_db_url' : args.load_db_url, 'table' : args.table}]
+		targets.extend({'load_db_url' : url, 'table' : table} for url, table in args.targets)
+		for target in targets:
+			target['append'] = args.append
+		results = io.replicate_fanout(args.query_db_url, args.query, targets,
+									  query_is_file=args.from_file, analyze=args.analyze,
+									  disable_indices=args.disable_indices,
+									  create_staging=args.create_staging,
+									  do_rowcount_check=args.rowcount_check,
+									  batch_bytes=args.batch_bytes, direct=args.direct,
+									  bulk_pragmas=args.bulk_pragmas, merge=args.merge,
+									  merge_keys=merge_keys, delete_missing=args.delete_missing)
+		if any(result['error'] is not None for result in results):
+			sys.exit(1)
+	elif args.chunk_by:
+		if args.threaded:
+			method = 'threaded'
+		elif args.fifo:
+			method = 'fifo'
+		else:
+			method = 'no_fifo'
+		io.replicate_chunked(args.query_db_url, args.load_db_url, args.query, args.table,
+							 args.append, args.chunk_by, chunks=args.chunks, method=method,
+							 query_is_file=args.from_file, analyze=args.analyze,
+							 checkpoint_key=args.checkpoint_key, max_attempts=args.max_attempts,
+							 disable_indices=args.disable_indices,
+							 do_rowcount_check=args.rowcount_check, direct=args.direct,
+							 bulk_pragmas=args.bulk_pragmas, compression=args.compression,
+							 compression_level=args.compression_level,
+							 batch_bytes=args.batch_bytes, pipeline_depth=args.pipeline_depth,
+							 native_export=args.native_export, copy_format=args.copy_format)
+	elif args.threaded:
+		io.replicate_threaded(args.query_db_url, args.load_db_url, args.query, args.table,
+							  args.append, analyze=args.analyze,
+							  disable_indices=args.disable_indices,
+							  query_is_file=args.from_file, create_staging=args.create_staging,
+							  do_rowcount_check=args.rowcount_check, batch_bytes=args.batch_bytes,
+							  pipeline_depth=args.pipeline_depth,
+							  native_export=args.native_export, copy_format=args.copy_format,
+							  direct=args.direct, bulk_pragmas=args.bulk_pragmas,
+							  watermark_column=args.watermark_column,
+							  watermark_key=args.watermark_key, merge=args.merge,
+							  merge_keys=merge_keys, delete_missing=args.delete_missing,
+							  pipe_size=args.pipe_size, profile=args.profile)
+	elif args.fifo:
 		io.replicate(args.query_db_url, args.load_db_url, args.query, args.table, 
 					 args.append, analyze=args.analyze, disable_indices=args.disable_indices,
 					 query_is_file=args.from_file, create_staging=args.create_staging,
-					 do_rowcount_check=args.rowcount_check, direct=args.direct)
+					 do_rowcount_check=args.rowcount_check, batch_bytes=args.batch_bytes,
+					 pipeline_depth=args.pipeline_depth, native_export=args.native_export,
+					 copy_format=args.copy_format, direct=args.direct,
+					 bulk_pragmas=args.bulk_pragmas, watermark_column=args.watermark_column,
+					 watermark_key=args.watermark_key, merge=args.merge, merge_keys=merge_keys,
+					 delete_missing=args.delete_missing, pipe_size=args.pipe_size,
+					 profile=args.profile)
 	else:
 		io.replicate_no_fifo(args.query_db_url, args.load_db_url, args.query, args.table, 
 							 args.append, analyze=args.analyze, 
 							 disable_indices=args.disable_indices,
 							 query_is_file=args.from_file, create_staging=args.create_staging,
-							 do_rowcount_check=args.rowcount_check, direct=args.direct)
+							 do_rowcount_check=args.rowcount_check, direct=args.direct,
+							 bulk_pragmas=args.bulk_pragmas, compression=args.compression,
+							 compression_level=args.compression_level,
+							 batch_bytes=args.batch_bytes, pipeline_depth=args.pipeline_depth,
+							 native_export=args.native_export, copy_format=args.copy_format,
+							 watermark_column=args.watermark_column,
+							 watermark_key=args.watermark_key, merge=args.merge,
+							 merge_keys=merge_keys, delete_missing=args.delete_missing,
+							 spool=args.spool, segment_bytes=args.segment_bytes,
+							 profile=args.profile)
+
+
+def sync(args):
+	io.sync(args.query_db_url, args.load_db_url, args.table, source_table=args.source_table,
+			key=args.key, chunks=args.chunks, direct=args.direct, bulk_pragmas=args.bulk_pragmas)
+
+
+def run(args):
+	results = jobs.run_manifest(args.manifest, workers=args.workers)
+	print jobs.format_summary(results)
+	if any(result['status'] != jobs.SUCCEEDED for result in results):
+		sys.exit(1)
 
 
 def main():
@@ -43,11 +217,18 @@ def main():
 			 						"querying to CSV, or querying to a table in a database."))
 	parser.add_argument('-v', '--verbose', action='store_true')
 	parser.add_argument('-q', '--quiet', action='store_true')	
+	parser.add_argument('--pool-size', type=int, dest='pool_size',
+						help="Number of connections kept open to each database.")
+	parser.add_argument('--pool-pre-ping', dest='pool_pre_ping', action='store_true',
+						help="Test pooled connections before use, reopening dropped ones.")
 
-	# Subparsers: 'query','load','replicate'
+	# Subparsers: 'query','snapshot','load','replicate','sync','run'
 	subparsers = parser.add_subparsers(title='Operation', description="I/O operation.")
 	__setup_replicate_parser(subparsers)
+	__setup_sync_parser(subparsers)
+	__setup_run_parser(subparsers)
 	__setup_query_parser(subparsers)
+	__setup_snapshot_parser(subparsers)
 	__setup_load_parser(subparsers)
 
 	# Handle all arg parsing.
@@ -60,6 +241,8 @@ def main():
 		logging.basicConfig(level=logging.WARNING)
 	else:
 		logging.basicConfig(level=logging.INFO)
+
+	configure_engines(pool_size=args.pool_size, pool_pre_ping=args.pool_pre_ping or None)
 	 
 	# Call the specified script.
 	args.func(args)
@@ -88,15 +271,116 @@ def __setup_replicate_parser(subparsers):
 										"before loading and recreated after."))
 	replicate_parser.add_argument('-nf', '--no-fifo', dest='fifo', action='store_false', 
 									help="Include to avoid using mkfifo(), a Unix-only operation.")
+	replicate_parser.add_argument('-sp', '--spool', dest='spool', action='store_true',
+									help=("With --no-fifo, load the temporary files while the query "
+										"is still writing them, deleting each once loaded."))
+	replicate_parser.add_argument('-sb', '--segment-bytes', type=__parse_size, dest='segment_bytes',
+									default=io.SEGMENT_BYTES,
+									help="With --spool, the size of each temporary file (e.g. 16M).")
+	replicate_parser.add_argument('-t', '--threaded', dest='threaded', action='store_true',
+									help=("Run the query and the load on threads of this process "
+										"instead of spawning two dbio processes."))
+	replicate_parser.add_argument('-cf', '--copy-format', dest='copy_format',
+									choices=io.COPY_FORMATS, default='csv',
+									help=("Bulk format to replicate in. 'binary' requires "
+										"PostgreSQL as the load database."))
+	replicate_parser.add_argument('-c', '--compression', choices=compression.CODECS,
+									help="With --no-fifo, compress the temporary file with this codec.")
+	replicate_parser.add_argument('-cl', '--compression-level', type=int, dest='compression_level',
+									help="Codec specific compression level.")
+	replicate_parser.add_argument('-bb', '--batch-bytes', type=__parse_size, dest='batch_bytes',
+									help=("Size query batches to about this many bytes (e.g. 64M) "
+										"instead of a fixed number of rows."))
+	replicate_parser.add_argument('-pd', '--pipeline-depth', type=int, dest='pipeline_depth',
+									help=("Fetch, encode and write query batches on separate "
+										"threads, queueing at most this many batches between them."))
+	replicate_parser.add_argument('-ps', '--pipe-size', type=__parse_size, dest='pipe_size',
+									help=("Enlarge the pipe buffer to this many bytes (e.g. 1M) and "
+										"write to it in chunks of half as many. Linux only."))
+	replicate_parser.add_argument('-ne', '--native-export', dest='native_export', action='store_true',
+									help=("Export with the query database's own bulk export "
+										"command, e.g. COPY TO STDOUT for PostgreSQL."))
+	replicate_parser.add_argument('-pr', '--profile', dest='profile',
+									help=("Save a cProfile of the query and of the load to this "
+										"file with .query and .load added before the extension, "
+										"e.g. out.query.pstats for out.pstats."))
 	replicate_parser.add_argument('-s', '--staging-exists', dest='create_staging', action='store_false',
 									help="Include if a table named table_staging already exists.")
 	replicate_parser.add_argument('-rc', '--rowcount-check', dest='rowcount_check', action='store_true',
-									help="Only succeed if the load table rowcount matches the query rowcount.")
+									help="Only succeed if the rows loaded match the rows the query returned.")
+	replicate_parser.add_argument('-m', '--merge', dest='merge', action='store_true',
+									help=("Merge the results into table on its keys instead of "
+										"appending them or replacing the table."))
+	replicate_parser.add_argument('-mk', '--merge-keys', dest='merge_keys',
+									help="Comma separated columns to merge on. Defaults to the primary key.")
+	replicate_parser.add_argument('-dm', '--delete-missing', dest='delete_missing', action='store_true',
+									help="With -m, delete the rows of table that are not in the results.")
+	replicate_parser.add_argument('-wc', '--watermark-column', dest='watermark_column',
+									help=("Only replicate rows past the largest value of this column "
+										"replicated before, appending or merging them. Requires -a or -m."))
+	replicate_parser.add_argument('-wk', '--watermark-key', dest='watermark_key',
+									help=("Name of the source the watermark is saved under. Defaults "
+										"to a hash of query_db_url and query."))
+	replicate_parser.add_argument('-sh', '--shards', type=__parse_shards, dest='shards',
+									help=("Comma separated shard ids or ranges, e.g. 0-15, to put in "
+										"place of {shard} in query_db_url. Every shard is queried at "
+										"once, and the results are loaded together."))
+	replicate_parser.add_argument('-tg', '--target', dest='targets', nargs=2, action='append',
+									metavar=('LOAD_DB_URL', 'TABLE'),
+									help=("Also load the results into this table, running the query "
+										"once. May be repeated. Loads run on threads, as with -t, "
+										"and succeed or fail independently."))
+	replicate_parser.add_argument('-cb', '--chunk-by', dest='chunk_by',
+									help=("Replicate in ranges of this column, committing each one, "
+										"so that a failed replication resumes where it stopped."))
+	replicate_parser.add_argument('-nc', '--chunks', type=int, dest='chunks', default=io.REPLICATE_CHUNKS,
+									help="With -cb, the number of ranges to split the column into.")
+	replicate_parser.add_argument('-ck', '--checkpoint-key', dest='checkpoint_key',
+									help=("With -cb, name of the replication the checkpoint is saved "
+										"under. Defaults to a hash of query_db_url and query."))
+	replicate_parser.add_argument('-ma', '--max-attempts', type=int, dest='max_attempts',
+									default=io.MAX_WRITE_ATTEMPTS,
+									help="With -cb, the number of times each range is attempted.")
 	replicate_parser.add_argument('-dt', '--direct', dest='direct', action='store_const', const='DIRECT',
 								  default='', help="Special keywoard for Vertica load commands to skip WOS")
+	replicate_parser.add_argument('-bp', '--bulk-pragmas', dest='bulk_pragmas', action='store_true',
+									help=("For SQLite, turn off syncing and journaling to disk while "
+										"loading. A crash during the load can corrupt the database."))
 	replicate_parser.set_defaults(func=replicate)
 
 
+def __setup_run_parser(subparsers):
+	run_parser = subparsers.add_parser('run', description=("Run the query, load, replicate and sync "
+									   "jobs of a manifest file, several at a time."))
+
+	run_parser.add_argument('manifest', help=("YAML manifest of jobs, or JSON if the name ends "
+											"with .json. YAML requires the PyYAML package."))
+	run_parser.add_argument('-w', '--workers', type=int, dest='workers',
+							help="Number of jobs run at once. Overrides the manifest's workers.")
+	run_parser.set_defaults(func=run)
+
+
+def __setup_sync_parser(subparsers):
+	sync_parser = subparsers.add_parser('sync', description=("Bring a table up to date with a table "
+										"in another database, copying only the key ranges that differ."))
+
+	sync_parser.add_argument('query_db_url', help="SQLAlchemy engine creation URL for the source database.")
+	sync_parser.add_argument('load_db_url', help="SQLAlchemy engine creation URL for the database of table.")
+	sync_parser.add_argument('table', help="Table in 'load_db' that will be brought up to date.")
+	sync_parser.add_argument('-st', '--source-table', dest='source_table',
+							 help="Table in 'query_db' to copy from. Defaults to table.")
+	sync_parser.add_argument('-k', '--key', dest='key',
+							 help="Column to split the tables on. Defaults to the primary key of table.")
+	sync_parser.add_argument('-n', '--chunks', type=int, dest='chunks', default=io.SYNC_CHUNKS,
+							 help="Number of key ranges to checksum and compare.")
+	sync_parser.add_argument('-dt', '--direct', dest='direct', action='store_const', const='DIRECT',
+							 default='', help="Special keywoard for Vertica load commands to skip WOS")
+	sync_parser.add_argument('-bp', '--bulk-pragmas', dest='bulk_pragmas', action='store_true',
+							 help=("For SQLite, turn off syncing and journaling to disk while "
+								"loading. A crash during the load can corrupt the database."))
+	sync_parser.set_defaults(func=sync)
+
+
 def __setup_query_parser(subparsers):
 	query_parser = subparsers.add_parser('query', description=("Query a table and put the results into a csv file."))
 	
@@ -107,6 +391,48 @@ def __setup_query_parser(subparsers):
 	query_parser.add_argument('-f', '--file', dest='from_file', action='store_true', 
 									help="This flag indicates that 'query' is a file name")
 	query_parser.add_argument('-b', '--batchsize', type=int, dest='batch_size', default=io.FILE_WRITE_BATCH)
+	query_parser.add_argument('-bb', '--batch-bytes', type=__parse_size, dest='batch_bytes',
+								help=("Size batches to about this many bytes (e.g. 64M) instead "
+									"of --batchsize rows."))
+	query_parser.add_argument('-pd', '--pipeline-depth', type=int, dest='pipeline_depth',
+								help=("Fetch, encode and write on separate threads, queueing at "
+									"most this many batches between them."))
+	query_parser.add_argument('-ps', '--pipe-size', type=__parse_size, dest='pipe_size',
+								help=("If filename is a named pipe, enlarge its buffer to this many "
+									"bytes. Linux only."))
+	query_parser.add_argument('-pr', '--profile', dest='profile',
+								help="Save a cProfile of the query to this file, e.g. out.pstats.")
+	query_parser.add_argument('-tf', '--timings-file', dest='timings_file',
+								help="Save the phases of the query to this file as JSON.")
+	query_parser.add_argument('-ne', '--native-export', dest='native_export', action='store_true',
+								help=("Write the file with the database's own bulk export command, "
+									"e.g. COPY TO STDOUT for PostgreSQL."))
+
+	# PARTITIONING ARGS
+	query_parser.add_argument('-pb', '--partition-by', dest='partition_by',
+								help=("Split the results into ranges of this column and query "
+									"them over separate connections."))
+	query_parser.add_argument('-p', '--parallel', type=int, dest='parallel', default=1,
+								help="Number of ranges to query at the same time.")
+	query_parser.add_argument('-np', '--partitions', type=int, dest='partitions',
+								help="Number of ranges to split the column into. Defaults to --parallel.")
+	query_parser.add_argument('-bd', '--boundaries', dest='boundaries',
+								help="Comma separated, sorted values at which ranges start.")
+	query_parser.add_argument('-sf', '--shard-files', dest='shard_files', action='store_true',
+								help=("Leave each range in its own file (filename.0000, ...) "
+									"instead of merging them into filename."))
+	query_parser.add_argument('-cf', '--copy-format', dest='copy_format',
+								choices=io.COPY_FORMATS, default='csv',
+								help="Bulk format to write. 'binary' is PostgreSQL's binary COPY format.")
+	query_parser.add_argument('-ct', '--column-types', dest='column_types',
+								help=("With -cf binary, comma separated PostgreSQL types of the "
+									"columns the file will be loaded into."))
+	query_parser.add_argument('-rf', '--rowcount-file', dest='rowcount_file',
+								help="Save the number of rows written to this file.")
+	query_parser.add_argument('-c', '--compression', choices=compression.CODECS,
+								help="Compress the file with this codec. Inferred from the extension if omitted.")
+	query_parser.add_argument('-cl', '--compression-level', type=int, dest='compression_level',
+								help="Codec specific compression level.")
 	
 	# CSV ARGS
 	query_parser.add_argument('-qc', '--quotechar', default=None, help='Character to enclose fields. If not included, fields are not enclosed.')
@@ -119,6 +445,48 @@ def __setup_query_parser(subparsers):
 	query_parser.set_defaults(func=query)
 
 
+def __setup_snapshot_parser(subparsers):
+	snapshot_parser = subparsers.add_parser('snapshot', description=("Run several queries against "
+											"one snapshot of a database, each into its own csv file."))
+
+	snapshot_parser.add_argument('db_url', help="SQLAlchemy engine creation URL for db.")
+	snapshot_parser.add_argument('queries', nargs='+', metavar='QUERY FILENAME',
+								help=("Pairs of a SQL query string, or a file name if -f is "
+									"included, and the file to write its results to."))
+	snapshot_parser.add_argument('-f', '--file', dest='from_file', action='store_true',
+								help="This flag indicates that the queries are file names")
+	snapshot_parser.add_argument('-p', '--parallel', type=int, dest='parallel', default=1,
+								help=("Number of queries to run at the same time. Only PostgreSQL "
+									"shares a snapshot between connections, others run one at a time."))
+	snapshot_parser.add_argument('-b', '--batchsize', type=int, dest='batch_size', default=io.FILE_WRITE_BATCH)
+	snapshot_parser.add_argument('-bb', '--batch-bytes', type=__parse_size, dest='batch_bytes',
+								help=("Size batches to about this many bytes (e.g. 64M) instead "
+									"of --batchsize rows."))
+	snapshot_parser.add_argument('-pd', '--pipeline-depth', type=int, dest='pipeline_depth',
+								help=("Fetch, encode and write on separate threads, queueing at "
+									"most this many batches between them."))
+	snapshot_parser.add_argument('-ne', '--native-export', dest='native_export', action='store_true',
+								help=("Write the files with the database's own bulk export command, "
+									"e.g. COPY TO STDOUT for PostgreSQL."))
+	snapshot_parser.add_argument('-cf', '--copy-format', dest='copy_format',
+								choices=io.COPY_FORMATS, default='csv',
+								help="Bulk format to write. 'binary' is PostgreSQL's binary COPY format.")
+	snapshot_parser.add_argument('-c', '--compression', choices=compression.CODECS,
+								help="Compress the files with this codec. Inferred from the extensions if omitted.")
+	snapshot_parser.add_argument('-cl', '--compression-level', type=int, dest='compression_level',
+								help="Codec specific compression level.")
+
+	# CSV ARGS
+	snapshot_parser.add_argument('-qc', '--quotechar', default=None, help='Character to enclose fields. If not included, fields are not enclosed.')
+	snapshot_parser.add_argument('-ns', '--null-string', default=DEFAULT_NULL_STRING, help='String to replace NULL fields.')
+	snapshot_parser.add_argument('-d', '--delimiter', default=DEFAULT_CSV_PARAMS['delimiter'], help='Field separation character.')
+	snapshot_parser.add_argument('-esc', '--escapechar', default=DEFAULT_CSV_PARAMS['escapechar'], help='Escape character.')
+	snapshot_parser.add_argument('-l', '--lineterminator', default=DEFAULT_CSV_PARAMS['lineterminator'], help='Record terminator.')
+	snapshot_parser.add_argument('-e', '--encoding', default=DEFAULT_CSV_PARAMS['encoding'], help='Character encoding.')
+
+	snapshot_parser.set_defaults(func=snapshot)
+
+
 def __setup_load_parser(subparsers):
 	load_parser = subparsers.add_parser('load', description=("Load data into a table from a file."))
 	
@@ -137,9 +505,34 @@ def __setup_load_parser(subparsers):
 	load_parser.add_argument('-s', '--staging-exists', dest='create_staging', action='store_false',
 									help="Include if a table named table_staging already exists.")
 	load_parser.add_argument('-r', '--expected-rowcount', dest='expected_rowcount', type=int,
-									help='Number of rows expected in the table after loading.')
+									help='Number of rows expected to be loaded.')
+	load_parser.add_argument('-rf', '--expected-rowcount-file', dest='expected_rowcount_file',
+									help=("File that query -rf saves the expected number of rows "
+										"to, read once the data has been loaded."))
+	load_parser.add_argument('-m', '--merge', dest='merge', action='store_true',
+							 help=("Merge the file into table on its keys instead of appending it "
+								"or replacing the table."))
+	load_parser.add_argument('-mk', '--merge-keys', dest='merge_keys',
+							 help="Comma separated columns to merge on. Defaults to the primary key.")
+	load_parser.add_argument('-dm', '--delete-missing', dest='delete_missing', action='store_true',
+							 help="With -m, delete the rows of table that are not in the file.")
+	load_parser.add_argument('-wm', '--watermark', nargs=3, metavar=('KEY', 'COLUMN', 'MARK'),
+							 help=("Save MARK, a SQL literal, as the watermark of COLUMN for the "
+								"source KEY in the load transaction. Used by replicate -wc."))
 	load_parser.add_argument('-dt', '--direct', dest='direct', action='store_const', const='DIRECT',
 							 default='', help="Special keywoard for Vertica load commands to skip WOS")
+	load_parser.add_argument('-bp', '--bulk-pragmas', dest='bulk_pragmas', action='store_true',
+							 help=("For SQLite, turn off syncing and journaling to disk while "
+								"loading. A crash during the load can corrupt the database."))
+	load_parser.add_argument('-cf', '--copy-format', dest='copy_format',
+							 choices=io.COPY_FORMATS, default='csv',
+							 help="Bulk format of the file, as written by query.")
+	load_parser.add_argument('-pr', '--profile', dest='profile',
+							 help="Save a cProfile of the load to this file, e.g. out.pstats.")
+	load_parser.add_argument('-tf', '--timings-file', dest='timings_file',
+							 help="Save the phases of the load to this file as JSON.")
+	load_parser.add_argument('-c', '--compression', choices=compression.CODECS,
+							 help="Codec the file is compressed with. Inferred from the extension if omitted.")
 	# CSV ARGS
 	load_parser.add_argument('-qc', '--quotechar', default=None, help='Character to enclose fields. If not included, fields are not enclosed.')
 	load_parser.add_argument('-ns', '--null-string', default=DEFAULT_NULL_STRING, help='String to replace NULL fields.')
@@ -158,12 +551,59 @@ def __get_csv_params(args):
 	csv_params['lineterminator'] = args.lineterminator
 	csv_params['encoding'] = args.encoding
 	if args.quotechar:
-		csv_params['quoting'] = unicodecsv.QUOTE_ALL
+		csv_params['quoting'] = csv.QUOTE_ALL
 		csv_params['quotechar'] = args.quotechar
 	else:
-		csv_params['quoting'] = unicodecsv.QUOTE_NONE
+		csv_params['quoting'] = csv.QUOTE_NONE
 	return csv_params
 
 
+def __parse_boundary(boundary):
+	for parse in (int, float):
+		try:
+			return parse(boundary)
+		except ValueError:
+			pass
+	return boundary
+
+
+def __read_rowcount(filename):
+	with open(filename) as f:
+		rowcount = f.read().strip()
+	if not rowcount:
+		raise ValueError("No row count in {filename}, the query did not finish.".format(
+						 filename=filename))
+	return int(rowcount)
+
+
+def __parse_shards(shards):
+	ids = []
+	for part in shards.split(','):
+		first, _, last = part.partition('-')
+		if last:
+			try:
+				ids.extend(str(shard) for shard in range(int(first), int(last) + 1))
+			except ValueError:
+				raise argparse.ArgumentTypeError("invalid shard range: " + part)
+		else:
+			ids.append(first)
+	return ids
+
+
+def __parse_size(size):
+	multiplier = 1
+	suffix = size[-1:].upper()
+	if suffix in SIZE_SUFFIXES:
+		multiplier = SIZE_SUFFIXES[suffix]
+		size = size[:-1]
+	try:
+		value = int(size) * multiplier
+	except ValueError:
+		raise argparse.ArgumentTypeError("invalid size: " + size)
+	if value <= 0:
+		raise argparse.ArgumentTypeError("size must be positive")
+	return value
+
+
 if __name__ == "__main__":
 	main()
\ No newline at end of file
@@ -0,0 +1,231 @@
+# Python standard library
+import contextlib
+import errno
+import gzip
+import os
+import shutil
+import sys
+import tempfile
+import threading
+
+""" Streaming codecs for query output and load input. gzip is always available, zstd and lz4
+	need the zstandard and lz4 packages, which are imported only when used. """
+
+CODECS = ('gzip', 'zstd', 'lz4')
+
+EXTENSIONS = {
+	'.gz' : 'gzip',
+	'.gzip' : 'gzip',
+	'.zst' : 'zstd',
+	'.zstd' : 'zstd',
+	'.lz4' : 'lz4'
+}
+
+DEFAULT_LEVELS = {
+	'gzip' : 6,
+	'zstd' : 3,
+	'lz4' : 0
+}
+
+READ_SIZE = 1024 * 1024
+
+
+def infer_compression(filename, compression=None):
+	""" Works out which codec applies to a file.
+
+		:param filename: Name of the file.
+		:param compression: Codec name. Overrides the file extension if given.
+
+		:returns: The codec name, or None for uncompressed files.
+
+	"""
+	if compression is None:
+		compression = EXTENSIONS.get(os.path.splitext(filename)[1].lower())
+	if compression is not None and compression not in CODECS:
+		raise UnsupportedCompressionError(compression + " is an unsupported compression codec.")
+	return compression
+
+
+def open_file(filename, mode, compression=None, level=None):
+	""" Opens a file for streaming through a codec.
+
+		:param filename: Name of the file, or a file object open for reading, such as a
+					:py:class:`dbio.spool.SpoolReader`, which is returned as is.
+		:param mode: 'rb' or 'wb'.
+		:param compression: Codec name. If None, it is inferred from the file extension.
+		:param level: Compression level when writing. Higher levels spend more CPU to write
+					fewer bytes. Defaults to a fast level of each codec.
+
+		:returns: A file object. Uncompressed files are opened with the builtin open().
+
+	"""
+	if hasattr(filename, 'read'):
+		return filename
+	compression = infer_compression(filename, compression)
+	if compression is None:
+		return open(filename, mode)
+	if level is None:
+		level = DEFAULT_LEVELS[compression]
+
+	if compression == 'gzip':
+		return gzip.open(filename, mode, level)
+	elif compression == 'zstd':
+		zstd = __import_codec('zstandard', 'zstd')
+		raw = open(filename, mode)
+		if 'w' in mode:
+			stream = zstd.ZstdCompressor(level=level).stream_writer(raw)
+		else:
+			stream = zstd.ZstdDecompressor().stream_reader(raw)
+		return StreamFile(raw, stream)
+	else:
+		lz4_frame = __import_codec('lz4.frame', 'lz4')
+		return lz4_frame.open(filename, mode, compression_level=level)
+
+
+@contextlib.contextmanager
+def decompressed_path(filename, compression=None):
+	""" For loaders that can only be given a file name. Yields filename itself if it is not
+		compressed, otherwise a named pipe that a thread fills with the decompressed contents.
+
+		If decompressing fails, the error is raised when the context exits, so that a load
+		inside it can be rolled back.
+
+		filename may also be a file object open for reading, which is copied into the pipe
+		the same way.
+
+		**Unix only for compressed files and file objects.**
+
+	"""
+	if hasattr(filename, 'read'):
+		src = filename
+	else:
+		compression = infer_compression(filename, compression)
+		if compression is None:
+			yield filename
+			return
+		# Opened here so that a missing file fails before the loader waits on the pipe.
+		src = open_file(filename, 'rb', compression)
+
+	pipe_dir = tempfile.mkdtemp(prefix='dbio_')
+	pipe_name = os.path.join(pipe_dir, 'decompressed')
+	os.mkfifo(pipe_name)
+	failure = []
+
+	def feed():
+		try:
+			with src, open(pipe_name, 'wb') as dst:
+				shutil.copyfileobj(src, dst, READ_SIZE)
+		except IOError as e:
+			# The loader closed the pipe early; it reports its own error.
+			if e.errno != errno.EPIPE:
+				failure.append(sys.exc_info())
+		except:
+			failure.append(sys.exc_info())
+
+	feeder = threading.Thread(target=feed, name='dbio-decompress')
+	feeder.daemon = True
+	feeder.start()
+	try:
+		yield pipe_name
+	finally:
+		# If the loader never opened the pipe, the feeder is blocked opening it until
+		# a reader comes along.
+		while feeder.is_alive():
+			os.close(os.open(pipe_name, os.O_RDONLY | os.O_NONBLOCK))
+			feeder.join(0.1)
+		shutil.rmtree(pipe_dir)
+
+	if failure:
+		raise failure[0][0], failure[0][1], failure[0][2]
+
+
+def __import_codec(module_name, compression):
+	try:
+		__import__(module_name)
+	except ImportError:
+		raise UnsupportedCompressionError("The {module} package is required for {codec} "
+			"compression.".format(module=module_name.split('.')[0], codec=compression))
+	return sys.modules[module_name]
+
+
+class StreamFile(object):
+	""" File object over a zstandard stream, which by itself only offers read() or write()
+		and must be closed through its context manager to finish the frame. """
+
+	def __init__(self, raw, stream):
+		self.raw = raw
+		self.stream = stream.__enter__()
+		self.buffer = ''
+		self.closed = False
+
+
+	def read(self, size=-1):
+		if size is None or size < 0:
+			chunks = [self.buffer]
+			chunk = self.stream.read(READ_SIZE)
+			while chunk:
+				chunks.append(chunk)
+				chunk = self.stream.read(READ_SIZE)
+			self.buffer = ''
+			return ''.join(chunks)
+
+		while len(self.buffer) < size:
+			chunk = self.stream.read(READ_SIZE)
+			if not chunk:
+				break
+			self.buffer += chunk
+		data, self.buffer = self.buffer[:size], self.buffer[size:]
+		return data
+
+
+	def readline(self):
+		end = self.buffer.find('\n')
+		while end < 0:
+			chunk = self.stream.read(READ_SIZE)
+			if not chunk:
+				break
+			end = chunk.find('\n')
+			if end >= 0:
+				end += len(self.buffer)
+			self.buffer += chunk
+		if end < 0:
+			line, self.buffer = self.buffer, ''
+		else:
+			line, self.buffer = self.buffer[:end + 1], self.buffer[end + 1:]
+		return line
+
+
+	def __iter__(self):
+		line = self.readline()
+		while line:
+			yield line
+			line = self.readline()
+
+
+	def write(self, data):
+		self.stream.write(data)
+
+
+	def flush(self):
+		pass
+
+
+	def close(self):
+		if not self.closed:
+			self.closed = True
+			try:
+				self.stream.__exit__(None, None, None)
+			finally:
+				self.raw.close()
+
+
+	def __enter__(self):
+		return self
+
+
+	def __exit__(self, type, value, traceback):
+		self.close()
+
+
+class UnsupportedCompressionError(Exception):
+	pass
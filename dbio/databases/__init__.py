@@ -1,25 +1,79 @@
+# Python standard library
+import csv
 import importlib
 
-from base import Importable
+""" Registry of the database class of each SQLAlchemy dialect and driver. A class's module,
+	and with it SQLAlchemy and the DB API module, is only imported once a URL of its dialect
+	and driver is used, so that the library can be used without all of the DB API modules
+	installed, and ``dbio -h`` imports none of them.
 
-DEFAULT_CSV_PARAMS = Importable.DEFAULT_CSV_PARAMS
-DEFAULT_NULL_STRING = Importable.DEFAULT_NULL_STRING
+	Other packages add database classes through the 'dbio.databases' entry point group,
+	naming each entry point dialect+driver, e.g. in their setup.py::
 
-""" This fancy dynamic importing is just to allow for use of the library without having
-	all of the DB API modules installed. """
+		entry_points={
+			'dbio.databases': ['oracle+cx_oracle = dbio_oracle:Oracle']
+		}
 
+	or at run time with :py:func:`register_backend`. """
+
+DEFAULT_CSV_PARAMS = {
+					'delimiter' : ',',
+					'escapechar' : '\\',
+					'lineterminator' : '\n',
+					'encoding' : 'utf-8',
+					'quoting' : csv.QUOTE_NONE
+}
+
+DEFAULT_NULL_STRING = 'NULL'
+
+ENTRY_POINT_GROUP = 'dbio.databases'
+
+# 'module:class' of each dialect and driver.
 dialect_driver_class_map = {
 	'mysql' : {
-		'mysqldb' : getattr(importlib.import_module('dbio.databases.mysql'), 'MySQL')
+		'mysqldb' : 'dbio.databases.mysql:MySQL'
 	},
 	'postgresql' : {
-		'psycopg2' : getattr(importlib.import_module('dbio.databases.postgresql'), 'PostgreSQL')
+		'psycopg2' : 'dbio.databases.postgresql:PostgreSQL'
 	},
 	'sqlite' : {
-		'pysqlite' : getattr(importlib.import_module('dbio.databases.sqlite'), 'SQLite')
+		'pysqlite' : 'dbio.databases.sqlite:SQLite'
 	},
 	'vertica' : {
-		'vertica_python' : getattr(importlib.import_module('dbio.databases.vertica'), 'Vertica'),
-		'pyodbc' : getattr(importlib.import_module('dbio.databases.vertica'), 'VerticaODBC')
+		'vertica_python' : 'dbio.databases.vertica:Vertica',
+		'pyodbc' : 'dbio.databases.vertica:VerticaODBC'
 	}
-}
\ No newline at end of file
+}
+
+
+def register_backend(dialect, driver, backend):
+	""" :param dialect: SQLAlchemy dialect name, e.g. 'postgresql'.
+		:param driver: SQLAlchemy driver name, e.g. 'psycopg2'.
+		:param backend: Database class, or 'module:class' to import it from when first used.
+	"""
+	dialect_driver_class_map.setdefault(dialect, {})[driver] = backend
+
+
+def get_backend(dialect, driver):
+	""" :returns: The database class of dialect and driver, imported on first use.
+		:raises KeyError: Neither registered nor provided by an entry point.
+	"""
+	backend = dialect_driver_class_map.get(dialect, {}).get(driver)
+	if backend is None:
+		backend = __load_entry_point(dialect, driver)
+	if isinstance(backend, basestring):
+		module_name, class_name = backend.split(':')
+		backend = getattr(importlib.import_module(module_name), class_name)
+		register_backend(dialect, driver, backend)
+	return backend
+
+
+def __load_entry_point(dialect, driver):
+	# pkg_resources takes a while to import, so it is only imported for unknown backends.
+	import pkg_resources
+	name = dialect + '+' + driver
+	for entry_point in pkg_resources.iter_entry_points(ENTRY_POINT_GROUP, name):
+		backend = entry_point.load()
+		register_backend(dialect, driver, backend)
+		return backend
+	raise KeyError(name)
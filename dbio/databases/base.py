@@ -3,7 +3,10 @@ import logging
 
 # PyPI packages
 import sqlalchemy
-import unicodecsv
+
+# Local modules
+from dbio.databases import DEFAULT_CSV_PARAMS, DEFAULT_NULL_STRING
+from engines import get_engine
 
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.NullHandler())
@@ -13,6 +16,21 @@ class Exportable():
 
 	SELECT_COUNT_CMD = "SELECT COUNT(*) FROM ({query}) AS query_count;"
 
+	SELECT_RANGE_CMD = "SELECT MIN({column}), MAX({column}) FROM ({query}) AS query_range;"
+
+	COPY_FORMATS = ('csv',)
+
+	CHECKSUM_CMD = "SELECT COUNT(*), SUM({hash}), SUM(LENGTH({row})) FROM {table} WHERE {predicate};"
+
+	# Text of one column in the rows hashed by CHECKSUM_CMD.
+	CHECKSUM_COLUMN = "COALESCE(CAST({column} AS VARCHAR), 'NULL')"
+
+	# The first 32 bits of the MD5 of {row} as an integer, or None if not supported.
+	ROW_HASH = None
+
+	# Run at the start of a transaction so that its queries all read one snapshot.
+	BEGIN_SNAPSHOT_CMDS = ("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ",)
+
 	def __init__(self, url):
 		"""
 			:param url: sqlalchemy engine creation url.
@@ -22,8 +40,16 @@ class Exportable():
 	
 
 	def get_export_engine(self):
-		""" :returns: sqlalchemy engine object. """
-		return sqlalchemy.create_engine(self.url)
+		""" :returns: sqlalchemy engine object, created on first use. """
+		if getattr(self, 'export_engine', None) is None:
+			self.export_engine = self.create_export_engine()
+		return self.export_engine
+
+
+	def create_export_engine(self):
+		""" :returns: sqlalchemy engine object, shared with every database object for the
+				same URL (see :py:mod:`dbio.databases.engines`). """
+		return get_engine(self.url)
 
 
 	def get_query_rowcount(self, query):
@@ -42,21 +68,141 @@ class Exportable():
 		return rowcount
 
 
+	def get_query_range(self, query, column):
+		""" Gets the smallest and largest value of a column in the results of a query.
+
+			:param query: The query whose results are examined.
+			:param column: Name of the column in the results.
+
+			:returns: (min, max) tuple. Both are None if the query returns no rows.
+
+		"""
+		engine = self.get_export_engine()
+		results = engine.execute(self.SELECT_RANGE_CMD.format(query=query, column=column))
+		value_range = tuple(results.fetchall()[0])
+		results.close()
+		logger.info("Range of {column}: {range}.".format(column=column, range=value_range))
+		return value_range
+
+
+	def get_chunk_checksum(self, table, columns, predicate):
+		""" Checksums the rows of a table matching a predicate on the server. The checksum is
+			the sum of a hash of each row's text, so it does not depend on the order of the
+			rows. Values are converted to text by the database, so tables in databases of
+			different kinds can differ in checksum while holding the same values.
+
+			:param table: The table to checksum.
+			:param columns: List of the columns to include, in the same order on both sides
+					of a comparison.
+			:param predicate: SQL condition selecting the rows.
+
+			:returns: (rowcount, checksum, text_length) tuple, text_length being the total
+					length of the rows' text, about the size of them as CSV.
+
+		"""
+		if self.ROW_HASH is None:
+			raise NotImplementedError(self.__class__.__name__ + " does not support checksums.")
+		row = self.get_checksum_row(columns)
+		engine = self.get_export_engine()
+		results = engine.execute(self.CHECKSUM_CMD.format(hash=self.ROW_HASH.format(row=row),
+														  row=row, table=table,
+														  predicate=predicate))
+		rowcount, checksum, text_length = results.fetchall()[0]
+		results.close()
+		return rowcount, int(checksum or 0), int(text_length or 0)
+
+
+	def get_checksum_row(self, columns):
+		""" :returns: SQL expression of the text of a row hashed by :py:meth:`get_chunk_checksum`,
+			its columns separated by '|'. """
+		return " || '|' || ".join(self.CHECKSUM_COLUMN.format(column=column) for column in columns)
+
+
+	def begin_snapshot(self, connection, snapshot=None):
+		""" Makes the transaction begun on connection read from one snapshot of the
+			database until it ends. Must come before any query in the transaction.
+
+			:param connection: sqlalchemy connection in a transaction.
+			:param snapshot: Identifier returned by :py:meth:`export_snapshot` in another
+					transaction, whose snapshot is read instead of a new one.
+
+		"""
+		if snapshot is not None:
+			raise NotImplementedError(self.__class__.__name__ + " does not support sharing snapshots.")
+		for cmd in self.BEGIN_SNAPSHOT_CMDS:
+			connection.execute(cmd)
+
+
+	def export_snapshot(self, connection):
+		""" :returns: Identifier of the snapshot read by the transaction on connection, to be
+			passed to :py:meth:`begin_snapshot` in other transactions, or None if the
+			database cannot share snapshots between transactions. """
+		return None
+
+
+	def execute_export(self, query, f, csv_params, null_string, copy_format='csv',
+					   connection=None):
+		""" Database specific implementation of writing query results to a CSV file with the
+			database's own bulk export command, so that rows are never turned into Python
+			objects. The output is in the dialect of csv_params, but values are formatted by
+			the database, so may differ from :py:func:`dbio.query`.
+
+			:param query: SQL query string to execute.
+			:param f: File object to write to.
+			:param csv_params: Dictionary of csv parameters.
+			:param null_string: String to represent null values with.
+			:param copy_format: One of COPY_FORMATS.
+			:param connection: sqlalchemy connection to export on, e.g. in a transaction
+					begun with :py:meth:`begin_snapshot`. Defaults to a new connection.
+
+			:returns: The number of rows written.
+			:raises ValueError: csv_params that the database cannot write.
+
+		"""
+		raise NotImplementedError(self.__class__.__name__ + " does not support native export.")
+
+
 class Importable():
 	""" Designed to be the target of **load** operations. """
 
-	DEFAULT_CSV_PARAMS = {
-						'delimiter' : ',', 
-						'escapechar' : '\\',
-						'lineterminator' : '\n',
-						'encoding' : 'utf-8',
-						'quoting' : unicodecsv.QUOTE_NONE
-	}
+	DEFAULT_CSV_PARAMS = DEFAULT_CSV_PARAMS
 
-	DEFAULT_NULL_STRING = 'NULL'
+	DEFAULT_NULL_STRING = DEFAULT_NULL_STRING
+
+	# Whether the output of execute_export() is loaded as written, i.e. by PostgreSQL, whose
+	# COPY reads the values COPY TO STDOUT formats.
+	LOADS_NATIVE_EXPORT = False
 
 	ROWCOUNT_QUERY = "SELECT COUNT(*) FROM {table};"
 
+	# Standard SQL MERGE, for databases without a form of their own.
+	MERGE_CMD = ("MERGE INTO {table} USING {staging} ON {matches} "
+				 "{update}"
+				 "WHEN NOT MATCHED THEN INSERT ({columns}) VALUES ({values});")
+
+	MERGE_UPDATE = "WHEN MATCHED THEN UPDATE SET {updates} "
+
+	DELETE_WHERE_CMD = "DELETE FROM {table} WHERE {predicate};"
+
+	DELETE_MISSING_CMD = "DELETE FROM {table} WHERE NOT EXISTS (SELECT 1 FROM {staging} WHERE {matches});"
+
+	WATERMARK_TABLE = 'dbio_watermarks'
+
+	CREATE_WATERMARK_TABLE_CMD = ("CREATE TABLE IF NOT EXISTS {watermarks} ("
+								  "target_table varchar(255), source_key varchar(255), "
+								  "mark_column varchar(255), mark varchar(255));")
+
+	SELECT_WATERMARK_CMD = ("SELECT mark_column, mark FROM {watermarks} "
+							"WHERE target_table = :table AND source_key = :key")
+
+	DELETE_WATERMARK_CMD = ("DELETE FROM {watermarks} "
+							"WHERE target_table = :table AND source_key = :key")
+
+	INSERT_WATERMARK_CMD = ("INSERT INTO {watermarks} (target_table, source_key, mark_column, mark) "
+							"VALUES (:table, :key, :column, :mark)")
+
+	COPY_FORMATS = ('csv',)
+
 	def __init__(self, url):
 		""" 
 			:param url: sqlalchemy engine creation url.
@@ -66,8 +212,16 @@ class Importable():
 
 
 	def get_import_engine(self):
-		""" :return: sqlalchemy engine object. """
-		return sqlalchemy.create_engine(self.url)
+		""" :return: sqlalchemy engine object, created on first use. """
+		if getattr(self, 'import_engine', None) is None:
+			self.import_engine = self.create_import_engine()
+		return self.import_engine
+
+
+	def create_import_engine(self):
+		""" :return: sqlalchemy engine object, shared with every database object for the
+				same URL (see :py:mod:`dbio.databases.engines`). """
+		return get_engine(self.url)
 
 
 	def do_rowcount_check(self, table, expected_rowcount):
@@ -89,6 +243,206 @@ class Importable():
 											expected=expected_rowcount, table=table, actual=rowcount))
 
 
+	def check_rowcount(self, table, expected_rowcount, loaded_rowcount, append):
+		""" Checks the number of rows a load brought into table. The count the driver reported
+			for the load is compared when there is one, so that the table is not scanned and
+			appended rows can be checked on their own. When the driver reported nothing,
+			:py:meth:`do_rowcount_check` counts the table instead, which only holds the loaded
+			rows if not appending.
+
+			:param table: The table that was loaded.
+			:param expected_rowcount: Number of rows to expect, None to skip the check, or a
+					function returning either, called once the data has been read.
+			:param loaded_rowcount: Number of rows the driver reported loading, or None.
+			:param append: True if table kept the rows it had before the load.
+					Only used to warn when the table count includes those rows.
+
+			:raises: UnexpectedRowcountError upon row count mismatch
+
+		"""
+		if callable(expected_rowcount):
+			expected_rowcount = expected_rowcount()
+		if expected_rowcount is None:
+			return
+		if loaded_rowcount is None or loaded_rowcount < 0:
+			if append:
+				logger.warning("No row count was reported for the load, counting all of "
+							   "{table} instead of the appended rows.".format(table=table))
+			self.do_rowcount_check(table, expected_rowcount)
+			return
+		logger.info("Rows loaded into {table}: {count}.".format(table=table, count=loaded_rowcount))
+		if loaded_rowcount != expected_rowcount:
+			raise self.UnexpectedRowcountError("Expected {expected} rows in {table}, loaded {actual}.".format(
+											expected=expected_rowcount, table=table, actual=loaded_rowcount))
+
+
+	def create_staging(self, connection, table, staging):
+		""" Database specific creation of staging as an empty copy of table, replacing any
+			table of that name.
+
+			:param connection: sqlalchemy connection to create it on.
+			:param table: The table to copy.
+			:param staging: Name of the new table.
+
+		"""
+		raise NotImplementedError(self.__class__.__name__ + " does not support separate staging.")
+
+
+	def swap_staging(self, connection, table, staging, drop=True):
+		""" Database specific replacement of table by staging, staging then holding the
+			previous contents of table.
+
+			:param connection: sqlalchemy connection to swap them on.
+			:param table: The table to replace.
+			:param staging: The table replacing it.
+			:param drop: If True, staging is dropped after the swap.
+
+		"""
+		raise NotImplementedError(self.__class__.__name__ + " does not support separate staging.")
+
+
+	def delete_where(self, connection, table, predicate):
+		""" Deletes the rows of table matching a predicate in the load transaction, before
+			the new rows are added, so that appending them replaces a range of the table.
+
+			:param connection: sqlalchemy connection of the load transaction.
+			:param table: The table loaded into.
+			:param predicate: SQL condition selecting the rows to delete, or None to do nothing.
+
+		"""
+		if predicate is None:
+			return
+		results = connection.execute(self.DELETE_WHERE_CMD.format(table=table, predicate=predicate))
+		logger.info("Deleted {count} rows of {table} to be replaced.".format(
+					count=results.rowcount, table=table))
+
+
+	def merge_staging(self, connection, table, staging, keys=None, delete_missing=False):
+		""" Merges the rows loaded into staging into table: rows whose keys are in table
+			replace the existing ones, the others are inserted.
+
+			:param connection: sqlalchemy connection of the merge transaction.
+			:param table: The table to merge into.
+			:param staging: The table holding the rows to merge.
+			:param keys: List of the columns identifying a row. Defaults to the primary key
+					of table. Some databases match on the unique keys of table regardless,
+					see :py:meth:`get_merge_cmd`.
+			:param delete_missing: If True, rows of table whose keys are not in staging are
+					deleted, for when staging holds every row rather than a delta.
+
+		"""
+		inspector = sqlalchemy.engine.reflection.Inspector.from_engine(connection)
+		columns = [column['name'] for column in inspector.get_columns(table)]
+		if not keys:
+			keys = inspector.get_pk_constraint(table)['constrained_columns']
+			if not keys:
+				raise ValueError(table + " has no primary key, the merge keys must be given.")
+
+		connection.execute(self.get_merge_cmd(table, staging, columns, keys))
+		if delete_missing:
+			matches = ' AND '.join('{staging}.{key} = {table}.{key}'.format(
+								   staging=staging, table=table, key=key) for key in keys)
+			connection.execute(self.DELETE_MISSING_CMD.format(table=table, staging=staging,
+															  matches=matches))
+		logger.info("Merged {staging} into {table} on {keys}.".format(
+					staging=staging, table=table, keys=', '.join(keys)))
+
+
+	def get_merge_cmd(self, table, staging, columns, keys):
+		""" Database specific statement merging staging into table, standard SQL MERGE by
+			default.
+
+			:param table: The table to merge into.
+			:param staging: The table holding the rows to merge, with the same columns.
+			:param columns: List of the columns of table.
+			:param keys: List of the columns identifying a row.
+
+			:returns: SQL string.
+
+		"""
+		matches = ' AND '.join('{table}.{key} = {staging}.{key}'.format(
+							   table=table, staging=staging, key=key) for key in keys)
+		updates = ', '.join('{column} = {staging}.{column}'.format(column=column, staging=staging)
+							for column in columns if column not in keys)
+		return self.MERGE_CMD.format(table=table, staging=staging, matches=matches,
+									 update=self.MERGE_UPDATE.format(updates=updates) if updates else '',
+									 columns=', '.join(columns),
+									 values=', '.join(staging + '.' + column for column in columns))
+
+
+	def get_watermark(self, table, key):
+		""" Gets the high-water mark of incremental loads into table from a source, creating
+			WATERMARK_TABLE if it does not exist yet. It is created here rather than when the
+			mark is saved, because some databases commit the open transaction on DDL.
+
+			:param table: The table loaded incrementally.
+			:param key: Identifies the source of the rows loaded into table.
+
+			:returns: (mark_column, mark) tuple, mark being a SQL literal, or None if nothing
+					has been loaded from that source yet.
+
+		"""
+		engine = self.get_import_engine()
+		engine.execute(self.CREATE_WATERMARK_TABLE_CMD.format(watermarks=self.WATERMARK_TABLE))
+		results = engine.execute(
+			sqlalchemy.text(self.SELECT_WATERMARK_CMD.format(watermarks=self.WATERMARK_TABLE)),
+			table=table, key=key)
+		row = results.fetchone()
+		results.close()
+		if row is None:
+			return None
+		return tuple(row)
+
+
+	def save_watermark(self, connection, table, watermark):
+		""" Saves the high-water mark of an incremental load on the connection loading it, so
+			that it is committed, or rolled back, along with the rows.
+
+			:param connection: sqlalchemy connection of the load transaction.
+			:param table: The table loaded incrementally.
+			:param watermark: Dictionary with the 'key' of the source, the 'column' of the
+					mark and the 'mark' itself as a SQL literal, or None to do nothing.
+
+		"""
+		if watermark is None:
+			return
+		watermarks = self.WATERMARK_TABLE
+		connection.execute(sqlalchemy.text(self.DELETE_WATERMARK_CMD.format(watermarks=watermarks)),
+						   table=table, key=watermark['key'])
+		connection.execute(sqlalchemy.text(self.INSERT_WATERMARK_CMD.format(watermarks=watermarks)),
+						   table=table, key=watermark['key'], column=watermark['column'],
+						   mark=watermark['mark'])
+		logger.info("Watermark of {table} advanced to {column} = {mark}.".format(
+					table=table, **watermark))
+
+
+	def delete_watermark(self, connection, table, key):
+		""" Forgets the high-water mark of loads into table from a source.
+
+			:param connection: sqlalchemy connection to delete it on.
+			:param table: The table loaded incrementally.
+			:param key: Identifies the source of the rows loaded into table.
+
+		"""
+		connection.execute(
+			sqlalchemy.text(self.DELETE_WATERMARK_CMD.format(watermarks=self.WATERMARK_TABLE)),
+			table=table, key=key)
+
+
+	def raise_if_aborted(self, abort_event):
+		""" Checks whether the writer feeding a load gave up before finishing. Called after
+			the data has been loaded but before the load transaction is committed, so a
+			partial load is rolled back instead of swapped in.
+
+			:param abort_event: threading.Event set by the writer on failure, or None.
+
+			:raises: ImportAbortedError if abort_event is set.
+
+		"""
+		if abort_event is not None and abort_event.is_set():
+			raise self.ImportAbortedError("The data source was abandoned before it was complete.")
+
+
 	def execute_import(self, table, filename, append, csv_params, null_string, 
 						analyze=False, disable_indices=False, create_staging=True,
 						expected_rowcount=None, **kwargs):
@@ -96,6 +450,7 @@ class Importable():
 
 			:param table: destination for the load operation.
 			:param data_source: Either a CSV file to be loaded or an INSERT command.
+					The file may also be given as a file object open for reading.
 			:param csv_params: csv format info of the data_source.
 			:param append: True if the data_source should add to table,
 					False if table should only contain the contents of
@@ -109,10 +464,31 @@ class Importable():
 					If False, there must be an existing table named "table_staging".
 			:param expected_rowcount: The number of rows that are expected to be in the loaded table.
 					If the count does not much, the loading transaction will raise an error and rollback if possible.
-					If the count is set to None, no check will be made. 
+					If the count is set to None, no check will be made. May be a function returning
+					the count, called once the data has been read (see :py:meth:`check_rowcount`).
+			:param abort_event: Optional threading.Event. If it is set by the time the data
+					has been read, the load is rolled back with ImportAbortedError.
+			:param compression: Codec the file is compressed with (see :py:mod:`dbio.compression`).
+					If None, it is inferred from the file extension.
+			:param copy_format: One of COPY_FORMATS. Defaults to 'csv'.
+			:param watermark: Saved with :py:meth:`save_watermark` in the transaction that
+					loads the rows.
+			:param merge: If True, append is ignored and the rows are loaded into
+					"table_staging", then merged into table (see :py:meth:`merge_staging`).
+			:param merge_keys: List of the columns to merge on. Defaults to the primary key.
+			:param delete_missing: If True, a merge deletes the rows of table that are not
+					in the file.
+			:param replace_where: SQL condition. When appending, the rows of table matching
+					it are deleted in the load transaction (see :py:meth:`delete_where`).
+			:param timings: :py:class:`dbio.timing.Timings` recording the phases of the load.
+
+			:returns: The number of rows loaded, or -1 if the driver does not report it.
 
 		"""
 		raise NotImplementedError()
 
 
-	class UnexpectedRowcountError(Exception): pass
\ No newline at end of file
+	class UnexpectedRowcountError(Exception): pass
+
+
+	class ImportAbortedError(Exception): pass
\ No newline at end of file
@@ -0,0 +1,99 @@
+# Python standard library
+import threading
+
+""" Process-wide registry of SQLAlchemy engines, keyed by URL and engine options, so that
+	every database object for the same URL shares one engine and one connection pool. A
+	query, a load and its row count check then reuse pooled connections instead of each
+	connecting again, as do repeated calls to dbio.load and the jobs of a manifest. """
+
+# Options of :py:func:`configure_engines`, passed on to sqlalchemy.create_engine().
+POOL_OPTIONS = ('pool_size', 'max_overflow', 'pool_timeout', 'pool_recycle', 'pool_pre_ping')
+
+# Only accepted by pools that keep a fixed number of connections, i.e. not by SQLite's.
+QUEUE_POOL_OPTIONS = ('pool_size', 'max_overflow', 'pool_timeout')
+
+__engines = {}
+__pool_options = {}
+__lock = threading.Lock()
+
+
+def configure_engines(**options):
+	""" Sets the pool options of engines created from now on. Engines already created keep
+		theirs, and are only replaced for lookups with the new options.
+
+		:param pool_size: Number of connections kept open per engine. SQLAlchemy's default
+					is 5.
+		:param max_overflow: Number of connections opened past pool_size when all of them
+					are in use, and closed once returned. SQLAlchemy's default is 10.
+		:param pool_timeout: Seconds to wait for a connection when the pool is exhausted.
+		:param pool_recycle: Seconds after which a pooled connection is reopened, for
+					databases that close idle connections.
+		:param pool_pre_ping: If True, pooled connections are tested before use and
+					reopened if they were dropped.
+
+		An option set to None goes back to SQLAlchemy's default.
+
+	"""
+	unknown = set(options) - set(POOL_OPTIONS)
+	if unknown:
+		raise ValueError("Unknown engine options: " + ', '.join(sorted(unknown)))
+	with __lock:
+		for name, value in options.items():
+			if value is None:
+				__pool_options.pop(name, None)
+			else:
+				__pool_options[name] = value
+
+
+def get_engine(url, connect_args=None, listeners=()):
+	""" :param url: SQLAlchemy engine creation URL.
+		:param connect_args: Dictionary of arguments for the DB API connect() function.
+		:param listeners: Functions called on each new DB API connection, as for
+					the 'connect' pool event. They are part of the key, so must be the
+					same function objects each time, e.g. static methods.
+
+		:returns: The shared engine for url with these arguments and the current pool
+				options, created on first use.
+
+	"""
+	with __lock:
+		pool_options = dict(__pool_options)
+		key = (str(url), __freeze(connect_args or {}), tuple(listeners), __freeze(pool_options))
+		engine = __engines.get(key)
+		if engine is None:
+			engine = __create_engine(url, connect_args, listeners, pool_options)
+			__engines[key] = engine
+	return engine
+
+
+def dispose_engines():
+	""" Closes the pooled connections of every engine and empties the registry, e.g. in a
+		child process after a fork. """
+	with __lock:
+		engines = __engines.values()
+		__engines.clear()
+	for engine in engines:
+		engine.dispose()
+
+
+def __create_engine(url, connect_args, listeners, pool_options):
+	# Imported on first use, so that importing dbio or configuring engines does not.
+	import sqlalchemy
+	import sqlalchemy.engine.url
+	import sqlalchemy.pool
+	parsed_url = sqlalchemy.engine.url.make_url(url)
+	pool_class = parsed_url.get_dialect().get_pool_class(parsed_url)
+	if not issubclass(pool_class, sqlalchemy.pool.QueuePool):
+		pool_options = dict((name, value) for name, value in pool_options.items()
+							if name not in QUEUE_POOL_OPTIONS)
+	kwargs = dict(pool_options)
+	if connect_args:
+		kwargs['connect_args'] = connect_args
+	engine = sqlalchemy.create_engine(url, **kwargs)
+	for listener in listeners:
+		sqlalchemy.event.listen(engine, 'connect', listener)
+	return engine
+
+
+def __freeze(options):
+	return tuple(sorted(options.items()))
@@ -1,10 +1,12 @@
 # PyPI packages
 import MySQLdb.cursors
-import sqlalchemy
 import unicodecsv
 
 # Local modules
 from base import Exportable, Importable
+from engines import get_engine
+from dbio.compression import decompressed_path
+from dbio.timing import phase
 
 
 class MySQL(Exportable, Importable):
@@ -20,6 +22,9 @@ class MySQL(Exportable, Importable):
 	# Fail on warnings, e.g. truncated rows or invalid datatypes.
 	SET_SQL_MODE = "SET SESSION sql_mode='STRICT_ALL_TABLES';"
 
+	BEGIN_SNAPSHOT_CMDS = ("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ",
+						   "START TRANSACTION WITH CONSISTENT SNAPSHOT")
+
 	CREATE_STAGING_CMD = "CREATE TABLE {staging} LIKE {table};"
 
 	DISABLE_KEYS = "ALTER TABLE {table} DISABLE KEYS;"
@@ -43,6 +48,9 @@ class MySQL(Exportable, Importable):
 
 	TRUNCATE_CMD = "TRUNCATE TABLE {staging};"
 
+	MERGE_CMD = ("INSERT INTO {table} ({columns}) SELECT {columns} FROM {staging} "
+				 "ON DUPLICATE KEY UPDATE {updates};")
+
 	DEFAULT_CSV_PARAMS = {
 						'delimiter' : ',', 
 						'escapechar' : '\\',
@@ -54,67 +62,123 @@ class MySQL(Exportable, Importable):
 
 	DEFAULT_NULL_STRING = '\\N'
 
+	CHECKSUM_COLUMN = "COALESCE(CAST({column} AS CHAR), 'NULL')"
+
+	ROW_HASH = "CAST(CONV(SUBSTRING(MD5({row}), 1, 8), 16, 10) AS UNSIGNED)"
+
 	def __init__(self, url):
 		self.url = url
 		
 
-	def get_export_engine(self):
+	def create_export_engine(self):
 		# SSCursor keeps the results on the server until a row is explicitly fetched
 		# by the client's cursor.
-		return sqlalchemy.create_engine(self.url, 
-				connect_args={'cursorclass' : MySQLdb.cursors.SSCursor})
+		return get_engine(self.url, connect_args={'cursorclass' : MySQLdb.cursors.SSCursor})
 
 
-	def get_import_engine(self):
+	def create_import_engine(self):
 		# LOAD DATA LOCAL INFILE fails without the local_infile=1 arg.
-		return sqlalchemy.create_engine(self.url, connect_args={'local_infile' : 1})
+		return get_engine(self.url, connect_args={'local_infile' : 1})
+
+
+	def get_checksum_row(self, columns):
+		# || is OR in MySQL.
+		return "CONCAT_WS('|', {columns})".format(columns=', '.join(
+			self.CHECKSUM_COLUMN.format(column=column) for column in columns))
+
+
+	def get_merge_cmd(self, table, staging, columns, keys):
+		""" INSERT ... ON DUPLICATE KEY UPDATE, which matches rows on every unique key of table
+			rather than on keys. """
+		updates = [column for column in columns if column not in keys] or keys
+		return self.MERGE_CMD.format(table=table, staging=staging, columns=', '.join(columns),
+									 updates=', '.join('{0} = VALUES({0})'.format(column)
+													   for column in updates))
+
+
+	def create_staging(self, connection, table, staging):
+		# Pre drop table in case it already exists
+		connection.execute(self.DROP_CMD.format(staging=staging))
+		connection.execute(
+			self.CREATE_STAGING_CMD.format(staging=staging, table=table))
+
+
+	def swap_staging(self, connection, table, staging, drop=True):
+		connection.execute(
+			self.SWAP_CMD.format(table=table, staging=staging, temp=table + '_temp'))
+		if drop:
+			connection.execute(self.DROP_CMD.format(staging=staging))
 
 
 	def execute_import(self, table, filename, append, csv_params, null_string, 
 						analyze=False, disable_indices=False, create_staging=True,
 						expected_rowcount=None, **kwargs):
 		staging = table + '_staging'
-		temp = table + '_temp'
+		merge = kwargs.get('merge')
+		if merge:
+			# Rows to merge are loaded into staging, like those replacing the table.
+			append = False
 		if append:
 			load_table = table
 		else:
 			load_table = staging
 
 		eng = self.get_import_engine()
+		timings = kwargs.get('timings')
+
+		with phase(timings, 'connect'):
+			connection = eng.connect()
 		
 		# Start transaction
-		with eng.begin() as connection, connection.begin() as tran:
+		with connection, connection.begin() as tran:
 			connection.execute(self.SET_NET_READ_TIMEOUT)
 			connection.execute(self.SET_TRANS_ISO_LVL)
 			connection.execute(self.SET_SQL_MODE)
 
 			if not append:
-				if create_staging:
-					# Pre drop table in case it already exists
-					connection.execute(self.DROP_CMD.format(staging=staging))
-					connection.execute(
-						self.CREATE_STAGING_CMD.format(staging=staging, table=table))
-				else:
-					connection.execute(self.TRUNCATE_CMD.format(staging=staging))
+				with phase(timings, 'staging'):
+					if create_staging:
+						self.create_staging(connection, table, staging)
+					else:
+						connection.execute(self.TRUNCATE_CMD.format(staging=staging))
 
 			if disable_indices:
-				connection.execute(self.DISABLE_KEYS.format(table=load_table))
-
-			connection.execute(
-					self.LOAD_CMD.format(table=load_table, filename=filename, **csv_params))
+				with phase(timings, 'disable_indices'):
+					connection.execute(self.DISABLE_KEYS.format(table=load_table))
+
+			self.delete_where(connection, load_table, kwargs.get('replace_where'))
+
+			# LOAD DATA needs a file name, so compressed files are decompressed through a FIFO.
+			with phase(timings, 'transfer'), \
+					decompressed_path(filename, kwargs.get('compression')) as load_path:
+				loaded_rowcount = connection.execute(
+						self.LOAD_CMD.format(table=load_table, filename=load_path, **csv_params)).rowcount
+			self.raise_if_aborted(kwargs.get('abort_event'))
+			if not merge:
+				self.save_watermark(connection, table, kwargs.get('watermark'))
 			
 		with eng.begin() as connection:
-			if expected_rowcount is not None:
-				self.do_rowcount_check(load_table, expected_rowcount)
+			with phase(timings, 'rowcount_check'):
+				self.check_rowcount(load_table, expected_rowcount, loaded_rowcount, append)
 
 			if disable_indices:
-				connection.execute(self.ENABLE_KEYS.format(table=load_table))
+				with phase(timings, 'index_rebuild'):
+					connection.execute(self.ENABLE_KEYS.format(table=load_table))
 
-			if analyze:
-				connection.execute(self.ANALYZE_CMD.format(table=load_table))
+			if merge:
+				with phase(timings, 'merge'):
+					self.merge_staging(connection, table, staging, kwargs.get('merge_keys'),
+									   kwargs.get('delete_missing'))
+				self.save_watermark(connection, table, kwargs.get('watermark'))
 
-			if not append:
-				connection.execute(
-					self.SWAP_CMD.format(table=table, staging=staging, temp=temp))
-				if create_staging:
-					connection.execute(self.DROP_CMD.format(staging=staging))					
\ No newline at end of file
+			if analyze:
+				with phase(timings, 'analyze'):
+					connection.execute(self.ANALYZE_CMD.format(table=table if merge else load_table))
+
+			if not merge and not append:
+				with phase(timings, 'swap'):
+					self.swap_staging(connection, table, staging, drop=False)
+			if not append and create_staging:
+				with phase(timings, 'drop'):
+					connection.execute(self.DROP_CMD.format(staging=staging))
+		return loaded_rowcount
\ No newline at end of file
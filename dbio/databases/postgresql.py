@@ -1,8 +1,13 @@
+# Python standard library
+import re
+
 # PyPI packages
 import unicodecsv
 
 # Local modules
 from base import Exportable, Importable
+from dbio.compression import open_file
+from dbio.timing import phase
 
 
 class PostgreSQL(Exportable, Importable):
@@ -13,6 +18,40 @@ class PostgreSQL(Exportable, Importable):
                 "NULL '{null_string}' "
                 "ESCAPE '{escapechar}';")
 
+    # For the dialect dbio writes by default: unquoted, with backslash escapes. In CSV mode
+    # ESCAPE only applies inside quotes, so an escaped delimiter would split the field.
+    COPY_TEXT_CMD = ("COPY {table} FROM STDIN WITH (FORMAT text, "
+                     "DELIMITER '{delimiter}', NULL '{null_string}');")
+
+    COPY_BINARY_CMD = "COPY {table} FROM STDIN WITH (FORMAT binary);"
+
+    EXPORT_CMD = "COPY ({query}) TO STDOUT WITH ({options});"
+
+    SELECT_NONE_CMD = "SELECT * FROM ({query}) AS query_columns LIMIT 0;"
+
+    SELECT_COLUMNS_CMD = "SELECT {columns} FROM ({query}) AS query_columns"
+
+    # Booleans as str() writes them, rather than t and f.
+    BOOL_TEXT = "CASE WHEN {column} THEN 'True' WHEN NOT {column} THEN 'False' END AS {column}"
+
+    BOOL_OID = 16
+
+    SELECT_COLUMN_TYPES_CMD = ("SELECT t.typname FROM pg_catalog.pg_attribute a "
+                               "JOIN pg_catalog.pg_type t ON t.oid = a.atttypid "
+                               "WHERE a.attrelid = '{table}'::regclass "
+                               "AND a.attnum > 0 AND NOT a.attisdropped "
+                               "ORDER BY a.attnum;")
+
+    COPY_FORMATS = ('csv', 'binary')
+
+    LOADS_NATIVE_EXPORT = True
+
+    EXPORT_SNAPSHOT_CMD = "SELECT pg_export_snapshot();"
+
+    IMPORT_SNAPSHOT_CMD = "SET TRANSACTION SNAPSHOT '{snapshot}';"
+
+    ROW_HASH = "('x' || SUBSTR(MD5({row}), 1, 8))::bit(32)::bigint"
+
     SELECT_INDICES_CMD = ("SELECT indexname, indexdef FROM pg_catalog.pg_indexes "
                             "WHERE tablename='{table}';")
 
@@ -30,6 +69,9 @@ class PostgreSQL(Exportable, Importable):
 
     TRUNCATE_CMD = "TRUNCATE TABLE {staging};"
 
+    MERGE_CMD = ("INSERT INTO {table} ({columns}) SELECT {columns} FROM {staging} "
+                 "ON CONFLICT ({keys}) DO {action};")
+
     GET_GRANTS_CMD = (
         "SELECT 'GRANT ' || string_agg(privilege_type, ',') || ' ON {staging} TO ' || grantee "
         "FROM information_schema.role_table_grants "
@@ -51,71 +93,272 @@ class PostgreSQL(Exportable, Importable):
         Exportable.__init__(self, url)
         Importable.__init__(self, url)
 
+    def get_column_type_oids(self, query):
+        """ :returns: List of the type OIDs of the columns returned by the query. """
+        connection = self.get_export_engine().raw_connection()
+        try:
+            raw_cursor = connection.cursor()
+            raw_cursor.execute(self.SELECT_NONE_CMD.format(query=query))
+            type_oids = [column[1] for column in raw_cursor.description]
+            raw_cursor.close()
+        finally:
+            connection.close()
+        return type_oids
+
+    def get_table_column_types(self, table):
+        """ :returns: List of the type names of the columns of table, e.g. ['int4', 'text']. """
+        results = self.get_import_engine().execute(self.SELECT_COLUMN_TYPES_CMD.format(table=table))
+        column_types = [row[0] for row in results.fetchall()]
+        results.close()
+        return column_types
+
+    def begin_snapshot(self, connection, snapshot=None):
+        """ REPEATABLE READ, importing snapshot if given, as pg_dump -j does. """
+        Exportable.begin_snapshot(self, connection)
+        if snapshot is not None:
+            connection.execute(self.IMPORT_SNAPSHOT_CMD.format(snapshot=snapshot))
+
+    def export_snapshot(self, connection):
+        return connection.execute(self.EXPORT_SNAPSHOT_CMD).scalar()
+
+    def execute_export(self, query, f, csv_params, null_string, copy_format='csv',
+                       connection=None):
+        """ Writes the query results with COPY TO STDOUT. In CSV format, COPY's text format is
+            converted to the dialect dbio writes, so only csv_params without quoting and with
+            a backslash escapechar and '\\n' line terminators are supported. Booleans are
+            written as True and False, but other values are formatted by Postgres, e.g.
+            timestamps with a time zone or fractional seconds, so may still differ from
+            :py:func:`dbio.query` without native_export.
+
+            In binary format, csv_params and null_string are ignored, and the output can only
+            be loaded into columns of exactly the same types.
+
+            :raises ValueError: csv_params that COPY cannot write.
+
+        """
+        if copy_format == 'binary':
+            options = ["FORMAT binary"]
+        else:
+            options = self.__text_export_options(csv_params, null_string)
+
+        if connection is not None:
+            raw_connection = connection.connection
+        else:
+            raw_connection = self.get_export_engine().raw_connection()
+        try:
+            raw_cursor = raw_connection.cursor()
+            writer = f
+            if copy_format != 'binary':
+                query = self.__text_export_query(raw_cursor, query)
+                writer = TextCopyWriter(f, csv_params)
+            raw_cursor.copy_expert(
+                self.EXPORT_CMD.format(query=query, options=', '.join(options)), writer)
+            if writer is not f:
+                writer.finish()
+            rowcount = raw_cursor.rowcount
+            raw_cursor.close()
+        finally:
+            if connection is None:
+                raw_connection.close()
+        return rowcount
+
+    def __text_export_options(self, csv_params, null_string):
+        if not self.__is_text_dialect(csv_params):
+            raise ValueError("Native export only writes unquoted fields with a backslash "
+                             "escapechar.")
+        if csv_params.get('lineterminator', '\r\n') != '\n':
+            raise ValueError("COPY only writes '\\n' line terminators.")
+
+        return ["FORMAT text",
+                "DELIMITER '{0}'".format(csv_params.get('delimiter', ',')),
+                "NULL '{0}'".format(null_string),
+                "ENCODING '{0}'".format(csv_params.get('encoding', 'utf-8'))]
+
+    def __text_export_query(self, raw_cursor, query):
+        """ :returns: query with its boolean columns converted to 'True' and 'False'. """
+        raw_cursor.execute(self.SELECT_NONE_CMD.format(query=query))
+        columns = [(column[0], column[1]) for column in raw_cursor.description]
+        if not any(type_oid == self.BOOL_OID for _, type_oid in columns):
+            return query
+        selects = []
+        for name, type_oid in columns:
+            column = '"' + name.replace('"', '""') + '"'
+            if type_oid == self.BOOL_OID:
+                column = self.BOOL_TEXT.format(column=column)
+            selects.append(column)
+        return self.SELECT_COLUMNS_CMD.format(columns=', '.join(selects), query=query)
+
+    def __is_text_dialect(self, csv_params):
+        return (csv_params.get('quoting') == unicodecsv.QUOTE_NONE and
+                csv_params.get('escapechar') == '\\')
+
+    def get_merge_cmd(self, table, staging, columns, keys):
+        """ INSERT ... ON CONFLICT, which needs a unique index on the keys. """
+        updates = ['{0} = EXCLUDED.{0}'.format(column) for column in columns if column not in keys]
+        if updates:
+            action = "UPDATE SET " + ', '.join(updates)
+        else:
+            action = "NOTHING"
+        return self.MERGE_CMD.format(table=table, staging=staging, columns=', '.join(columns),
+                                     keys=', '.join(keys), action=action)
+
+    def create_staging(self, connection, table, staging, timings=None):
+        """ Also copies the grants of table, timed as a 'grants' phase of timings. """
+        # Pre drop table in case it already exists
+        connection.execute(self.DROP_CMD.format(staging=staging))
+        connection.execute(
+            self.CREATE_STAGING_CMD.format(staging=staging, table=table))
+        with phase(timings, 'grants'):
+            # get list of existing grants for existing table
+            permission_cmds = connection.execute(
+                self.GET_GRANTS_CMD.format(table=table, staging=staging)
+            ).fetchall()
+            # create equal set of grants for the new staging table
+            for cmd, in permission_cmds:
+                connection.execute(cmd)
+
+    def swap_staging(self, connection, table, staging, drop=True):
+        connection.execute(
+            self.SWAP_CMD.format(table=table, staging=staging, temp=table + '_temp'))
+        if drop:
+            connection.execute(self.DROP_CMD.format(staging=staging))
+
     def execute_import(self, table, filename, append, csv_params, null_string,
                        analyze=False, disable_indices=False, create_staging=True,
                        expected_rowcount=None, **kwargs):
         staging = table + '_staging'
-        temp = table + '_temp'
+        merge = kwargs.get('merge')
+        if merge:
+            # Rows to merge are loaded into staging, like those replacing the table.
+            append = False
         if append:
             copy_table = table
         else:
             copy_table = staging
 
         eng = self.get_import_engine()
+        timings = kwargs.get('timings')
+
+        with phase(timings, 'connect'):
+            connection = eng.connect()
 
         # Start transaction
-        with eng.begin() as connection, connection.begin() as tran:
+        with connection, connection.begin() as tran:
             if not append:
-                if create_staging:
-                    # Pre drop table in case it already exists
-                    connection.execute(self.DROP_CMD.format(staging=staging))
-                    connection.execute(
-                        self.CREATE_STAGING_CMD.format(staging=staging, table=table))
-                    # get list of existing grants for existing table
-                    permission_cmds = connection.execute(
-                        self.GET_GRANTS_CMD.format(table=table, staging=staging)
-                    ).fetchall()
-                    # create equal set of grants for the new staging table
-                    for cmd, in permission_cmds:
-                        connection.execute(cmd)
-                else:
-                    connection.execute(self.TRUNCATE_CMD.format(staging=staging))
+                with phase(timings, 'staging'):
+                    if create_staging:
+                        self.create_staging(connection, table, staging, timings)
+                    else:
+                        connection.execute(self.TRUNCATE_CMD.format(staging=staging))
 
             if disable_indices:
-                # fetch index information from pg_catalog
-                results = connection.execute(self.SELECT_INDICES_CMD.format(table=copy_table))
-                index_names = []
-                index_creates = []
-                for row in results:
-                    index_names.append(row[0])
-                    index_creates.append(row[1])
-                results.close()
-
-                # drop the entire list of indices in a single DROP INDEX, if any exist
-                if index_names:
-                    connection.execute(self.DROP_INDICES_CMD.format(indices=','.join(index_names)))
+                with phase(timings, 'disable_indices'):
+                    # fetch index information from pg_catalog
+                    results = connection.execute(self.SELECT_INDICES_CMD.format(table=copy_table))
+                    index_names = []
+                    index_creates = []
+                    for row in results:
+                        index_names.append(row[0])
+                        index_creates.append(row[1])
+                    results.close()
+
+                    # drop the entire list of indices in a single DROP INDEX, if any exist
+                    if index_names:
+                        connection.execute(self.DROP_INDICES_CMD.format(indices=','.join(index_names)))
+
+            self.delete_where(connection, copy_table, kwargs.get('replace_where'))
 
             # get psycopg2 cursor object to access copy_expert()
             raw_cursor = connection.connection.cursor()
-            with open(filename, 'r') as f:
-                raw_cursor.copy_expert(
-                    self.COPY_CMD.format(table=copy_table, null_string=null_string,
-                                         **csv_params), f)
+            if kwargs.get('copy_format') == 'binary':
+                copy_cmd = self.COPY_BINARY_CMD.format(table=copy_table)
+            elif self.__is_text_dialect(csv_params):
+                copy_cmd = self.COPY_TEXT_CMD.format(table=copy_table, null_string=null_string,
+                                                     **csv_params)
+            else:
+                copy_cmd = self.COPY_CMD.format(table=copy_table, null_string=null_string,
+                                                **csv_params)
+            with phase(timings, 'transfer'), open_file(filename, 'rb', kwargs.get('compression')) as f:
+                raw_cursor.copy_expert(copy_cmd, f)
+                loaded_rowcount = raw_cursor.rowcount
                 raw_cursor.close()
+            self.raise_if_aborted(kwargs.get('abort_event'))
+            if not merge:
+                self.save_watermark(connection, table, kwargs.get('watermark'))
         with eng.begin() as connection:
-            if expected_rowcount is not None:
-                self.do_rowcount_check(copy_table, expected_rowcount)
+            with phase(timings, 'rowcount_check'):
+                self.check_rowcount(copy_table, expected_rowcount, loaded_rowcount, append)
 
             if disable_indices:
-                # create indices from 'indexdef'
-                for index_create_cmd in index_creates:
-                    connection.execute(index_create_cmd)
+                with phase(timings, 'index_rebuild'):
+                    # create indices from 'indexdef'
+                    for index_create_cmd in index_creates:
+                        connection.execute(index_create_cmd)
+
+            if merge:
+                with phase(timings, 'merge'):
+                    self.merge_staging(connection, table, staging, kwargs.get('merge_keys'),
+                                       kwargs.get('delete_missing'))
+                self.save_watermark(connection, table, kwargs.get('watermark'))
 
             if analyze:
-                connection.execute(self.ANALYZE_CMD.format(table=copy_table))
+                with phase(timings, 'analyze'):
+                    connection.execute(self.ANALYZE_CMD.format(table=table if merge else copy_table))
 
-            if not append:
-                connection.execute(
-                    self.SWAP_CMD.format(table=table, staging=staging, temp=temp))
-                if create_staging:
-                    connection.execute(self.DROP_CMD.format(staging=staging))
\ No newline at end of file
+            if not merge and not append:
+                with phase(timings, 'swap'):
+                    self.swap_staging(connection, table, staging, drop=False)
+            if not append and create_staging:
+                with phase(timings, 'drop'):
+                    connection.execute(self.DROP_CMD.format(staging=staging))
+        return loaded_rowcount
+
+class TextCopyWriter(object):
+    """ Writes the output of COPY TO STDOUT in text format to a file in the dialect that
+        :py:class:`dbio.encoder.BatchEncoder` writes for unquoted csv_params with a backslash
+        escapechar. COPY escapes backslashes and the delimiter the same way, but writes the
+        quote character as is and control characters as a backslash and a letter, e.g. \\n. """
+
+    # Control characters COPY writes as a backslash and a letter.
+    UNESCAPES = {'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t', 'v': '\v'}
+
+    def __init__(self, f, csv_params):
+        self.f = f
+        self.quotechar = csv_params.get('quotechar', '"')
+        # The characters the encoder escapes.
+        self.specials = set(csv_params.get('lineterminator', '\r\n'))
+        for char in (csv_params.get('delimiter', ','), '\\', self.quotechar):
+            if char:
+                self.specials.add(char)
+        pattern = r'\\(.)'
+        if self.quotechar:
+            pattern += '|' + re.escape(self.quotechar)
+        self.escape_re = re.compile(pattern, re.DOTALL)
+        self.pending = ''
+
+    def write(self, data):
+        data = self.pending + data
+        self.pending = ''
+        # psycopg2 writes whole rows, but an escape split between two writes is still kept
+        # whole for the next one.
+        if (len(data) - len(data.rstrip('\\'))) % 2:
+            data, self.pending = data[:-1], data[-1]
+        if '\\' in data or (self.quotechar and self.quotechar in data):
+            data = self.escape_re.sub(self.__convert, data)
+        self.f.write(data)
+
+    def finish(self):
+        """ Writes what is left of the data, once COPY is done. """
+        if self.pending:
+            self.f.write(self.pending)
+            self.pending = ''
+
+    def __convert(self, match):
+        char = match.group(1)
+        if char is None:
+            # The quote character, which COPY does not escape.
+            return '\\' + match.group(0)
+        char = self.UNESCAPES.get(char, char)
+        if char in self.specials:
+            return '\\' + char
+        return char
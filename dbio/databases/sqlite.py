@@ -1,8 +1,17 @@
+# Python standard library
+import codecs
+import csv
+import hashlib
+import itertools
+
 # PyPI packages
 import unicodecsv
 
 # Local modules
 from base import Exportable, Importable
+from engines import get_engine
+from dbio.compression import open_file
+from dbio.timing import phase
 
 
 class SQLite(Exportable, Importable):
@@ -15,7 +24,11 @@ class SQLite(Exportable, Importable):
 
 	DROP_INDEX_CMD = "DROP INDEX {index};"
 
-	INSERT_CMD = "INSERT INTO {table} VALUES {values};";
+	INSERT_CMD = "INSERT INTO {table} VALUES ({placeholders});"
+
+	PRAGMA_CMD = "PRAGMA {name} = {value};"
+
+	SELECT_PRAGMA_CMD = "PRAGMA {name};"
 
 	ANALYZE_CMD = "ANALYZE {table};"
 
@@ -23,85 +36,206 @@ class SQLite(Exportable, Importable):
 						 "ALTER TABLE {staging} RENAME TO {table};",
 						 "ALTER TABLE {temp} RENAME TO {staging};"]
 	
-	DROP_CMD = "DROP TABLE {staging};"
+	DROP_CMD = "DROP TABLE IF EXISTS {staging};"
+
+	TRUNCATE_CMD = "DELETE FROM {staging};"
+
+	CHECKSUM_COLUMN = "COALESCE(CAST({column} AS TEXT), 'NULL')"
+
+	# SQLite has no hash function, dbio_md5_32 is registered by create_export_engine.
+	ROW_HASH = "dbio_md5_32({row})"
 
-	TRUNCATE_CMD = "TRUNCATE TABLE {staging};"
+	# The sqlite3 module only begins transactions before writes. Reads in one are consistent.
+	BEGIN_SNAPSHOT_CMDS = ("BEGIN",)
 
-	INSERT_BATCH = 100
+	MERGE_CMD = "INSERT OR REPLACE INTO {table} ({columns}) SELECT {columns} FROM {staging};"
+
+	# Trade durability for speed while loading. A crash during the load can corrupt the
+	# database. cache_size is in KiB when negative.
+	BULK_PRAGMAS = {
+		'synchronous' : 'OFF',
+		'journal_mode' : 'MEMORY',
+		'cache_size' : -256 * 1024
+	}
 
 	def __init__(self, url):
 		Exportable.__init__(self, url)
 		Importable.__init__(self, url)
 
 
+	def create_export_engine(self):
+		return get_engine(self.url, listeners=[self.__register_functions])
+
+
+	def create_staging(self, connection, table, staging):
+		# Pre drop table in case it already exists
+		connection.execute(self.DROP_CMD.format(staging=staging))
+		results = connection.execute(self.SELECT_CREATE_CMD.format(table=table))
+		create_cmd = results.fetchone()[0]
+		results.close()
+		# Only the name, which comes first, and not e.g. column types containing it.
+		connection.execute(create_cmd.replace(table, staging, 1))
+
+
+	def swap_staging(self, connection, table, staging, drop=True):
+		for cmd in self.SWAP_CMDS:
+			connection.execute(cmd.format(table=table, staging=staging, temp=table + '_temp'))
+
+		if drop:
+			connection.execute(self.DROP_CMD.format(staging=staging))
+
+
 	def execute_import(self, table, filename, append, csv_params, null_string, 
 						analyze=False, disable_indices=False, create_staging=True,
 						expected_rowcount=None, **kwargs):
+		""" Inserts the rows of the file with executemany() on a single prepared INSERT, in
+			the load transaction.
+
+			:param bulk_pragmas: If True, BULK_PRAGMAS are set for the duration of the load.
+					A dictionary of PRAGMA names and values is set instead, if given.
+
+		"""
+		pragmas = kwargs.get('bulk_pragmas')
+		if pragmas is True:
+			pragmas = self.BULK_PRAGMAS
+
+		# Pragmas only last as long as the connection, so both transactions share one.
+		with phase(kwargs.get('timings'), 'connect'):
+			connection = self.get_import_engine().connect()
+		try:
+			previous_pragmas = self.__set_pragmas(connection, pragmas or {})
+			try:
+				return self.__load(connection, table, filename, append, csv_params, null_string,
+							analyze, disable_indices, create_staging, expected_rowcount, **kwargs)
+			finally:
+				self.__set_pragmas(connection, previous_pragmas)
+		finally:
+			connection.close()
+
+
+	def get_merge_cmd(self, table, staging, columns, keys):
+		""" INSERT OR REPLACE, which matches rows on every unique constraint of table rather
+			than on keys. """
+		return self.MERGE_CMD.format(table=table, staging=staging, columns=', '.join(columns))
+
+
+	@staticmethod
+	def __register_functions(dbapi_connection, connection_record):
+		dbapi_connection.create_function('dbio_md5_32', 1,
+			lambda text: int(hashlib.md5(text.encode('utf-8')).hexdigest()[:8], 16))
+
+
+	def __get_reader(self, f, csv_params):
+		# SQLite stores text as UTF-8, which the sqlite3 module binds byte strings as. A UTF-8
+		# file can then be read by the csv module without decoding every field.
+		if codecs.lookup(csv_params.get('encoding', 'utf-8')).name == 'utf-8':
+			return csv.reader(f, **dict((key, value) for key, value in csv_params.items()
+										if key not in ('encoding', 'errors')))
+		return unicodecsv.reader(f, **csv_params)
+
+
+	def __set_pragmas(self, connection, pragmas):
+		""" :returns: The previous values of the pragmas. """
+		previous = {}
+		for name, value in pragmas.items():
+			results = connection.execute(self.SELECT_PRAGMA_CMD.format(name=name))
+			previous[name] = results.fetchone()[0]
+			results.close()
+			connection.execute(self.PRAGMA_CMD.format(name=name, value=value))
+		return previous
+
+
+	def __load(self, connection, table, filename, append, csv_params, null_string, analyze,
+			   disable_indices, create_staging, expected_rowcount, **kwargs):
 		staging = table + '_staging'
-		temp = table + '_temp'
+		merge = kwargs.get('merge')
+		if merge:
+			# Rows to merge are loaded into staging, like those replacing the table.
+			append = False
 		if append:
 			insert_table = table
 		else:
 			insert_table = staging
 
-		eng = self.get_import_engine()
-		
+		timings = kwargs.get('timings')
+
 		# Start transaction
-		with eng.begin() as connection:
+		with connection.begin():
 			if not append:
-				if create_staging:
-					results = connection.execute(self.SELECT_CREATE_CMD.format(table=table))
-					create_cmd = results.fetchone()[0]
-					results.close()
-					connection.execute(create_cmd.replace(table, staging))
-				else:
-					connection.execute(self.TRUNCATE_CMD.format(staging=staging))
+				with phase(timings, 'staging'):
+					if create_staging:
+						self.create_staging(connection, table, staging)
+					else:
+						connection.execute(self.TRUNCATE_CMD.format(staging=staging))
 				
 
 			if disable_indices:
-				# fetch index information from sqlite_master
-				results = connection.execute(self.SELECT_INDICES_CMD.format(table=copy_table))
-				index_names = []
-				index_creates = []
-				for row in results:
-					index_names.append(row[0])
-					index_creates.append(row[1])
-				results.close()
-
-				for index in index_names:
-					connection.execute(self.DROP_INDEX_CMD.format(index=index))
-
-			with open(filename, 'rb') as f:
-				reader = unicodecsv.reader(f, **csv_params)
-				rows_read = 0
-				values = []
-				for row in reader:
-					rows_read += 1
-					nulled_row = ['NULL' if field == null_string else field for field in row]
-					values.append('(\'' + '\',\''.join(nulled_row) + '\')')
-					if (rows_read % self.INSERT_BATCH) == 0:
-						connection.execute(self.INSERT_CMD.format(
-											table=insert_table, values=','.join(values)))
-						values = []
-				if values:
-					connection.execute(self.INSERT_CMD.format(
-											table=insert_table, values=','.join(values)))
+				with phase(timings, 'disable_indices'):
+					# fetch index information from sqlite_master
+					results = connection.execute(self.SELECT_INDICES_CMD.format(table=insert_table))
+					index_names = []
+					index_creates = []
+					for row in results:
+						index_names.append(row[0])
+						index_creates.append(row[1])
+					results.close()
+
+					for index in index_names:
+						connection.execute(self.DROP_INDEX_CMD.format(index=index))
+
+			self.delete_where(connection, insert_table, kwargs.get('replace_where'))
+
+			with phase(timings, 'transfer'), open_file(filename, 'rb', kwargs.get('compression')) as f:
+				reader = self.__get_reader(f, csv_params)
+				first_row = next(reader, None)
+				loaded_rowcount = 0
+				if first_row is not None:
+					# null_string is turned into NULL by SQLite, so that rows go straight
+					# from the csv reader to the sqlite3 cursor without Python code per row.
+					placeholder = "NULLIF(?, '{null_string}')".format(
+									null_string=null_string.replace("'", "''"))
+					insert_cmd = self.INSERT_CMD.format(table=insert_table,
+									placeholders=','.join([placeholder] * len(first_row)))
+					raw_connection = connection.connection.connection
+					text_factory = raw_connection.text_factory
+					# sqlite3 only binds non-ASCII byte strings with a text_factory other
+					# than unicode. The factory applies to reading, so it is put back after.
+					raw_connection.text_factory = str
+					try:
+						raw_cursor = raw_connection.cursor()
+						raw_cursor.executemany(insert_cmd, itertools.chain([first_row], reader))
+						loaded_rowcount = raw_cursor.rowcount
+						raw_cursor.close()
+					finally:
+						raw_connection.text_factory = text_factory
+			self.raise_if_aborted(kwargs.get('abort_event'))
+			if not merge:
+				self.save_watermark(connection, table, kwargs.get('watermark'))
 					
-		with eng.begin() as connection:
-			if expected_rowcount is not None:
-				self.do_rowcount_check(insert_table, expected_rowcount)
+		with connection.begin():
+			with phase(timings, 'rowcount_check'):
+				self.check_rowcount(insert_table, expected_rowcount, loaded_rowcount, append)
 
 			if disable_indices:
-				# create indices from 'sql'
-				for index_create_cmd in index_creates:
-					connection.execute(index_create_cmd)
+				with phase(timings, 'index_rebuild'):
+					# create indices from 'sql'
+					for index_create_cmd in index_creates:
+						connection.execute(index_create_cmd)
 
-			if analyze:
-				connection.execute(self.ANALYZE_CMD.format(table=insert_table))
+			if merge:
+				with phase(timings, 'merge'):
+					self.merge_staging(connection, table, staging, kwargs.get('merge_keys'),
+									   kwargs.get('delete_missing'))
+				self.save_watermark(connection, table, kwargs.get('watermark'))
 
-			if not append:
-				for cmd in self.SWAP_CMDS:
-					connection.execute(cmd.format(table=table, staging=staging, temp=temp))
-
-				if create_staging:
-					connection.execute(self.DROP_CMD.format(staging=staging))
\ No newline at end of file
+			if analyze:
+				with phase(timings, 'analyze'):
+					connection.execute(self.ANALYZE_CMD.format(table=table if merge else insert_table))
+
+			if not merge and not append:
+				with phase(timings, 'swap'):
+					self.swap_staging(connection, table, staging, drop=False)
+			if not append and create_staging:
+				with phase(timings, 'drop'):
+					connection.execute(self.DROP_CMD.format(staging=staging))
+		return loaded_rowcount
\ No newline at end of file
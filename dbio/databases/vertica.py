@@ -3,6 +3,8 @@ import unicodecsv
 
 # Local modules
 from base import Exportable, Importable
+from dbio.compression import decompressed_path, open_file
+from dbio.timing import phase
 
 
 class Vertica(Exportable, Importable):
@@ -36,57 +38,95 @@ class Vertica(Exportable, Importable):
 
 	DEFAULT_NULL_STRING = 'NULL'
 
+	ROW_HASH = "HEX_TO_INTEGER(SUBSTR(MD5({row}), 1, 8))"
+
+	# Vertica runs REPEATABLE READ as SERIALIZABLE, and sets it with START TRANSACTION.
+	BEGIN_SNAPSHOT_CMDS = ("START TRANSACTION ISOLATION LEVEL SERIALIZABLE",)
+
 
 	def __init__(self, url):
 		Exportable.__init__(self, url)
 		Importable.__init__(self, url)
 		
 
+	def create_staging(self, connection, table, staging):
+		# Pre drop table in case it already exists
+		connection.execute(self.DROP_CMD.format(staging=staging))
+		connection.execute(
+			self.CREATE_STAGING_CMD.format(staging=staging, table=table))
+
+
+	def swap_staging(self, connection, table, staging, drop=True):
+		connection.execute(
+			self.SWAP_CMD.format(table=table, staging=staging, temp=table + '_temp'))
+		if drop:
+			connection.execute(self.DROP_CMD.format(staging=staging))
+
+
 	def execute_import(self, table, filename, append, csv_params, null_string, 
 					   analyze=False, create_staging=True, expected_rowcount=None,
                        direct='', **kwargs):
 		""" Vertica has no indices, so disable_indices doesn't apply """
 		
 		staging = table + '_staging'
-		temp = table + '_temp'
+		merge = kwargs.get('merge')
+		if merge:
+			# Rows to merge are loaded into staging, like those replacing the table.
+			append = False
 		if append:
 			copy_table = table
 		else:
 			copy_table = staging
 
 		eng = self.get_import_engine()
+		timings = kwargs.get('timings')
+
+		with phase(timings, 'connect'):
+			connection = eng.connect()
 		
 		# Start transaction
-		with eng.begin() as connection:
+		with connection, connection.begin():
 			if not append:
-				if create_staging:
-					# Pre drop table in case it already exists
-					connection.execute(self.DROP_CMD.format(staging=staging))
-					connection.execute(
-						self.CREATE_STAGING_CMD.format(staging=staging, table=table))
-				else:
-					connection.execute(self.TRUNCATE_CMD.format(staging=staging))
+				with phase(timings, 'staging'):
+					if create_staging:
+						self.create_staging(connection, table, staging)
+					else:
+						connection.execute(self.TRUNCATE_CMD.format(staging=staging))
+
+			self.delete_where(connection, copy_table, kwargs.get('replace_where'))
 
 			raw_cursor = connection.connection.cursor()
-			with open(filename, 'r') as f:
+			with phase(timings, 'transfer'), open_file(filename, 'rb', kwargs.get('compression')) as f:
 				raw_cursor.copy(
 					self.COPY_CMD.format(table=copy_table, nullstring=null_string, direct=direct,
                                          **csv_params), f)
+				loaded_rowcount = raw_cursor.rowcount
 				raw_cursor.close()
+			self.raise_if_aborted(kwargs.get('abort_event'))
+			if not merge:
+				self.save_watermark(connection, table, kwargs.get('watermark'))
 
 		with eng.begin() as connection:
-			if expected_rowcount is not None:
-				self.do_rowcount_check(copy_table, expected_rowcount)
+			with phase(timings, 'rowcount_check'):
+				self.check_rowcount(copy_table, expected_rowcount, loaded_rowcount, append)
 
-			if analyze:
-				connection.execute(self.ANALYZE_CMD.format(table=copy_table))
+			if merge:
+				with phase(timings, 'merge'):
+					self.merge_staging(connection, table, staging, kwargs.get('merge_keys'),
+									   kwargs.get('delete_missing'))
+				self.save_watermark(connection, table, kwargs.get('watermark'))
 
-			if not append:
-				connection.execute(
-					self.SWAP_CMD.format(table=table, staging=staging, temp=temp))
+			if analyze:
+				with phase(timings, 'analyze'):
+					connection.execute(self.ANALYZE_CMD.format(table=table if merge else copy_table))
 
-				if create_staging:
+			if not merge and not append:
+				with phase(timings, 'swap'):
+					self.swap_staging(connection, table, staging, drop=False)
+			if not append and create_staging:
+				with phase(timings, 'drop'):
 					connection.execute(self.DROP_CMD.format(staging=staging))
+		return loaded_rowcount
 
 
 class VerticaODBC(Exportable, Importable):
@@ -119,6 +159,11 @@ class VerticaODBC(Exportable, Importable):
 
 	DEFAULT_NULL_STRING = 'NULL'
 
+	ROW_HASH = "HEX_TO_INTEGER(SUBSTR(MD5({row}), 1, 8))"
+
+	# Vertica runs REPEATABLE READ as SERIALIZABLE, and sets it with START TRANSACTION.
+	BEGIN_SNAPSHOT_CMDS = ("START TRANSACTION ISOLATION LEVEL SERIALIZABLE",)
+
 	def __init__(self, url):
 		Exportable.__init__(self, url)
 		Importable.__init__(self, url)
@@ -129,32 +174,57 @@ class VerticaODBC(Exportable, Importable):
                        direct='', **kwargs):
 		staging = table + '_staging'
 		temp = table + '_temp'
+		merge = kwargs.get('merge')
+		if merge:
+			# Rows to merge are loaded into staging, like those replacing the table.
+			append = False
 		if append:
 			copy_table = table
 		else:
 			copy_table = staging
 
 		eng = self.get_import_engine()
+		timings = kwargs.get('timings')
+
+		with phase(timings, 'connect'):
+			connection = eng.connect()
 		
 		# Start transaction
-		with eng.begin() as connection:
+		with connection, connection.begin():
 			if not append and create_staging:
-				connection.execute(
-					self.CREATE_STAGING_CMD.format(staging=staging, table=table))
+				with phase(timings, 'staging'):
+					connection.execute(
+						self.CREATE_STAGING_CMD.format(staging=staging, table=table))
 
-			connection.execute(
-					self.COPY_CMD.format(table=copy_table, filename=filename, 
-										nullstring=null_string, direct=direct, **csv_params))
+			self.delete_where(connection, copy_table, kwargs.get('replace_where'))
+
+			with phase(timings, 'transfer'), \
+					decompressed_path(filename, kwargs.get('compression')) as copy_path:
+				loaded_rowcount = connection.execute(
+						self.COPY_CMD.format(table=copy_table, filename=copy_path, 
+											nullstring=null_string, direct=direct, **csv_params)).rowcount
+			self.raise_if_aborted(kwargs.get('abort_event'))
+			if not merge:
+				self.save_watermark(connection, table, kwargs.get('watermark'))
 
 		with eng.begin() as connection:
-			if expected_rowcount is not None:
-				self.do_rowcount_check(copy_table, expected_rowcount)
+			with phase(timings, 'rowcount_check'):
+				self.check_rowcount(copy_table, expected_rowcount, loaded_rowcount, append)
+
+			if merge:
+				with phase(timings, 'merge'):
+					self.merge_staging(connection, table, staging, kwargs.get('merge_keys'),
+									   kwargs.get('delete_missing'))
+				self.save_watermark(connection, table, kwargs.get('watermark'))
 
 			if analyze:
-				connection.execute(self.ANALYZE_CMD.format(table=copy_table))
+				with phase(timings, 'analyze'):
+					connection.execute(self.ANALYZE_CMD.format(table=table if merge else copy_table))
 
 			if not append:
-				if create_staging:
-					connection.execute(self.DROP_CMD.format(staging=staging))
-				else:
-					connection.execute(self.TRUNCATE_CMD.format(staging=staging))
\ No newline at end of file
+				with phase(timings, 'drop'):
+					if create_staging:
+						connection.execute(self.DROP_CMD.format(staging=staging))
+					else:
+						connection.execute(self.TRUNCATE_CMD.format(staging=staging))
+		return loaded_rowcount
\ No newline at end of file
@@ -0,0 +1,224 @@
+# Python standard library
+import codecs
+import csv
+import itertools
+import re
+from cStringIO import StringIO
+
+
+""" Batch CSV encoding for query results. The output is byte for byte what unicodecsv.writer
+	writes for the same csv parameters, but a whole fetchmany() batch is converted column by
+	column and escaped in one pass instead of field by field. """
+
+# Stand-ins for the field and record separators while a batch is escaped. A batch whose
+# data contains either of them is written with unicodecsv instead.
+FIELD_SENTINEL = '\x00'
+RECORD_SENTINEL = '\x01'
+
+# Encodings in which joining and then splitting on a NUL byte is safe.
+ASCII_COMPATIBLE_ENCODINGS = ('utf-8', 'ascii', 'latin-1', 'iso8859-1', 'cp1252')
+
+
+class BatchEncoder(object):
+	""" Encodes batches of rows into CSV bytes. """
+
+	# CSV files have nothing before the first or after the last record.
+	header = ''
+
+	trailer = ''
+
+	def __init__(self, csv_params, null_string):
+		"""
+			:param csv_params: Dictionary of csv parameters, as passed to unicodecsv.writer.
+			:param null_string: String to represent null values with.
+
+		"""
+		self.csv_params = csv_params
+		self.null_string = null_string
+		self.encoding = csv_params.get('encoding', 'utf-8')
+		self.errors = csv_params.get('errors', 'strict')
+		self.join_encode = codecs.lookup(self.encoding).name in ASCII_COMPATIBLE_ENCODINGS
+
+		# Dialect defaults are those of csv.excel, which unicodecsv.writer falls back on.
+		self.delimiter = csv_params.get('delimiter', ',')
+		self.escapechar = csv_params.get('escapechar')
+		self.quotechar = csv_params.get('quotechar', '"')
+		self.quoting = csv_params.get('quoting', csv.QUOTE_MINIMAL)
+		self.doublequote = csv_params.get('doublequote', True)
+		self.lineterminator = csv_params.get('lineterminator', '\r\n')
+
+		specials = set(self.lineterminator)
+		for char in (self.delimiter, self.escapechar, self.quotechar):
+			if char:
+				specials.add(char)
+
+		self.fast = (self.quoting in (csv.QUOTE_NONE, csv.QUOTE_ALL) and
+					 not specials & set([FIELD_SENTINEL, RECORD_SENTINEL]))
+		if self.quoting == csv.QUOTE_NONE:
+			self.special_re = re.compile('[' + re.escape(''.join(sorted(specials))) + ']')
+			if self.escapechar:
+				self.escape_repl = self.escapechar.replace('\\', '\\\\') + '\\g<0>'
+		elif self.quotechar:
+			if self.doublequote:
+				self.quote_repl = self.quotechar * 2
+			elif self.escapechar:
+				self.quote_repl = self.escapechar + self.quotechar
+			else:
+				self.quote_repl = None
+
+		if isinstance(null_string, unicode):
+			self.null_bytes = null_string.encode(self.encoding, self.errors)
+		else:
+			self.null_bytes = str(null_string)
+
+
+	def encode(self, rows):
+		""" Encodes a batch of rows.
+
+			:param rows: Sequence of rows, e.g. the result of fetchmany().
+
+			:returns: Byte string of CSV records, terminated with the line terminator.
+
+		"""
+		if not rows:
+			return ''
+		num_fields = len(rows[0])
+		if not self.fast or num_fields == 0:
+			return self.__encode_with_unicodecsv(rows)
+
+		columns = [self.__convert_column(column) for column in zip(*rows)]
+		columns.append(itertools.repeat(RECORD_SENTINEL, len(rows)))
+		text = FIELD_SENTINEL.join(itertools.chain.from_iterable(itertools.izip(*columns)))
+
+		# Data containing a sentinel, or rows that unicodecsv treats specially, are left to it.
+		if (text.count(FIELD_SENTINEL) != len(rows) * (num_fields + 1) - 1 or
+				text.count(RECORD_SENTINEL) != len(rows) or
+				(num_fields == 1 and self.quoting == csv.QUOTE_NONE and
+					(FIELD_SENTINEL * 2) in FIELD_SENTINEL + text)):
+			return self.__encode_with_unicodecsv(rows)
+
+		record_separator = FIELD_SENTINEL + RECORD_SENTINEL + FIELD_SENTINEL
+		if self.quoting == csv.QUOTE_NONE:
+			if self.special_re.search(text) is not None:
+				if not self.escapechar:
+					raise csv.Error("need to escape, but no escapechar set")
+				text = self.special_re.sub(self.escape_repl, text)
+			text = text[:-2].replace(record_separator, self.lineterminator)
+			return text.replace(FIELD_SENTINEL, self.delimiter) + self.lineterminator
+
+		# QUOTE_ALL
+		quote = self.quotechar or ''
+		if quote and quote in text:
+			if self.quote_repl is None:
+				raise csv.Error("need to escape, but no escapechar set")
+			text = text.replace(quote, self.quote_repl)
+		text = text[:-2].replace(record_separator, quote + self.lineterminator + quote)
+		text = text.replace(FIELD_SENTINEL, quote + self.delimiter + quote)
+		return quote + text + quote + self.lineterminator
+
+
+	def __convert_column(self, column):
+		""" Converts one column of a batch to byte strings, the way unicodecsv and the csv
+			module would: unicode is encoded, floats use repr() and everything else str(). """
+		types = set(map(type, column))
+		null_bytes = self.null_bytes
+		if type(None) in types:
+			types.discard(type(None))
+			if not types:
+				return [null_bytes] * len(column)
+			if types == set([str]):
+				return [null_bytes if value is None else value for value in column]
+			if types == set([unicode]) and self.join_encode:
+				null_text = null_bytes.decode(self.encoding)
+				return self.__encode_unicode([null_text if value is None else value
+											  for value in column])
+			stringify = self.__stringify
+			return [null_bytes if value is None else stringify(value) for value in column]
+
+		if types == set([str]):
+			return column
+		if types == set([unicode]):
+			if self.join_encode:
+				return self.__encode_unicode(column)
+			return [value.encode(self.encoding, self.errors) for value in column]
+		if types <= set([int, long]):
+			return map(str, column)
+		if types == set([float]):
+			return map(repr, column)
+		return map(self.__stringify, column)
+
+
+	def __encode_unicode(self, column):
+		# One encode() call per column. A NUL in the data breaks the split, but such batches
+		# already fail the sentinel count in encode() and are redone with unicodecsv.
+		encoded = u'\x00'.join(column).encode(self.encoding, self.errors).split('\x00')
+		if len(encoded) != len(column):
+			return [value.encode(self.encoding, self.errors) for value in column]
+		return encoded
+
+
+	def __stringify(self, value):
+		if isinstance(value, unicode):
+			return value.encode(self.encoding, self.errors)
+		if isinstance(value, str):
+			return value
+		if isinstance(value, float):
+			return repr(value)
+		if value is None:
+			return self.null_bytes
+		return str(value)
+
+
+	def __encode_with_unicodecsv(self, rows):
+		# Only needed for the batches the fast path cannot encode, so imported here.
+		import unicodecsv
+		buf = StringIO()
+		csv_writer = unicodecsv.writer(buf, **self.csv_params)
+		if self.null_string == '':
+			csv_writer.writerows(rows)
+		else:
+			csv_writer.writerows(
+				[[self.null_string if field is None else field for field in row] for row in rows])
+		return buf.getvalue()
+
+
+class BatchSizer(object):
+	""" Picks fetchmany() sizes that keep each encoded batch within a byte budget, based on the
+		encoded size of the rows seen so far. The budget bounds the encoded CSV; the fetched
+		Python rows take a small multiple of that in memory. """
+
+	INITIAL_ROWS = 100
+
+	# Limits how fast the batch size grows, in case narrow rows are followed by wide ones.
+	MAX_GROWTH = 4
+
+	def __init__(self, batch_bytes, initial_rows=INITIAL_ROWS):
+		"""
+			:param batch_bytes: Budget in bytes for one encoded batch.
+			:param initial_rows: Size of the first batch, before any row has been measured.
+
+		"""
+		self.batch_bytes = batch_bytes
+		self.rows = max(1, initial_rows)
+		self.total_rows = 0
+		self.total_bytes = 0
+
+
+	def update(self, num_rows, num_bytes):
+		""" Records the size of an encoded batch and recomputes the next batch size.
+
+			:param num_rows: Number of rows in the batch.
+			:param num_bytes: Length of the encoded batch.
+
+			:returns: The number of rows to fetch next.
+
+		"""
+		if num_rows:
+			self.total_rows += num_rows
+			self.total_bytes += num_bytes
+			# The larger of the overall and the latest average, so a run of wide rows
+			# shrinks the batches right away.
+			row_bytes = max(float(self.total_bytes) / self.total_rows,
+							float(num_bytes) / num_rows, 1.0)
+			self.rows = max(1, min(int(self.batch_bytes / row_bytes), self.rows * self.MAX_GROWTH))
+		return self.rows
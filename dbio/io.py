@@ -1,4 +1,7 @@
 # Python standard library
+import contextlib
+import csv
+import errno
 import tempfile
 import logging
 import os
@@ -7,13 +10,22 @@ import time
 import subprocess
 import sys
 import string
+import threading
+import Queue
+import decimal
+import hashlib
+import shutil
+import stat
+from multiprocessing.pool import ThreadPool
 
-# PyPI packages
-import unicodecsv
-import sqlalchemy
-
-# Local modules.
-from databases import dialect_driver_class_map, DEFAULT_CSV_PARAMS, DEFAULT_NULL_STRING
+# Local modules. SQLAlchemy and the database modules are imported once an operation runs,
+# so that importing dbio, and dbio -h, stay fast.
+from databases import get_backend, DEFAULT_CSV_PARAMS, DEFAULT_NULL_STRING
+from compression import infer_compression, open_file
+from encoder import BatchEncoder, BatchSizer
+from pgcopy import BinaryCopyEncoder
+from spool import SpoolReader, SpoolWriter, SEGMENT_BYTES, MAX_SEGMENTS
+from timing import Timings, phase, profile_path, profiled
 
 
 # Setup module level logging
@@ -23,15 +35,46 @@ logging.getLogger('sqlalchemy').setLevel(logging.NOTSET)
 
 FILE_WRITE_BATCH = 1000000
 
+# Partitioned query constants
+PARTITION_QUERY = "SELECT * FROM ({query}) AS query_partition WHERE {predicate}"
+COPY_BUFFER_SIZE = 16 * 1024 * 1024
+
+COPY_FORMATS = ('csv', 'binary')
+
+# Options of temporary files, which only replicate_no_fifo writes.
+COMPRESSION_OPTIONS = ('compression', 'compression_level')
+
+# Sync constants
+SYNC_CHUNKS = 100
+SYNC_QUERY = "SELECT {columns} FROM {table} WHERE {predicate}"
+
 # Named pipe replication constants
 PIPE_WRITE_BATCH = 100
+# fcntl commands to resize a pipe, Linux only. Python 2 does not define them.
+F_SETPIPE_SZ = 1031
+F_GETPIPE_SZ = 1032
+
+# Fan-out and fan-in replication constants
+FANIN_QUEUE_DEPTH = 16
+# Options of replicate_threaded that these query and encode in full without.
+FAN_UNSUPPORTED_OPTIONS = ('watermark_column', 'watermark_key', 'pipeline_depth', 'pipe_size',
+						   'profile')
+
+# Chunked replication constants
+REPLICATE_CHUNKS = 100
+CHUNK_QUERY = "SELECT * FROM ({query}) AS query_chunk WHERE {column} < {upper}"
 MAX_WRITE_ATTEMPTS = 10
-MAX_READ_ATTEMPTS = 10
+RETRY_DELAY = 1
+MAX_RETRY_DELAY = 60
 
 
 def query(sqla_url, query, filename, query_is_file=False, 
 			batch_size=FILE_WRITE_BATCH, csv_params=DEFAULT_CSV_PARAMS, 
-			null_string=DEFAULT_NULL_STRING):
+			null_string=DEFAULT_NULL_STRING, partition_by=None, parallel=1,
+			partitions=None, boundaries=None, shard_files=False, compression=None,
+			compression_level=None, batch_bytes=None, pipeline_depth=None, native_export=False,
+			copy_format='csv', column_types=None, rowcount_file=None, pipe_size=None,
+			timings=None):
 	""" Query a database and write the results to a csv file.
 
 		:param sqla_url: SQLAlchemy engine creation URL for db.
@@ -41,6 +84,48 @@ def query(sqla_url, query, filename, query_is_file=False,
 		:param batch_size: Number of rows to keep in memory before writing to filename.
 		:param csv_params: Dictionary of csv parameters.
 		:param null_string: String to represent null values with.
+		:param partition_by: If set, the results are split into ranges of this column, and
+					each range is queried over its own connection. Rows are written range by
+					range, so the order of the results is not preserved.
+		:param parallel: Number of ranges queried at the same time.
+		:param partitions: Number of ranges to split the column into, evenly between its
+					smallest and largest value. Defaults to parallel.
+		:param boundaries: Explicit, sorted list of values at which ranges start. Required
+					if the column is neither numeric nor a date or time.
+		:param shard_files: If True, each range is left in its own file named
+					filename.0000, filename.0001, etc. instead of being merged into filename.
+		:param compression: Codec to compress the file with: 'gzip', 'zstd' or 'lz4'.
+					If None, it is inferred from the extension of filename.
+		:param compression_level: Codec specific compression level.
+		:param batch_bytes: If set, batch_size is ignored and the number of rows per batch
+					is adapted to keep each encoded batch within this many bytes.
+		:param pipeline_depth: If set, rows are fetched, encoded and written by three
+					threads at once, with at most this many batches queued between each
+					pair of them. The busy and idle time of each stage is logged.
+		:param native_export: If True, the database writes the file with its own bulk
+					export command (e.g. COPY TO STDOUT for PostgreSQL), without turning rows
+					into Python objects. The file is in the same dialect, so csv_params must
+					not quote fields and must escape with a backslash, but values are
+					formatted by the database (see the database's execute_export()). Batch
+					options are ignored.
+		:param copy_format: 'binary' writes the binary COPY format of PostgreSQL instead of
+					CSV, to be loaded into PostgreSQL with the same copy_format. With
+					native_export, only a PostgreSQL database can write it.
+		:param column_types: For the binary format without native_export, the PostgreSQL
+					types of the columns the file will be loaded into, e.g. ['int4', 'text'].
+					If None, they are inferred from the Python values (see
+					:py:func:`dbio.pgcopy.infer_type`).
+		:param rowcount_file: If set, the number of rows written is saved to this file before
+					filename is closed, so that a load reading filename as a named pipe can
+					check it without the query being run a second time.
+		:param pipe_size: If filename is a named pipe, its buffer is enlarged to this many
+					bytes (Linux only, see :py:func:`replicate`), and unless batch_bytes is
+					given, batches are written in chunks of half as many bytes.
+		:param timings: :py:class:`dbio.timing.Timings` to add the phases of the query to:
+					'connect', 'first_row' (running the query until its first batch is
+					fetched) and 'transfer' (fetching, encoding and writing the rest), or only
+					'transfer' with native_export. The phases are logged in any case.
+					Partitioned queries are not split into phases.
 		:returns: The number of rows written to the file.
 
 	"""
@@ -53,35 +138,139 @@ def query(sqla_url, query, filename, query_is_file=False,
 		query_str = query
 
 	db = __get_database(sqla_url)
-	db_engine = db.get_export_engine()
-	connection = db_engine.connect()
-
-	# Stream results with given buffer size. Currently only used by pyscopg2.
-	results = (connection.execution_options(stream_results=True, 
-				max_row_buffer=batch_size)).execute(query_str)
+	__check_copy_format(db, copy_format, native_export)
+	compression = infer_compression(filename, compression)
+	if partition_by is not None:
+		if copy_format == 'binary' and not shard_files:
+			raise ValueError("Files in the binary format cannot be merged, use shard_files.")
+		rows_written = __query_partitioned(db, query_str, filename, partition_by, parallel,
+										   partitions or parallel, boundaries, shard_files,
+										   batch_size, csv_params, null_string, compression,
+										   compression_level, batch_bytes, pipeline_depth,
+										   native_export, copy_format, column_types)
+		if rowcount_file is not None:
+			__write_rowcount(rowcount_file, rows_written)
+		return rows_written
 
-	rows_written = 0
-	with open(filename, 'wb') as f:
-		csv_writer = unicodecsv.writer(f, **csv_params)
-		rows = results.fetchmany(batch_size)
-		while rows:
-			if null_string == '':
-				csv_writer.writerows(rows)
-			else:
-				csv_writer.writerows(
-					[[null_string if field is None else field for field in row] for row in rows])
-			rows_written += len(rows)
-			rows = results.fetchmany(batch_size)
+	if pipe_size is not None and batch_bytes is None:
+		batch_bytes = pipe_size // 2
 
-	results.close()
+	query_timings = Timings('query')
+	try:
+		with open_file(filename, 'wb', compression, compression_level) as f:
+			if (pipe_size is not None and hasattr(f, 'fileno') and
+					stat.S_ISFIFO(os.stat(filename).st_mode)):
+				__set_pipe_size(f.fileno(), pipe_size)
+			rows_written = __write_query_results(db, query_str, f, batch_size, csv_params,
+												 null_string, batch_bytes, pipeline_depth,
+												 native_export, copy_format, column_types,
+												 timings=query_timings)
+			if rowcount_file is not None:
+				__write_rowcount(rowcount_file, rows_written)
+	finally:
+		__add_timings(timings, query_timings)
 
 	logger.info("Query to csv completed. Rows written: {count}.".format(count=rows_written))
+	__log_timings('Query', query_timings)
 	return rows_written
 
 
+# query() under a name that the query argument of the replicate functions does not shadow.
+__query_to_file = query
+
+
+def query_snapshot(sqla_url, queries, parallel=1, query_is_file=False,
+				   batch_size=FILE_WRITE_BATCH, csv_params=DEFAULT_CSV_PARAMS,
+				   null_string=DEFAULT_NULL_STRING, compression=None, compression_level=None,
+				   batch_bytes=None, pipeline_depth=None, native_export=False, copy_format='csv'):
+	""" Query a database several times, e.g. for each of a set of related tables, and write
+		the results of each query to its own csv file. Every query reads the same snapshot
+		of the database, so the files are consistent with each other.
+
+		With PostgreSQL, the queries run on parallel connections whose transactions import
+		the snapshot of a first one, as pg_dump -j does. Other databases run them one after
+		the other in a single REPEATABLE READ (or equivalent) transaction.
+
+		:param sqla_url: SQLAlchemy engine creation URL for db.
+		:param queries: List of (query, filename) pairs.
+		:param parallel: Number of queries run at the same time, if the database can share
+					its snapshot.
+		:param query_is_file: If True, the queries are filenames.
+		:param batch_size: Number of rows to keep in memory before writing to a file.
+		:param csv_params: Dictionary of csv parameters.
+		:param null_string: String to represent null values with.
+		:param compression: Codec to compress the files with. If None, it is inferred from
+					the extension of each filename.
+		:param compression_level: Codec specific compression level.
+		:param batch_bytes: Byte budget for each batch (see :py:func:`query`).
+		:param pipeline_depth: Queue depth of pipelined batches (see :py:func:`query`).
+		:param native_export: If True, the database writes the files with its own bulk export
+					command (see :py:func:`query`).
+		:param copy_format: 'csv' or 'binary' (see :py:func:`query`).
+		:returns: List of the number of rows written to each file.
+
+	"""
+
+	logger.info("Querying {count} queries from one snapshot.".format(count=len(queries)))
+
+	if query_is_file:
+		queries = [(__file_to_str(query_str), filename) for query_str, filename in queries]
+
+	db = __get_database(sqla_url)
+	__check_copy_format(db, copy_format, native_export)
+
+	def query_one(item, connection):
+		query_str, filename = item
+		with open_file(filename, 'wb', infer_compression(filename, compression),
+					   compression_level) as f:
+			rows_written = __write_query_results(db, query_str, f, batch_size, csv_params,
+												 null_string, batch_bytes, pipeline_depth,
+												 native_export, copy_format,
+												 connection=connection)
+		logger.info("Rows written to {filename}: {count}.".format(filename=filename,
+					count=rows_written))
+		return rows_written
+
+	engine = db.get_export_engine()
+	leader = engine.connect()
+	try:
+		# The snapshot lasts as long as the transaction exporting it.
+		with leader.begin():
+			db.begin_snapshot(leader)
+			snapshot = None
+			if parallel > 1:
+				snapshot = db.export_snapshot(leader)
+				if snapshot is None:
+					logger.info("{name} cannot share snapshots, querying in one transaction.".format(
+								name=db.__class__.__name__))
+
+			if snapshot is None:
+				rowcounts = [query_one(item, leader) for item in queries]
+			else:
+				def query_in_snapshot(item):
+					connection = engine.connect()
+					try:
+						with connection.begin():
+							db.begin_snapshot(connection, snapshot)
+							return query_one(item, connection)
+					finally:
+						connection.close()
+
+				pool = ThreadPool(parallel)
+				try:
+					rowcounts = pool.map(query_in_snapshot, queries)
+				finally:
+					pool.close()
+	finally:
+		leader.close()
+
+	logger.info("Snapshot query completed. Rows written: {count}.".format(count=sum(rowcounts)))
+	return rowcounts
+
+
 def load(sqla_url, table, filename, append, disable_indices=False, analyze=False,
 		 csv_params=DEFAULT_CSV_PARAMS, null_string=DEFAULT_NULL_STRING, 
-		 create_staging=True, expected_rowcount=None, **kwargs):
+		 create_staging=True, expected_rowcount=None, timings=None, **kwargs):
 	""" Import data from a csv file to a database table. 
 
 		:param sqla_url: SQLAlchemy url string to pass to create_engine().
@@ -99,25 +288,52 @@ def load(sqla_url, table, filename, append, disable_indices=False, analyze=False
 					If False, there must be an existing table named "table_staging".
 		:param expected_rowcount: The number of rows that are expected to be in the loaded table.
 					If the count does not much, the loading transaction will raise an error and rollback if possible.
-					If the count is set to None, no check will be made.
+					If the count is set to None, no check will be made. May also be a function
+					returning the count, called once filename has been read to the end.
+		:param timings: :py:class:`dbio.timing.Timings` to add the phases of the load to:
+					'connect', 'staging' (including 'grants' for PostgreSQL), 'disable_indices',
+					'transfer', 'rowcount_check', 'index_rebuild', 'merge', 'analyze', 'swap'
+					and 'drop', for those that apply. The phases are logged in any case.
 		Kwargs:
              direct (string): For Vertica. Will apply DIRECT keywprd to COPY command to skip WOS
+             compression (string): Codec filename is compressed with: 'gzip', 'zstd' or 'lz4'.
+                                   If not given, it is inferred from the extension of filename.
+             copy_format (string): 'csv' (the default) or 'binary', for files written by
+                                   query with the same copy_format (PostgreSQL only).
+             bulk_pragmas (bool or dict): For SQLite. PRAGMAs to set while loading, or True
+                                   for SQLite.BULK_PRAGMAS.
+             merge (bool): Merge the rows into table on its keys instead of appending them
+                                   or replacing the table. append is then ignored.
+             merge_keys (list): Columns to merge on. Defaults to the primary key of table.
+             delete_missing (bool): With merge, delete the rows of table that are not in
+                                   filename, for files holding every row.
+
+		:returns: The number of rows loaded, or -1 if the database driver does not report it.
 	"""
 
 	logger.info("Importing from CSV.")
 
 	db = __get_database(sqla_url)
-	db.execute_import(table, filename, append, csv_params, null_string,
-						analyze=analyze, disable_indices=disable_indices, 
-						create_staging=create_staging, expected_rowcount=expected_rowcount,
-                        **kwargs)
+	__check_copy_format(db, kwargs.get('copy_format', 'csv'))
+	load_timings = Timings('load')
+	try:
+		rowcount = db.execute_import(table, filename, append, csv_params, null_string,
+							analyze=analyze, disable_indices=disable_indices, 
+							create_staging=create_staging, expected_rowcount=expected_rowcount,
+							timings=load_timings, **kwargs)
+	finally:
+		__add_timings(timings, load_timings)
 
 	logger.info("Load from csv completed.")
+	__log_timings('Load', load_timings)
+	return rowcount
 
 
 def replicate(query_db_url, load_db_url, query, table, append, analyze=False,
 			  disable_indices=False, query_is_file=False, create_staging=True,
-			  do_rowcount_check=False, **kwargs):
+			  do_rowcount_check=False, batch_bytes=None, pipeline_depth=None, native_export=False,
+			  copy_format='csv', watermark_column=None, watermark_key=None, pipe_size=None,
+			  profile=None, timings=None, **kwargs):
 	""" Load query results into a table using a named pipe to stream the data.
 
 		This method works by simultaneously executing :py:func:`query` and 
@@ -138,26 +354,86 @@ def replicate(query_db_url, load_db_url, query, table, append, analyze=False,
 		:param query_is_file: If True, the query argument is a filename.
 		:param create_staging: If True, the old table will be replaced with a new, identical table.
 					If False, there must be an existing table named "table_staging".
-		:param do_rowcount_check: If True, the replication will only succeed if the query rowcount
-					matches the load rowcount.
+		:param do_rowcount_check: If True, the replication will only succeed if the number of
+					rows the query wrote matches the number the load reports. The rows are
+					counted as they stream, so the query is not run twice.
+		:param batch_bytes: If set, the query fetches and writes batches of about this many
+					bytes instead of a fixed number of rows (see :py:func:`query`).
+		:param pipeline_depth: If set, the query fetches, encodes and writes on separate
+					threads (see :py:func:`query`).
+		:param native_export: If True, the query database writes the pipe with its own bulk
+					export command (see :py:func:`query`). Only between PostgreSQL databases,
+					otherwise ValueError is raised.
+		:param copy_format: 'binary' to replicate in the binary COPY format of PostgreSQL,
+					which the load database must be. Without native_export, rows are
+					encoded for the column types of table.
+		:param watermark_column: If set, only rows with a larger value in this column than
+					the last replication from the same source are queried and appended, and
+					the largest value replicated is saved in the load database, in the same
+					transaction as the rows. Requires append or merge. Rows with a NULL value are never
+					replicated, and rows committed late with a value below the saved one are
+					missed, so the column should only grow, like an id or an updated_at.
+		:param watermark_key: Name of the source in the saved watermarks. Defaults to a
+					hash of query_db_url, without the password, and of the query.
+		:param pipe_size: If set, the pipe buffer is enlarged from the default 64 KiB to this
+					many bytes with F_SETPIPE_SZ, on Linux only, and unless batch_bytes is given
+					the query writes chunks of half as many bytes instead of PIPE_WRITE_BATCH
+					rows. The pipe then absorbs bursts from the query without stalling the
+					load, with fewer writes and context switches. Sizes above
+					/proc/sys/fs/pipe-max-size need CAP_SYS_RESOURCE; without it, the pipe
+					keeps its size and a warning is logged.
+		:param profile: If set, the load and query processes save a cProfile of themselves
+					to this file name with '.load' and '.query' added before the extension,
+					e.g. out.load.pstats and out.query.pstats.
+		:param timings: :py:class:`dbio.timing.Timings` to add the phases of the query and
+					of the load to (see :py:func:`query` and :py:func:`load`). Each process
+					saves the phases of its side to a file, read once both have exited.
 		Kwargs:
              direct (string): For Vertica. Will apply DIRECT keywprd to COPY command to skip WOS
+             merge, merge_keys, delete_missing: Merge the results into table
+                                   (see :py:func:`load`).
+             compression, compression_level: Raise ValueError, as a pipe is not compressed.
 
-		:raises ReaderError: Reader process did not execute successfully.
-		:raises WriterError: Writer process did not execute successfully.
+		:returns: Dictionary mapping 'reader' and 'writer' to the returncode, cpu_time
+					(user + system seconds) and max_rss (as reported by getrusage, kilobytes
+					on Linux) of each process, and 'phases' to the phases of the query
+					followed by those of the load. Empty if watermark_column is set and there
+					were no new rows.
+		:raises RuntimeError: Reader or writer process did not execute successfully.
 		
 	"""
 	logger.info("Beginning replication.")
+	__check_uncompressed(kwargs)
 
 	load_db = __get_database(load_db_url)
 	csv_params = load_db.DEFAULT_CSV_PARAMS
 	null_string = load_db.DEFAULT_NULL_STRING
+	__check_native_export(load_db, native_export)
+
+	watermark = None
+	if watermark_column is not None:
+		if query_is_file:
+			query = __file_to_str(query)
+			query_is_file = False
+		query, watermark = __incremental_query(__get_database(query_db_url), load_db, query_db_url,
+											   query, table, append or kwargs.get('merge'),
+											   watermark_column, watermark_key)
+		if query is None:
+			return {}
 
 	# Open a UNIX first-in-first-out file (a named pipe).
 	pipe_name = 'pipe_' + ''.join(random.SystemRandom().choice(
 		string.ascii_uppercase + string.ascii_lowercase + string.digits) for _ in range(10))
 	os.mkfifo(pipe_name)
+	rowcount_file = None
+	# Each process saves the phases of its side here.
+	timings_files = {}
+	replication_timings = Timings()
 	try:
+		for side in ('query', 'load'):
+			handle, timings_files[side] = tempfile.mkstemp(prefix=pipe_name + '_timings_')
+			os.close(handle)
+
 		# Args for 'dbio' command
 		dbio_args = ['dbio']
 		root_logger_level = logging.getLogger().level
@@ -177,20 +453,52 @@ def replicate(query_db_url, load_db_url, query, table, append, analyze=False,
 		if disable_indices:
 			load_args.append('--disable-indices')
 		if do_rowcount_check:
-			if query_is_file:
-				rowcount = __get_database(query_db_url).get_query_rowcount(__file_to_str(query))
-			else:
-				rowcount = __get_database(query_db_url).get_query_rowcount(query)
-
-			load_args.append('--expected-rowcount')
-			load_args.append(str(rowcount))
+			# The writer saves its row count here before closing the pipe, so it is there
+			# by the time the reader has loaded everything.
+			handle, rowcount_file = tempfile.mkstemp(prefix=pipe_name + '_rowcount_')
+			os.close(handle)
+			load_args.extend(['--expected-rowcount-file', rowcount_file])
 		if kwargs.get('direct'):
 			load_args.append('--direct')
+		if kwargs.get('bulk_pragmas'):
+			load_args.append('--bulk-pragmas')
+		if kwargs.get('merge'):
+			load_args.append('--merge')
+		if kwargs.get('merge_keys'):
+			load_args.extend(['--merge-keys', ','.join(kwargs['merge_keys'])])
+		if kwargs.get('delete_missing'):
+			load_args.append('--delete-missing')
+		if copy_format != 'csv':
+			load_args.extend(['--copy-format', copy_format])
+		if watermark is not None:
+			load_args.extend(['--watermark', watermark['key'], watermark['column'],
+							  watermark['mark']])
+		if profile is not None:
+			load_args.extend(['--profile', profile_path(profile, 'load')])
+		load_args.extend(['--timings-file', timings_files['load']])
 		__append_csv_args(load_args, csv_params, null_string)
 		reader_args = dbio_args + load_args
 
 		# Args for 'query' subcommand
 		query_args  = ['query', query_db_url, query, pipe_name, '--batchsize', str(PIPE_WRITE_BATCH)]
+		if batch_bytes is not None:
+			query_args.extend(['--batch-bytes', str(batch_bytes)])
+		if pipeline_depth:
+			query_args.extend(['--pipeline-depth', str(pipeline_depth)])
+		if native_export:
+			query_args.append('--native-export')
+		if copy_format != 'csv':
+			query_args.extend(['--copy-format', copy_format])
+		column_types = __binary_column_types(load_db, table, copy_format, native_export)
+		if column_types is not None:
+			query_args.extend(['--column-types', ','.join(column_types)])
+		if rowcount_file is not None:
+			query_args.extend(['--rowcount-file', rowcount_file])
+		if pipe_size is not None:
+			query_args.extend(['--pipe-size', str(pipe_size)])
+		if profile is not None:
+			query_args.extend(['--profile', profile_path(profile, 'query')])
+		query_args.extend(['--timings-file', timings_files['query']])
 		if query_is_file:
 			query_args.append('--file')
 		__append_csv_args(query_args, csv_params, null_string)
@@ -206,60 +514,1316 @@ def replicate(query_db_url, load_db_url, query, table, append, analyze=False,
 		logger.debug("Writer call: " + ' '.join(writer_args))
 		writer_process = subprocess.Popen(writer_args, env=env)
 
-		processes = [reader_process, writer_process]
-		try:
-			running_processes = list(processes)
-			while running_processes:
-				for process in running_processes:
-					process.poll()
-					if process.returncode == os.EX_OK:
-						running_processes.remove(process)
-
-					elif process.returncode is not None:
-						running_processes.remove(process)
-						raise RuntimeError('Failure inside a database reader/writer process')
-
-		finally:
-			# Ensure no processes are orphaned
-			for process in processes:
-				process.poll()
-				if process.returncode is None:
-						process.kill()
+		usage = __supervise_processes({'reader' : reader_process, 'writer' : writer_process})
 
 	finally:
 		os.remove(pipe_name)
+		if rowcount_file is not None:
+			os.remove(rowcount_file)
+		for side in ('query', 'load'):
+			if side in timings_files:
+				replication_timings.phases.extend(Timings.read(timings_files[side]).phases)
+				os.remove(timings_files[side])
+		__add_timings(timings, replication_timings)
 
+	usage['phases'] = replication_timings.phases
 	logger.info("Replication completed.")
+	__log_timings('Replication', replication_timings)
+	return usage
 
 
 def replicate_no_fifo(query_db_url, load_db_url, query, table, append, analyze=False,
 					  disable_indices=False, query_is_file=False, create_staging=True,
-					  do_rowcount_check=False, **kwargs):
+					  do_rowcount_check=False, compression=None, compression_level=None,
+					  batch_bytes=None, pipeline_depth=None, native_export=False, copy_format='csv',
+					  watermark_column=None, watermark_key=None, spool=False,
+					  segment_bytes=SEGMENT_BYTES, max_segments=MAX_SEGMENTS, timings=None,
+					  profile=None, **kwargs):
 	""" Identitcal to :py:func:`replicate`, but uses a tempfile and disk I/O instead of a
 		named pipe. This method works on any platform and doesn't require the database
-		to support loading from named pipes."""
+		to support loading from named pipes.
+
+		With spool, the results are written to a spool of temp files instead (see
+		:py:mod:`dbio.spool`), which the load reads while the query is still writing it,
+		deleting each file once read. The query and the load then overlap, as with a
+		pipe, and no more than about max_segments * segment_bytes are on disk at once.
+		MySQL and Vertica over ODBC, which load from a file name, still read the spool
+		through a named pipe.
+
+		:param compression: Codec to compress the tempfile with: 'gzip', 'zstd' or 'lz4'.
+		:param compression_level: Codec specific compression level.
+		:param batch_bytes: Byte budget for each batch written by :py:func:`query`.
+		:param pipeline_depth: Queue depth of the pipelined :py:func:`query`, if set.
+		:param native_export: If True, :py:func:`query` uses the database's bulk export.
+		:param copy_format: 'csv' or 'binary' (see :py:func:`replicate`).
+		:param watermark_column: Replicate only new rows (see :py:func:`replicate`).
+		:param watermark_key: Name of the source in the saved watermarks.
+		:param spool: If True, load from a spool while the query writes it.
+		:param segment_bytes: Size of each spool file, before compression.
+		:param max_segments: Number of spool files left unread before the query waits for
+					the load.
+		:param timings: :py:class:`dbio.timing.Timings` to add the phases of the query and
+					of the load to (see :py:func:`query` and :py:func:`load`).
+		:param profile: Save a cProfile of the query and of the load to this file name with
+					'.query' and '.load' added before the extension (see
+					:py:func:`replicate`).
+
+		:returns: The number of rows replicated.
+
+	"""
 
 	logger.info("Beginning replication.")
 
 	load_db = __get_database(load_db_url)
 	csv_params = load_db.DEFAULT_CSV_PARAMS
 	null_string = load_db.DEFAULT_NULL_STRING
+	__check_native_export(load_db, native_export)
+
+	watermark = None
+	if watermark_column is not None:
+		if query_is_file:
+			query = __file_to_str(query)
+			query_is_file = False
+		query, watermark = __incremental_query(__get_database(query_db_url), load_db, query_db_url,
+											   query, table, append or kwargs.get('merge'),
+											   watermark_column, watermark_key)
+		if query is None:
+			return 0
+
+	column_types = __binary_column_types(load_db, table, copy_format, native_export)
+
+	if spool:
+		query_db = __get_database(query_db_url)
+		if query_is_file:
+			query = __file_to_str(query)
+		__check_copy_format(query_db, copy_format, native_export)
+		__check_copy_format(load_db, copy_format)
+		rowcount = __replicate_spooled(query_db, load_db, query, table, append, analyze,
+									   disable_indices, create_staging, do_rowcount_check,
+									   compression, compression_level, batch_bytes,
+									   pipeline_depth, native_export, copy_format, column_types,
+									   watermark, segment_bytes, max_segments, timings=timings,
+									   profile=profile, **kwargs)
+		logger.info("Replication completed.")
+		return rowcount
 
 	temp_file = tempfile.NamedTemporaryFile()
 	try:
-		rowcount = query(query_db_url, query, temp_file.name, query_is_file=query_is_file, 
-			  csv_params=csv_params, null_string=null_string)
-
-		if not do_rowcount_check:
-			rowcount = None
+		rowcount = profiled(profile_path(profile, 'query'), __query_to_file, query_db_url,
+			  query, temp_file.name, query_is_file=query_is_file,
+			  csv_params=csv_params, null_string=null_string, compression=compression,
+			  compression_level=compression_level, batch_bytes=batch_bytes,
+			  pipeline_depth=pipeline_depth, native_export=native_export, copy_format=copy_format,
+			  column_types=column_types, timings=timings)
 
-		load(load_db_url, table, temp_file.name, append, analyze=analyze, 
-			 disable_indices=disable_indices, csv_params=csv_params, null_string=null_string,
-			 create_staging=create_staging, expected_rowcount=rowcount, **kwargs)
+		profiled(profile_path(profile, 'load'), load, load_db_url, table, temp_file.name, append,
+			 analyze=analyze, disable_indices=disable_indices, csv_params=csv_params,
+			 null_string=null_string, create_staging=create_staging,
+			 expected_rowcount=rowcount if do_rowcount_check else None,
+			 compression=compression, copy_format=copy_format, watermark=watermark,
+			 timings=timings, **kwargs)
 	finally:
 		temp_file.close()
 
 	logger.info("Replication completed.")
+	return rowcount
+
+
+def replicate_threaded(query_db_url, load_db_url, query, table, append, analyze=False,
+					   disable_indices=False, query_is_file=False, create_staging=True,
+					   do_rowcount_check=False, batch_bytes=None, pipeline_depth=None,
+					   native_export=False, copy_format='csv', watermark_column=None,
+					   watermark_key=None, pipe_size=None, timings=None, profile=None, **kwargs):
+	""" Identical to :py:func:`replicate`, but the query and the load run on two threads
+		of the calling process, joined by an anonymous pipe. No ``dbio`` interpreters are
+		spawned, one database object is shared per URL, and an exception raised on either
+		side is re-raised as is.
+
+		If the query side fails part way through, the load is rolled back rather than
+		committing the rows that made it through the pipe.
+
+		**Unix only.**
+
+		:param batch_bytes: Byte budget for each batch written to the pipe.
+		:param pipeline_depth: If set, the query fetches, encodes and writes to the pipe on
+					separate threads (see :py:func:`query`).
+		:param native_export: If True, the query database writes to the pipe with its own
+					bulk export command (see :py:func:`query`). Between two PostgreSQL
+					databases, the rows then pass from COPY TO STDOUT to COPY FROM STDIN
+					without being parsed in Python.
+		:param copy_format: 'csv' or 'binary' (see :py:func:`replicate`). With native_export,
+					the column types of the query and of table are compared before binary
+					replication starts.
+		:param watermark_column: Replicate only new rows (see :py:func:`replicate`).
+		:param watermark_key: Name of the source in the saved watermarks.
+		:param pipe_size: Enlarge the pipe buffer to this many bytes, and write in chunks of
+					half as many (see :py:func:`replicate`).
+		:param timings: :py:class:`dbio.timing.Timings` to add the phases of the query and
+					of the load to (see :py:func:`query` and :py:func:`load`). The two sides
+					run at once, so their phases overlap.
+		:param profile: Save a cProfile of the query thread and of the load thread to this
+					file name with '.query' and '.load' added before the extension. Threads
+					started by either side, e.g. by pipeline_depth, are not profiled.
+
+		:returns: The number of rows replicated.
+
+	"""
+	logger.info("Beginning replication.")
+	__check_uncompressed(kwargs)
+
+	databases = {}
+	query_db = __get_shared_database(databases, query_db_url)
+	load_db = __get_shared_database(databases, load_db_url)
+	csv_params = load_db.DEFAULT_CSV_PARAMS
+	null_string = load_db.DEFAULT_NULL_STRING
+	__check_native_export(load_db, native_export)
+
+	if query_is_file:
+		query_str = __file_to_str(query)
+	else:
+		query_str = query
+
+	watermark = None
+	if watermark_column is not None:
+		query_str, watermark = __incremental_query(query_db, load_db, query_db_url, query_str,
+												   table, append or kwargs.get('merge'), watermark_column,
+												   watermark_key)
+		if query_str is None:
+			return 0
+
+	__check_copy_format(query_db, copy_format, native_export)
+	__check_copy_format(load_db, copy_format)
+	column_types = __binary_column_types(load_db, table, copy_format, native_export)
+	if copy_format == 'binary' and native_export:
+		if (query_db.get_column_type_oids(query_str) !=
+				load_db.get_column_type_oids('SELECT * FROM ' + table)):
+			raise ValueError("The column types of the query do not match those of " + table +
+							 ", which the binary format requires.")
+
+	# Filled in by the writer before it closes the pipe, i.e. before the loader checks it.
+	written = {}
+	expected_rowcount = None
+	if do_rowcount_check:
+		expected_rowcount = lambda: written['rows']
+
+	read_fd, write_fd = os.pipe()
+	if pipe_size is not None:
+		__set_pipe_size(write_fd, pipe_size)
+		if batch_bytes is None:
+			batch_bytes = pipe_size // 2
+	aborted = threading.Event()
+	finished = Queue.Queue()
+	replication_timings = Timings()
+	try:
+		__start_thread('writer', finished, profiled, profile_path(profile, 'query'),
+					   __write_to_pipe, query_db, query_str, write_fd, PIPE_WRITE_BATCH,
+					   csv_params, null_string, aborted, batch_bytes, pipeline_depth,
+					   native_export, copy_format, column_types, written,
+					   timings=replication_timings.for_side('query'))
+		# The loader reopens the read end through /dev/fd, so no path on disk is needed.
+		__start_thread('reader', finished, profiled, profile_path(profile, 'load'),
+					   load_db.execute_import, table, '/dev/fd/{fd}'.format(fd=read_fd),
+					   append, csv_params, null_string, analyze=analyze,
+					   disable_indices=disable_indices, create_staging=create_staging,
+					   expected_rowcount=expected_rowcount, abort_event=aborted,
+					   copy_format=copy_format, watermark=watermark,
+					   timings=replication_timings.for_side('load'), **kwargs)
+
+		failure = None
+		for _ in range(2):
+			name, _, exc_info = finished.get()
+			if exc_info is not None and failure is None:
+				failure = exc_info
+				logger.error("Replication {name} thread failed.".format(name=name))
+				if name == 'reader':
+					# Unblock the writer: its next write to the pipe fails with EPIPE.
+					os.close(read_fd)
+					read_fd = None
+	finally:
+		if read_fd is not None:
+			os.close(read_fd)
+		__add_timings(timings, replication_timings)
+
+	if failure is not None:
+		raise failure[0], failure[1], failure[2]
+
+	logger.info("Replication completed.")
+	__log_timings('Replication', replication_timings)
+	return written['rows']
+
+
+def replicate_fanout(query_db_url, query, targets, query_is_file=False, analyze=False,
+					 disable_indices=False, create_staging=True, do_rowcount_check=False,
+					 batch_bytes=None, **kwargs):
+	""" Like :py:func:`replicate_threaded`, but the results of one query are loaded into
+		several tables, in any number of databases, at once. The query runs once, and each
+		batch of rows is encoded once for each CSV dialect among the targets and written to
+		a pipe for each target. Writes block on the slowest target, so the query runs only
+		as fast as that one loads.
+
+		Each target is loaded in its own transaction. If one fails, its pipe is closed and
+		the others carry on; if the query fails, every load is rolled back.
+
+		**Unix only.**
+
+		:param query_db_url: SQLAlchemy engine creation URL for query_db.
+		:param query: SQL query string to execute.
+		:param targets: List of dictionaries with the 'load_db_url' and 'table' to load into,
+					and optionally 'append' (defaults to False) and any keyword argument of
+					:py:func:`load`, e.g. 'analyze', overriding those given here.
+		:param query_is_file: If True, the query argument is a filename.
+		:param analyze: If True, the tables will be analyzed after loading.
+		:param disable_indices: If True, indices are dropped while loading.
+		:param create_staging: If False, each "table_staging" must already exist.
+		:param do_rowcount_check: If True, each load only succeeds if it loaded as many rows
+					as the query returned.
+		:param batch_bytes: Byte budget for each batch fetched from the query.
+		Kwargs:
+             Passed to every load, e.g. direct. The options in FAN_UNSUPPORTED_OPTIONS, a
+             copy_format other than 'csv', native_export and compression raise ValueError,
+             here or in a target.
+
+		:returns: List of dictionaries, one for each target, with its 'load_db_url' and
+				'table', the 'rows' loaded, and the 'error' its load raised, or None.
+		:raises: Any error of the query.
+
+	"""
+	logger.info("Beginning replication to {count} targets.".format(count=len(targets)))
+	__check_uncompressed(kwargs)
+	__check_fan_options(kwargs)
+	for target in targets:
+		__check_uncompressed(target)
+		__check_fan_options(target)
+
+	databases = {}
+	query_db = __get_shared_database(databases, query_db_url)
+	if query_is_file:
+		query_str = __file_to_str(query)
+	else:
+		query_str = query
+
+	# Filled in by the writer before it closes the pipes, i.e. before the loaders check it.
+	written = {}
+	expected_rowcount = None
+	if do_rowcount_check:
+		expected_rowcount = lambda: written['rows']
+
+	loads = []
+	encoders = {}
+	pipes = []
+	read_fds = {}
+	for i, target in enumerate(targets):
+		load_db = __get_shared_database(databases, target['load_db_url'])
+		csv_params = load_db.DEFAULT_CSV_PARAMS
+		null_string = load_db.DEFAULT_NULL_STRING
+		dialect = (repr(sorted(csv_params.items())), null_string)
+		if dialect not in encoders:
+			encoders[dialect] = BatchEncoder(csv_params, null_string)
+		options = dict(kwargs, analyze=analyze, disable_indices=disable_indices,
+					   create_staging=create_staging)
+		options.update((key, value) for key, value in target.items()
+					   if key not in ('load_db_url', 'table', 'append'))
+		loads.append((load_db, target, csv_params, null_string, options))
+		read_fds[i], write_fd = os.pipe()
+		pipes.append((write_fd, encoders[dialect]))
+
+	aborted = threading.Event()
+	finished = Queue.Queue()
+	results = [{'load_db_url' : target['load_db_url'], 'table' : target['table'],
+				'rows' : None, 'error' : None} for target in targets]
+	failure = None
+	try:
+		__start_thread('writer', finished, __tee_to_pipes, query_db, query_str, pipes,
+					   PIPE_WRITE_BATCH, aborted, batch_bytes, written)
+		for i, (load_db, target, csv_params, null_string, options) in enumerate(loads):
+			__start_thread('reader-{0}'.format(i), finished, load_db.execute_import,
+						   target['table'], '/dev/fd/{fd}'.format(fd=read_fds[i]),
+						   target.get('append', False), csv_params, null_string,
+						   expected_rowcount=expected_rowcount, abort_event=aborted, **options)
+
+		for _ in range(len(targets) + 1):
+			name, rows, exc_info = finished.get()
+			if name == 'writer':
+				if exc_info is not None:
+					failure = exc_info
+					logger.error("Replication writer thread failed.")
+				continue
+			i = int(name.split('-')[1])
+			if exc_info is None:
+				results[i]['rows'] = rows
+			else:
+				results[i]['error'] = exc_info[1]
+				logger.error("Load into {table} failed.".format(table=targets[i]['table']),
+							 exc_info=exc_info)
+				# Unblock the writer: its next write to this pipe fails with EPIPE.
+				os.close(read_fds.pop(i))
+	finally:
+		for read_fd in read_fds.values():
+			os.close(read_fd)
+
+	if failure is not None:
+		raise failure[0], failure[1], failure[2]
+
+	logger.info("Replication completed. Targets loaded: {count} of {total}.".format(
+				count=sum(1 for result in results if result['error'] is None), total=len(targets)))
+	return results
+
+
+def replicate_fanin(query_db_urls, load_db_url, query, table, append, query_is_file=False,
+					analyze=False, disable_indices=False, create_staging=True,
+					do_rowcount_check=False, batch_bytes=None, queue_depth=FANIN_QUEUE_DEPTH,
+					**kwargs):
+	""" Like :py:func:`replicate_threaded`, but the query runs against several databases,
+		e.g. the shards of a table, and their results are loaded together into table in a
+		single load: into "table_staging", followed by one swap, unless appending.
+
+		Every source is queried at once on a thread of its own, which encodes its batches
+		and queues them for one writer thread to write whole into the pipe to the loader.
+
+		**Unix only.**
+
+		:param query_db_urls: List of SQLAlchemy engine creation URLs of the sources.
+		:param load_db_url: SQLAlchemy engine creation URL for load_db.
+		:param query: SQL query string to execute against every source.
+		:param table: Table in database to load data from filename.
+		:param append: If True, any data already in the table will be preserved.
+		:param query_is_file: If True, the query argument is a filename.
+		:param analyze: If True, the table will be analyzed after loading.
+		:param disable_indices: If True, indices are dropped while loading.
+		:param create_staging: If False, "table_staging" must already exist.
+		:param do_rowcount_check: If True, the load only succeeds if it loaded as many rows
+					as the sources returned together.
+		:param batch_bytes: Byte budget for each batch fetched from a source.
+		:param queue_depth: Number of encoded batches queued for the writer, from all the
+					sources together, before they wait.
+		Kwargs:
+             Passed to the load, e.g. direct. The options in FAN_UNSUPPORTED_OPTIONS, a
+             copy_format other than 'csv', native_export and compression raise ValueError.
+
+		:returns: List of the number of rows queried from each source.
+
+	"""
+	logger.info("Beginning replication from {count} sources.".format(count=len(query_db_urls)))
+	__check_uncompressed(kwargs)
+	__check_fan_options(kwargs)
+
+	databases = {}
+	load_db = __get_shared_database(databases, load_db_url)
+	query_dbs = [__get_shared_database(databases, url) for url in query_db_urls]
+	csv_params = load_db.DEFAULT_CSV_PARAMS
+	null_string = load_db.DEFAULT_NULL_STRING
+	if query_is_file:
+		query_str = __file_to_str(query)
+	else:
+		query_str = query
+
+	# Rows queried from each source, filled in before the writer closes the pipe.
+	counts = {}
+	expected_rowcount = None
+	if do_rowcount_check:
+		expected_rowcount = lambda: sum(counts.values())
+
+	batches = Queue.Queue(queue_depth)
+	stop = threading.Event()
+	read_fd, write_fd = os.pipe()
+	aborted = threading.Event()
+	finished = Queue.Queue()
+	try:
+		for i, query_db in enumerate(query_dbs):
+			__start_thread('source-{0}'.format(i), finished, __query_to_queue, query_db,
+						   query_str, BatchEncoder(csv_params, null_string), PIPE_WRITE_BATCH,
+						   batch_bytes, batches, stop, counts, i)
+		__start_thread('writer', finished, __write_batches, batches, write_fd, len(query_dbs),
+					   stop, aborted)
+		__start_thread('reader', finished, load_db.execute_import, table,
+					   '/dev/fd/{fd}'.format(fd=read_fd), append, csv_params, null_string,
+					   analyze=analyze, disable_indices=disable_indices,
+					   create_staging=create_staging, expected_rowcount=expected_rowcount,
+					   abort_event=aborted, **kwargs)
+
+		failure = None
+		for _ in range(len(query_dbs) + 2):
+			name, _, exc_info = finished.get()
+			if exc_info is not None and failure is None:
+				failure = exc_info
+				logger.error("Replication {name} thread failed.".format(name=name))
+				if name == 'reader':
+					# Unblock the writer: its next write to the pipe fails with EPIPE.
+					stop.set()
+					os.close(read_fd)
+					read_fd = None
+	finally:
+		if read_fd is not None:
+			os.close(read_fd)
+
+	if failure is not None:
+		raise failure[0], failure[1], failure[2]
+
+	rowcounts = [counts[i] for i in range(len(query_dbs))]
+	for url, rowcount in zip(query_db_urls, rowcounts):
+		logger.info("Rows queried from {url}: {count}.".format(
+					url=repr(__make_url(url)), count=rowcount))
+	logger.info("Replication completed. Rows replicated: {count}.".format(count=sum(rowcounts)))
+	return rowcounts
+
+
+def replicate_chunked(query_db_url, load_db_url, query, table, append, chunk_by,
+					  chunks=REPLICATE_CHUNKS, method='fifo', query_is_file=False, analyze=False,
+					  checkpoint_key=None, max_attempts=MAX_WRITE_ATTEMPTS, retry_delay=RETRY_DELAY,
+					  **kwargs):
+	""" Replicates in chunks of a column, each committed on its own, so that a replication
+		that fails part way through can be started again from the last committed chunk.
+
+		The column is split into ranges, which are replicated in order by
+		:py:func:`replicate`, :py:func:`replicate_no_fifo` or :py:func:`replicate_threaded`
+		into "table_staging", or into table if appending. The largest value of the column
+		committed so far is saved with each chunk as a watermark (see watermark_column of
+		:py:func:`replicate`), which serves as the checkpoint. Once every chunk is in,
+		"table_staging" is swapped with table and the checkpoint is deleted.
+
+		Running the same replication again after a failure resumes after the checkpoint.
+		A failed chunk is retried, waiting twice as long after each failed attempt.
+
+		:param query_db_url: SQLAlchemy engine creation URL for query_db.
+		:param load_db_url: SQLAlchemy engine creation URL for load_db.
+		:param query: SQL query string to execute.
+		:param table: Table in database to load data from filename.
+		:param append: If True, any data already in the table will be preserved.
+		:param chunk_by: Column to split the results on, e.g. the primary key. Rows with a
+					NULL value are not replicated.
+		:param chunks: Number of ranges to split the column into, evenly between its
+					smallest and largest value.
+		:param method: 'fifo', 'no_fifo' or 'threaded', for the function replicating each chunk.
+		:param query_is_file: If True, the query argument is a filename.
+		:param analyze: If True, the table will be will be analyzed for 
+					query optimization once every chunk is in.
+		:param checkpoint_key: Name of the replication in the saved checkpoints. Defaults to
+					a hash of query_db_url, without the password, and of the query.
+		:param max_attempts: Number of times each chunk is attempted.
+		:param retry_delay: Seconds to wait after the first failed attempt of a chunk.
+		Kwargs:
+             Passed on to the function replicating each chunk, e.g. do_rowcount_check.
+             compression and compression_level are only passed to replicate_no_fifo, and
+             raise ValueError if set for another method.
+
+	"""
+	logger.info("Beginning chunked replication.")
+
+	replicate_chunk = {'fifo' : replicate, 'no_fifo' : replicate_no_fifo,
+					   'threaded' : replicate_threaded}[method]
+	if kwargs.get('merge'):
+		raise ValueError("Chunked replication cannot merge.")
+	compression_options = dict((option, kwargs.pop(option)) for option in COMPRESSION_OPTIONS
+							   if option in kwargs)
+	if method == 'no_fifo':
+		kwargs.update(compression_options)
+	elif any(value is not None for value in compression_options.values()):
+		raise ValueError("Only chunks replicated through temporary files, with the no_fifo "
+						 "method, are compressed.")
+
+	query_db = __get_database(query_db_url)
+	load_db = __get_database(load_db_url)
+	__check_native_export(load_db, kwargs.get('native_export'))
+	if query_is_file:
+		query_str = __file_to_str(query)
+	else:
+		query_str = query
+	if checkpoint_key is None:
+		checkpoint_key = 'chunked:' + __source_key(query_db_url, query_str)
+
+	if append:
+		target = table
+	else:
+		target = table + '_staging'
+	checkpoint = load_db.get_watermark(target, checkpoint_key)
+	if checkpoint is not None:
+		logger.info("Resuming replication into {target} after {column} = {mark}.".format(
+					target=target, column=checkpoint[0], mark=checkpoint[1]))
+	elif not append:
+		with load_db.get_import_engine().begin() as connection:
+			load_db.create_staging(connection, table, target)
+
+	boundaries = __split_range(query_db.get_query_range(query_str, chunk_by), chunks)
+	for i, upper in enumerate(list(boundaries) + [None]):
+		if upper is None:
+			chunk_query = query_str
+		else:
+			chunk_query = CHUNK_QUERY.format(query=query_str, column=chunk_by,
+											 upper=__sql_literal(upper))
+		logger.info("Replicating chunk {i} of {count}.".format(i=i + 1, count=len(boundaries) + 1))
+		for attempt in range(max_attempts):
+			try:
+				replicate_chunk(query_db_url, load_db_url, chunk_query, target, True,
+								watermark_column=chunk_by, watermark_key=checkpoint_key, **kwargs)
+				break
+			except Exception:
+				if attempt + 1 == max_attempts:
+					raise
+				delay = min(retry_delay * 2 ** attempt, MAX_RETRY_DELAY)
+				logger.warning("Chunk {i} failed, retrying in {delay} seconds.".format(
+							   i=i + 1, delay=delay), exc_info=True)
+				time.sleep(delay)
+
+	with load_db.get_import_engine().begin() as connection:
+		if analyze:
+			connection.execute(load_db.ANALYZE_CMD.format(table=target))
+		if not append:
+			load_db.swap_staging(connection, table, target)
+		load_db.delete_watermark(connection, target, checkpoint_key)
+
+	logger.info("Chunked replication completed.")
+
+
+def sync(query_db_url, load_db_url, table, source_table=None, key=None, chunks=SYNC_CHUNKS,
+		 **kwargs):
+	""" Makes table match source_table by copying only the ranges of rows that differ.
+
+		The key column is split into ranges, and each range is checksummed on both databases
+		by SQL run on the server (see :py:meth:`dbio.databases.base.Exportable.get_chunk_checksum`).
+		The rows of a range whose row count or checksum differ are deleted from table and
+		copied again from source_table, in one transaction per range, with
+		:py:func:`replicate_threaded`. Ranges are compared and copied one after another, so
+		changes made to source_table meanwhile may be missed until the next sync.
+
+		**Unix only.**
+
+		:param query_db_url: SQLAlchemy engine creation URL for the source database.
+		:param load_db_url: SQLAlchemy engine creation URL for the database of table.
+		:param table: The table to bring up to date.
+		:param source_table: The table to copy from, with the same columns. Defaults to table.
+		:param key: Column to split the tables on. Defaults to the primary key of table,
+					which must then be a single column.
+		:param chunks: Number of ranges to split the key into, evenly between its smallest
+					and largest value in both tables.
+		Kwargs:
+             Passed on to :py:func:`replicate_threaded`, e.g. direct.
+
+		:returns: Dictionary of the number of 'chunks' compared, the number 'changed' and
+					copied, and the size of the rows as text in the copied and the skipped
+					ranges, 'bytes_copied' and 'bytes_saved'.
+
+	"""
+	logger.info("Beginning sync.")
+
+	databases = {}
+	query_db = __get_shared_database(databases, query_db_url)
+	load_db = __get_shared_database(databases, load_db_url)
+	if source_table is None:
+		source_table = table
+
+	import sqlalchemy.engine.reflection
+	inspector = sqlalchemy.engine.reflection.Inspector.from_engine(load_db.get_import_engine())
+	columns = [column['name'] for column in inspector.get_columns(table)]
+	if key is None:
+		primary_key = inspector.get_pk_constraint(table)['constrained_columns']
+		if len(primary_key) != 1:
+			raise ValueError(table + " has no single column primary key, the key must be given.")
+		key = primary_key[0]
+
+	values = []
+	for db, name in ((query_db, source_table), (load_db, table)):
+		values.extend(value for value in db.get_query_range('SELECT * FROM ' + name, key)
+					  if value is not None)
+	if values:
+		boundaries = __split_range((min(values), max(values)), chunks)
+	else:
+		boundaries = []
+
+	stats = {'chunks' : 0, 'changed' : 0, 'bytes_copied' : 0, 'bytes_saved' : 0}
+	for predicate in __range_predicates(key, boundaries):
+		stats['chunks'] += 1
+		source_rowcount, source_checksum, source_bytes = query_db.get_chunk_checksum(
+			source_table, columns, predicate)
+		rowcount, checksum, _ = load_db.get_chunk_checksum(table, columns, predicate)
+		if (source_rowcount, source_checksum) == (rowcount, checksum):
+			stats['bytes_saved'] += source_bytes
+			continue
+
+		logger.info("Copying {predicate}: {rowcount} rows in {table}, {source_rowcount} "
+					"in {source_table}.".format(predicate=predicate, rowcount=rowcount,
+					table=table, source_rowcount=source_rowcount, source_table=source_table))
+		replicate_threaded(query_db_url, load_db_url,
+						   SYNC_QUERY.format(columns=', '.join(columns), table=source_table,
+											 predicate=predicate),
+						   table, True, replace_where=predicate, **kwargs)
+		stats['changed'] += 1
+		stats['bytes_copied'] += source_bytes
+
+	logger.info("Sync completed. Chunks scanned: {chunks}, changed: {changed}, bytes copied: "
+				"{bytes_copied}, bytes saved: {bytes_saved}.".format(**stats))
+	return stats
+
+
+def __query_partitioned(db, query_str, filename, column, parallel, partitions, boundaries,
+						shard_files, batch_size, csv_params, null_string, compression,
+						compression_level, batch_bytes, pipeline_depth, native_export,
+						copy_format, column_types):
+	if boundaries is None:
+		boundaries = __split_range(db.get_query_range(query_str, column), partitions)
+
+	shards = []
+	for i, predicate in enumerate(__range_predicates(column, boundaries)):
+		shard_query = PARTITION_QUERY.format(query=query_str, predicate=predicate)
+		shards.append((shard_query, '{filename}.{i:04d}'.format(filename=filename, i=i)))
+
+	def query_shard(shard):
+		shard_query, shard_name = shard
+		with open_file(shard_name, 'wb', compression, compression_level) as f:
+			return __write_query_results(db, shard_query, f, batch_size, csv_params, null_string,
+										 batch_bytes, pipeline_depth, native_export, copy_format,
+										 column_types)
+
+	logger.info("Querying {count} partitions of {column} on {parallel} connections.".format(
+				count=len(shards), column=column, parallel=parallel))
+	pool = ThreadPool(parallel)
+	try:
+		rowcounts = pool.map(query_shard, shards)
+
+		for (_, shard_name), rowcount in zip(shards, rowcounts):
+			logger.info("Rows written to {shard}: {count}.".format(shard=shard_name, count=rowcount))
+
+		# Every codec allows concatenating compressed streams.
+		if not shard_files:
+			with open(filename, 'wb') as f:
+				for _, shard_name in shards:
+					with open(shard_name, 'rb') as shard_file:
+						shutil.copyfileobj(shard_file, f, COPY_BUFFER_SIZE)
+	finally:
+		pool.close()
+		if not shard_files:
+			for _, shard_name in shards:
+				if os.path.exists(shard_name):
+					os.remove(shard_name)
+
+	rows_written = sum(rowcounts)
+	logger.info("Query to csv completed. Rows written: {count}.".format(count=rows_written))
+	return rows_written
+
+
+def __incremental_query(query_db, load_db, query_db_url, query_str, table, append, column, key):
+	""" Narrows query_str to the rows past the saved watermark of table, up to the largest
+		value of column found now, so that rows arriving during the replication are left for
+		the next one.
+
+		:returns: (query, watermark) to replicate and save, or (None, None) if no rows are new.
+
+	"""
+	if not append:
+		raise ValueError("Incremental replication appends or merges the rows into the table, "
+						 "append or merge must be True.")
+	if key is None:
+		key = __source_key(query_db_url, query_str)
+
+	saved = load_db.get_watermark(table, key)
+	predicates = []
+	if saved is not None:
+		saved_column, mark = saved
+		if saved_column != column:
+			raise ValueError("The watermark of {table} is on {saved}, not {column}.".format(
+							 table=table, saved=saved_column, column=column))
+		predicates.append('{column} > {mark}'.format(column=column, mark=mark))
+		logger.info("Replicating rows of {table} past {column} = {mark}.".format(
+					table=table, column=column, mark=mark))
+		new_rows = PARTITION_QUERY.format(query=query_str, predicate=predicates[0])
+	else:
+		new_rows = query_str
+
+	upper = query_db.get_query_range(new_rows, column)[1]
+	if upper is None:
+		logger.info("No new rows to replicate into {table}.".format(table=table))
+		return None, None
+
+	mark = __sql_literal(upper)
+	predicates.append('{column} <= {mark}'.format(column=column, mark=mark))
+	return (PARTITION_QUERY.format(query=query_str, predicate=' AND '.join(predicates)),
+			{'key' : key, 'column' : column, 'mark' : mark})
+
+
+def __source_key(query_db_url, query_str):
+	# The URL's repr hides the password.
+	return hashlib.sha1(repr(__make_url(query_db_url)) + '\n' +
+						query_str).hexdigest()
+
+
+def __range_predicates(column, boundaries):
+	""" SQL conditions splitting column into the ranges starting at each boundary. Rows with
+		a NULL value go with the first range. """
+	predicates = []
+	lower = None
+	for upper in list(boundaries) + [None]:
+		if lower is None and upper is None:
+			predicate = '1 = 1'
+		elif lower is None:
+			predicate = '({column} < {upper} OR {column} IS NULL)'
+		elif upper is None:
+			predicate = '{column} >= {lower}'
+		else:
+			predicate = '{column} >= {lower} AND {column} < {upper}'
+		predicates.append(predicate.format(column=column, lower=__sql_literal(lower),
+										   upper=__sql_literal(upper)))
+		lower = upper
+	return predicates
+
+
+def __split_range(value_range, partitions):
+	""" Boundaries splitting value_range into evenly sized ranges. Works for anything that
+		supports subtraction and scaling, i.e. numbers, dates and times. """
+	lower, upper = value_range
+	if lower is None:
+		return []
+	try:
+		boundaries = [lower + (upper - lower) * i / partitions for i in range(1, partitions)]
+	except TypeError:
+		raise ValueError("Cannot split a column of {type} into ranges, "
+						 "pass explicit boundaries instead.".format(type=type(lower).__name__))
+	return sorted(set(boundary for boundary in boundaries if boundary > lower))
+
+
+def __sql_literal(value):
+	if isinstance(value, float):
+		return repr(value)
+	if value is None or isinstance(value, (int, long, decimal.Decimal)):
+		return str(value)
+	return "'" + str(value).replace("'", "''") + "'"
+
+
+def __tee_to_pipes(db, query_str, pipes, batch_size, aborted, batch_bytes=None, written=None):
+	""" Writes the results of a query to several pipes, given as (write_fd, encoder) pairs.
+		Each batch is encoded once per encoder. A pipe whose reader has gone is dropped. """
+	files = dict((i, os.fdopen(write_fd, 'wb')) for i, (write_fd, _) in enumerate(pipes))
+	encoders = [encoder for _, encoder in pipes]
+
+	def write(encode=None):
+		# Without encode, flushes the pipes.
+		encoded = {}
+		for i, f in files.items():
+			encoder = encoders[i]
+			try:
+				if encode is None:
+					f.flush()
+					continue
+				if id(encoder) not in encoded:
+					encoded[id(encoder)] = encode(encoder)
+				f.write(encoded[id(encoder)])
+			except IOError as e:
+				if e.errno != errno.EPIPE:
+					raise
+				logger.warning("Target {i} stopped reading, no longer writing to it.".format(i=i))
+				del files[i]
+				__close_quietly(f)
+		return max(len(data) for data in encoded.values()) if encoded else 0
+
+	if batch_bytes is not None:
+		sizer = BatchSizer(batch_bytes)
+		batch_size = sizer.rows
+	else:
+		sizer = None
+
+	connection = db.get_export_engine().connect()
+	try:
+		results = connection.execution_options(stream_results=True,
+											   max_row_buffer=batch_size).execute(query_str)
+		rows_written = 0
+		try:
+			write(lambda encoder: encoder.header)
+			rows = results.fetchmany(batch_size)
+			while rows and files:
+				num_bytes = write(lambda encoder: encoder.encode(rows))
+				rows_written += len(rows)
+				if sizer is not None:
+					batch_size = __resize_batch(results, sizer, len(rows), num_bytes)
+				rows = results.fetchmany(batch_size)
+			write(lambda encoder: encoder.trailer)
+		finally:
+			results.close()
+		write()
+		if written is not None:
+			written['rows'] = rows_written
+	except:
+		# Must be flagged before the pipes close, so the loaders see it once they reach EOF.
+		aborted.set()
+		raise
+	finally:
+		connection.close()
+		for f in files.values():
+			__close_quietly(f)
+	logger.info("Rows written to {count} targets: {rows}.".format(count=len(pipes),
+				rows=rows_written))
+	return rows_written
+
+
+def __query_to_queue(db, query_str, encoder, batch_size, batch_bytes, batches, stop, counts, i):
+	""" Queues the encoded batches of a query's results, then None. Stops early once stop
+		is set. The number of rows is saved as counts[i] if the query completes. """
+	if batch_bytes is not None:
+		sizer = BatchSizer(batch_bytes)
+		batch_size = sizer.rows
+	else:
+		sizer = None
+
+	rows_written = 0
+	connection = db.get_export_engine().connect()
+	try:
+		results = connection.execution_options(stream_results=True,
+											   max_row_buffer=batch_size).execute(query_str)
+		try:
+			rows = results.fetchmany(batch_size)
+			while rows and not stop.is_set():
+				data = encoder.encode(rows)
+				batches.put(data)
+				rows_written += len(rows)
+				if sizer is not None:
+					batch_size = __resize_batch(results, sizer, len(rows), len(data))
+				rows = results.fetchmany(batch_size)
+		finally:
+			results.close()
+		counts[i] = rows_written
+	except:
+		stop.set()
+		raise
+	finally:
+		connection.close()
+		batches.put(None)
+	return rows_written
+
+
+def __write_batches(batches, write_fd, sources, stop, aborted):
+	""" Writes queued batches to the pipe until each of the sources has queued None. Once
+		stop is set, batches are only drained, and the load is aborted. """
+	f = os.fdopen(write_fd, 'wb')
+	try:
+		while sources:
+			data = batches.get()
+			if data is None:
+				sources -= 1
+			elif not stop.is_set():
+				f.write(data)
+		if stop.is_set():
+			aborted.set()
+		f.flush()
+	except:
+		# Must be flagged before the pipe closes, so the loader sees it once it reaches EOF.
+		stop.set()
+		aborted.set()
+		while sources:
+			if batches.get() is None:
+				sources -= 1
+		raise
+	finally:
+		__close_quietly(f)
+
+
+def __replicate_spooled(query_db, load_db, query_str, table, append, analyze, disable_indices,
+						create_staging, do_rowcount_check, compression, compression_level,
+						batch_bytes, pipeline_depth, native_export, copy_format, column_types,
+						watermark, segment_bytes, max_segments, timings=None, profile=None,
+						**kwargs):
+	csv_params = load_db.DEFAULT_CSV_PARAMS
+	null_string = load_db.DEFAULT_NULL_STRING
+
+	# Filled in by the writer before it marks the end of the spool.
+	written = {}
+	expected_rowcount = None
+	if do_rowcount_check:
+		expected_rowcount = lambda: written['rows']
+
+	spool_dir = tempfile.mkdtemp(prefix='dbio_spool_')
+	aborted = threading.Event()
+	stopped = threading.Event()
+	finished = Queue.Queue()
+	replication_timings = Timings()
+	try:
+		__start_thread('writer', finished, profiled, profile_path(profile, 'query'),
+					   __write_to_spool, query_db, query_str, spool_dir, csv_params,
+					   null_string, aborted, stopped, compression, compression_level,
+					   segment_bytes, max_segments, batch_bytes, pipeline_depth, native_export,
+					   copy_format, column_types, written,
+					   timings=replication_timings.for_side('query'))
+		# Segments are decompressed by the reader, so the loader is given plain data.
+		__start_thread('reader', finished, profiled, profile_path(profile, 'load'),
+					   load_db.execute_import, table, SpoolReader(spool_dir, compression),
+					   append, csv_params, null_string, analyze=analyze,
+					   disable_indices=disable_indices, create_staging=create_staging,
+					   expected_rowcount=expected_rowcount, abort_event=aborted,
+					   copy_format=copy_format, watermark=watermark,
+					   timings=replication_timings.for_side('load'), **kwargs)
+
+		failure = None
+		for _ in range(2):
+			name, _, exc_info = finished.get()
+			if exc_info is not None and failure is None:
+				failure = exc_info
+				logger.error("Replication {name} thread failed.".format(name=name))
+				if name == 'reader':
+					# Unblock the writer if it is waiting for segments to be read.
+					stopped.set()
+	finally:
+		shutil.rmtree(spool_dir, ignore_errors=True)
+		__add_timings(timings, replication_timings)
+
+	if failure is not None:
+		raise failure[0], failure[1], failure[2]
+	__log_timings('Replication', replication_timings)
+	return written['rows']
+
+
+def __write_to_spool(db, query_str, spool_dir, csv_params, null_string, aborted, stopped,
+					 compression, compression_level, segment_bytes, max_segments,
+					 batch_bytes=None, pipeline_depth=None, native_export=False,
+					 copy_format='csv', column_types=None, written=None, timings=None):
+	f = SpoolWriter(spool_dir, segment_bytes, max_segments, compression, compression_level,
+					stopped)
+	try:
+		rows_written = __write_query_results(db, query_str, f, PIPE_WRITE_BATCH, csv_params,
+											 null_string, batch_bytes, pipeline_depth,
+											 native_export, copy_format, column_types,
+											 timings=timings)
+		written['rows'] = rows_written
+	except:
+		# Flagged before the spool is marked failed, like __write_to_pipe.
+		aborted.set()
+		f.abort()
+		raise
+	f.close()
+	return rows_written
+
+
+def __set_pipe_size(fd, size):
+	""" Enlarges the buffer of the pipe fd to at least size bytes, where Linux allows it.
+		:returns: The size of the buffer, or None if it is unknown. """
+	if not sys.platform.startswith('linux'):
+		logger.warning("Pipe sizes can only be set on Linux.")
+		return None
+	# Unix only, so imported here rather than with the other modules.
+	import fcntl
+	try:
+		fcntl.fcntl(fd, F_SETPIPE_SZ, size)
+	except IOError as e:
+		# EPERM above /proc/sys/fs/pipe-max-size without CAP_SYS_RESOURCE, or EBUSY if the
+		# pipe holds more than the new size.
+		logger.warning("Could not set the pipe size to {size} bytes: {error}".format(
+					   size=size, error=e))
+	actual = fcntl.fcntl(fd, F_GETPIPE_SZ)
+	logger.debug("Pipe size: {size} bytes.".format(size=actual))
+	return actual
+
+
+def __close_quietly(f):
+	try:
+		f.close()
+	except IOError:
+		pass
+
+
+def __write_to_pipe(db, query_str, write_fd, batch_size, csv_params, null_string, aborted,
+					batch_bytes=None, pipeline_depth=None, native_export=False, copy_format='csv',
+					column_types=None, written=None, timings=None):
+	f = os.fdopen(write_fd, 'wb')
+	try:
+		rows_written = __write_query_results(db, query_str, f, batch_size, csv_params, null_string,
+											 batch_bytes, pipeline_depth, native_export, copy_format,
+											 column_types, timings=timings)
+		f.flush()
+		if written is not None:
+			written['rows'] = rows_written
+	except:
+		# Must be flagged before the pipe closes, so the loader sees it once it reaches EOF.
+		aborted.set()
+		try:
+			f.close()
+		except IOError:
+			pass
+		raise
+	f.close()
+	return rows_written
+
+
+def __write_query_results(db, query_str, f, batch_size, csv_params, null_string,
+						  batch_bytes=None, pipeline_depth=None, native_export=False,
+						  copy_format='csv', column_types=None, connection=None, timings=None):
+	if native_export:
+		with phase(timings, 'transfer'):
+			return db.execute_export(query_str, f, csv_params, null_string,
+									 copy_format=copy_format, connection=connection)
+
+	if batch_bytes is not None:
+		sizer = BatchSizer(batch_bytes)
+		batch_size = sizer.rows
+	else:
+		sizer = None
+
+	if connection is None:
+		with phase(timings, 'connect'):
+			connection = db.get_export_engine().connect()
+
+	# Streaming cursors return from execute() before the query has produced anything, so
+	# the first fetch counts towards the query's time rather than the transfer's.
+	with phase(timings, 'first_row'):
+		# Stream results with given buffer size. Currently only used by pyscopg2.
+		results = (connection.execution_options(stream_results=True,
+					max_row_buffer=batch_size)).execute(query_str)
+		try:
+			rows = None if pipeline_depth else results.fetchmany(batch_size)
+		except:
+			results.close()
+			raise
+
+	rows_written = 0
+	try:
+		with phase(timings, 'transfer'):
+			if copy_format == 'binary':
+				encoder = BinaryCopyEncoder(column_types)
+			else:
+				encoder = BatchEncoder(csv_params, null_string)
+			f.write(encoder.header)
+
+			if pipeline_depth:
+				rows_written = __write_pipelined(results, f, batch_size, encoder, sizer,
+												 pipeline_depth)
+			else:
+				while rows:
+					data = encoder.encode(rows)
+					f.write(data)
+					rows_written += len(rows)
+					if sizer is not None:
+						batch_size = __resize_batch(results, sizer, len(rows), len(data))
+					rows = results.fetchmany(batch_size)
+
+			f.write(encoder.trailer)
+	finally:
+		results.close()
+
+	return rows_written
+
+
+def __add_timings(timings, operation_timings):
+	if timings is not None:
+		timings.phases.extend(operation_timings.phases)
+
+
+def __log_timings(operation, timings):
+	if timings.phases:
+		logger.info("{operation} phases: {phases}.".format(operation=operation,
+														   phases=timings.format()))
+
+
+def __write_rowcount(filename, rowcount):
+	with open(filename, 'w') as f:
+		f.write(str(rowcount))
+
+
+def __resize_batch(results, sizer, num_rows, num_bytes):
+	batch_size = sizer.update(num_rows, num_bytes)
+	# Let the streaming cursor buffer follow the budget too.
+	if hasattr(results, '_max_row_buffer'):
+		results._max_row_buffer = batch_size
+	return batch_size
+
+
+def __write_pipelined(results, f, batch_size, encoder, sizer, depth):
+	""" Fetches and encodes on two threads of their own while the calling thread writes.
+		Each stage hands batches to the next through a queue holding at most depth of them. """
+	fetched = Queue.Queue(depth)
+	encoded = Queue.Queue(depth)
+	stop = threading.Event()
+	timings = {}
+	state = {'batch_size' : batch_size, 'rows_written' : 0}
+
+	def fetch(_):
+		return results.fetchmany(state['batch_size']) or None
+
+	def encode(rows):
+		data = encoder.encode(rows)
+		if sizer is not None:
+			state['batch_size'] = __resize_batch(results, sizer, len(rows), len(data))
+		return len(rows), data
+
+	def write(batch):
+		num_rows, data = batch
+		f.write(data)
+		state['rows_written'] += num_rows
+		return num_rows
+
+	finished = Queue.Queue()
+	__start_thread('fetch', finished, __run_stage, 'fetch', fetch, None, fetched, stop, timings)
+	__start_thread('encode', finished, __run_stage, 'encode', encode, fetched, encoded, stop,
+				   timings)
+	try:
+		__run_stage('write', write, encoded, None, stop, timings)
+	finally:
+		# The stages shut each other down on failure, so both threads always finish.
+		failure = None
+		for _ in range(2):
+			_, _, exc_info = finished.get()
+			if exc_info is not None and failure is None:
+				failure = exc_info
+
+	if failure is not None:
+		raise failure[0], failure[1], failure[2]
+
+	logger.info("Export stage busy/idle seconds: " + ', '.join(
+		'{name} {busy:.2f}/{idle:.2f}'.format(name=name, busy=timings[name][0],
+											   idle=timings[name][1])
+		for name in ('fetch', 'encode', 'write')))
+	return state['rows_written']
+
+
+def __run_stage(name, work, inbox, outbox, stop, timings):
+	""" Calls work on each batch taken from inbox and puts the result in outbox, until a
+		None batch marks the end. Without an inbox, work is called until it returns None.
+
+		When stop is set, by this or another stage failing, the stage ends early, and still
+		marks the end of its outbox and drains its inbox so that no other stage stays blocked.
+		Time spent working and time spent waiting on the queues go into timings[name].
+
+	"""
+	busy = idle = 0.0
+	try:
+		while not stop.is_set():
+			start = time.time()
+			if inbox is not None:
+				item = inbox.get()
+				if item is None:
+					inbox = None
+					break
+			else:
+				item = None
+			ready = time.time()
+			result = work(item)
+			done = time.time()
+			if result is None:
+				break
+			if outbox is not None:
+				outbox.put(result)
+			busy += done - ready
+			idle += (ready - start) + (time.time() - done)
+	except:
+		stop.set()
+		raise
+	finally:
+		timings[name] = (busy, idle)
+		if outbox is not None:
+			outbox.put(None)
+		while inbox is not None and inbox.get() is not None:
+			pass
+
+
+def __supervise_processes(processes):
+	""" Blocks until every process has exited, killing the others as soon as one fails.
+		Each process is waited on by its own thread, so nothing spins while they run. """
+	finished = Queue.Queue()
+	for name, process in processes.items():
+		__start_thread(name, finished, __wait_for_process, process)
+
+	usage = {}
+	failed = None
+	try:
+		for _ in processes:
+			name, process_usage, exc_info = finished.get()
+			if exc_info is not None:
+				raise exc_info[0], exc_info[1], exc_info[2]
+			usage[name] = process_usage
+			logger.info("{name} process exited with {returncode}: cpu time {cpu_time:.2f}s, "
+						"max rss {max_rss}.".format(name=name, **process_usage))
+			if process_usage['returncode'] != os.EX_OK and failed is None:
+				failed = name
+				__kill_running(processes.values())
+	finally:
+		# Ensure no processes are orphaned
+		__kill_running(processes.values())
+
+	if failed is not None:
+		raise RuntimeError('Failure inside a database reader/writer process')
+	return usage
+
+
+def __wait_for_process(process):
+	while True:
+		try:
+			_, status, rusage = os.wait4(process.pid, 0)
+			break
+		except OSError as e:
+			if e.errno != errno.EINTR:
+				raise
+
+	if os.WIFSIGNALED(status):
+		process.returncode = -os.WTERMSIG(status)
+	else:
+		process.returncode = os.WEXITSTATUS(status)
+
+	return {'returncode' : process.returncode,
+			'cpu_time' : rusage.ru_utime + rusage.ru_stime,
+			'max_rss' : rusage.ru_maxrss}
+
+
+def __kill_running(processes):
+	for process in processes:
+		if process.returncode is None:
+			try:
+				process.kill()
+			except OSError as e:
+				# Exited between the check and the kill.
+				if e.errno != errno.ESRCH:
+					raise
+
+
+def __start_thread(name, finished, target, *args, **kwargs):
+	""" Runs target on a daemon thread. (name, return value, exc_info) is put on the
+		finished queue when it returns, with exc_info set to None on success. """
+	def run():
+		try:
+			result = target(*args, **kwargs)
+		except:
+			finished.put((name, None, sys.exc_info()))
+		else:
+			finished.put((name, result, None))
+
+	thread = threading.Thread(target=run, name='dbio-' + name)
+	thread.daemon = True
+	thread.start()
+	return thread
+
+
+def __binary_column_types(load_db, table, copy_format, native_export):
+	# Without native export, binary fields are encoded by dbio for the target columns.
+	if copy_format == 'binary' and not native_export:
+		return load_db.get_table_column_types(table)
+	return None
+
+
+def __check_copy_format(db, copy_format, native_export=True):
+	# Loads and native exports are handled by the database, other exports by dbio.
+	if native_export and copy_format not in db.COPY_FORMATS:
+		raise ValueError("{db} does not support the {format} format.".format(
+						 db=db.__class__.__name__, format=copy_format))
+	if copy_format not in COPY_FORMATS:
+		raise ValueError(copy_format + " is an unsupported format.")
+
+
+def __check_native_export(load_db, native_export):
+	# Values are formatted by the query database, and only PostgreSQL reads them back as is.
+	if native_export and not load_db.LOADS_NATIVE_EXPORT:
+		raise ValueError("{db} cannot load a native export, which is only replicated between "
+						 "PostgreSQL databases.".format(db=load_db.__class__.__name__))
+
+
+def __check_uncompressed(kwargs):
+	# Pipes are loaded as they are written, so there is no file to compress.
+	if any(kwargs.get(option) is not None for option in COMPRESSION_OPTIONS):
+		raise ValueError("Replication through a pipe is not compressed. Only replicate_no_fifo "
+						 "compresses its temporary file.")
+
+
+def __check_fan_options(kwargs):
+	# Every row is queried and encoded as CSV by the fan threads, and loaded as is.
+	unsupported = [option for option in FAN_UNSUPPORTED_OPTIONS if kwargs.get(option) is not None]
+	if kwargs.get('copy_format', 'csv') != 'csv':
+		unsupported.append('copy_format')
+	if kwargs.get('native_export'):
+		unsupported.append('native_export')
+	if unsupported:
+		raise ValueError("Replication to several targets or from several sources does not "
+						 "support {options}.".format(options=', '.join(unsupported)))
 
 
 def __file_to_str(fname):
@@ -279,21 +1843,67 @@ def __append_csv_args(args, csv_params, null_string):
 	args.append(csv_params['lineterminator'])
 	args.append('-e')
 	args.append(csv_params['encoding'])
-	if csv_params['quoting'] == unicodecsv.QUOTE_ALL:
+	if csv_params['quoting'] == csv.QUOTE_ALL:
 		args.append('-qc')
 		args.append(csv_params['quotechar'])
 
 
+@contextlib.contextmanager
+def shared_databases():
+	""" Within this context, operations on the same URL share one database object instead
+		of each creating its own. Engines and their connection pools are shared by URL in
+		any case (see :py:mod:`dbio.databases.engines`). Used by
+		:py:func:`dbio.jobs.run_jobs`, whose jobs run on threads of one process. """
+	with __shared_lock:
+		nested = __shared['databases'] is not None
+		if not nested:
+			__shared['databases'] = {}
+	try:
+		yield
+	finally:
+		if not nested:
+			with __shared_lock:
+				__shared['databases'] = None
+
+
+# Database objects by URL while in shared_databases(), otherwise None.
+__shared = {'databases' : None}
+__shared_lock = threading.Lock()
+
+
 def __get_database(url):
-	sqla_url = sqlalchemy.engine.url.make_url(url)
+	with __shared_lock:
+		databases = __shared['databases']
+		if databases is not None and url in databases:
+			return databases[url]
+	db = __create_database(url)
+	if databases is not None:
+		with __shared_lock:
+			db = databases.setdefault(url, db)
+	return db
+
+
+def __create_database(url):
+	sqla_url = __make_url(url)
 	dialect = sqla_url.get_backend_name()
 	driver = sqla_url.get_driver_name()
 	try:
-		db_class = dialect_driver_class_map[dialect][driver]
+		db_class = get_backend(dialect, driver)
 	except KeyError as e:
-		raise UnsupportedDatabaseError(e.message + " is an unsupported dialect or driver.")
+		raise UnsupportedDatabaseError(e.args[0] + " is an unsupported dialect or driver.")
 	return db_class(url)
 
 
+def __make_url(url):
+	import sqlalchemy.engine.url
+	return sqlalchemy.engine.url.make_url(url)
+
+
+def __get_shared_database(databases, url):
+	if url not in databases:
+		databases[url] = __get_database(url)
+	return databases[url]
+
+
 class UnsupportedDatabaseError(Exception):
 	pass
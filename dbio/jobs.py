@@ -0,0 +1,277 @@
+# Python standard library
+import json
+import logging
+import threading
+import time
+
+# Local modules
+import io
+from databases.engines import configure_engines
+from timing import Timings
+
+""" Runs a manifest of query, load, replicate and sync jobs on a pool of threads of one
+	process. Jobs share one database object, and so one set of connection pools, per URL,
+	may wait for other jobs to succeed, and are limited in how many run at once against
+	the same database. A failed job only stops the jobs depending on it. """
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+DEFAULT_WORKERS = 4
+
+OPERATIONS = ('query', 'snapshot', 'load', 'replicate', 'sync')
+
+# Functions replicating with each method, see replicate_chunked.
+REPLICATE_METHODS = {
+	'threaded' : io.replicate_threaded,
+	'fifo' : io.replicate,
+	'no_fifo' : io.replicate_no_fifo
+}
+
+# Keys of a job that are not arguments of its operation.
+JOB_KEYS = ('name', 'operation', 'depends_on', 'method')
+
+# Operations that record their phases with a timings argument.
+TIMED_FUNCTIONS = (io.query, io.load, io.replicate, io.replicate_threaded, io.replicate_no_fifo)
+
+# Arguments of the operations that name a database.
+URL_ARGS = ('sqla_url', 'query_db_url', 'load_db_url')
+
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+
+
+def load_manifest(filename):
+	""" Reads a manifest of jobs, e.g.::
+
+			workers: 8
+			limits:
+			  "mysql://reader@source/prod": 2
+			engines:
+			  pool_size: 4
+			  pool_pre_ping: true
+			jobs:
+			  - name: accounts
+			    operation: replicate
+			    query_db_url: "mysql://reader@source/prod"
+			    load_db_url: "postgresql://writer@warehouse/prod"
+			    query: SELECT * FROM accounts
+			    table: accounts
+			  - name: users
+			    operation: replicate
+			    depends_on: [accounts]
+			    ...
+
+		See :py:func:`run_jobs` for the keys of a job, and
+		:py:func:`dbio.databases.engines.configure_engines` for the engine options.
+
+		:param filename: YAML file, which requires the PyYAML package, or JSON file if the
+					name ends with '.json'.
+
+		:returns: The manifest as a dictionary.
+
+	"""
+	with open(filename, 'r') as f:
+		text = f.read()
+	if filename.endswith('.json'):
+		return json.loads(text)
+	try:
+		import yaml
+	except ImportError:
+		raise ImportError("YAML manifests require the PyYAML package. Install it, or write "
+						  "the manifest as JSON in a file ending with '.json'.")
+	return yaml.safe_load(text)
+
+
+def run_manifest(filename, workers=None):
+	""" Runs the jobs of a manifest file (see :py:func:`load_manifest`).
+
+		:param filename: Name of the manifest file.
+		:param workers: Number of jobs run at once. Defaults to the manifest's 'workers',
+					or DEFAULT_WORKERS.
+
+		:returns: The results of :py:func:`run_jobs`.
+
+	"""
+	manifest = load_manifest(filename)
+	if workers is None:
+		workers = manifest.get('workers', DEFAULT_WORKERS)
+	if 'engines' in manifest:
+		configure_engines(**manifest['engines'])
+	return run_jobs(manifest['jobs'], workers, manifest.get('limits'))
+
+
+def run_jobs(jobs, workers=DEFAULT_WORKERS, limits=None):
+	""" Runs jobs on a pool of threads, starting each in the order given once the jobs it
+		depends on have succeeded.
+
+		:param jobs: List of dictionaries with the keys:
+					'name': Unique name of the job.
+					'operation': 'query', 'snapshot', 'load', 'replicate' or 'sync'.
+					'depends_on': Optional list of the names of jobs listed before this one
+					that must succeed first. If one of them fails, this job is skipped.
+					'method': For replicate, 'threaded' (the default), 'fifo' or 'no_fifo'.
+					Any other key is a keyword argument of the function of the operation in
+					:py:mod:`dbio.io`, e.g. query_db_url or append. append defaults to False.
+					Replicate jobs with chunk_by run :py:func:`dbio.io.replicate_chunked`.
+		:param workers: Number of jobs run at once.
+		:param limits: Dictionary of database URLs and the number of jobs that may run at
+					once against each of them. Other URLs are only limited by workers.
+
+		:returns: List of dictionaries, one for each job in order, with the 'name',
+				'operation', 'status' ('succeeded', 'failed' or 'skipped'), 'seconds' taken,
+				'rows' copied, if known, 'error' message of failed jobs, and the 'phases'
+				recorded by query, load and replicate jobs without chunk_by (see
+				:py:class:`dbio.timing.Timings`), otherwise None.
+
+	"""
+	__check_jobs(jobs)
+	limits = limits or {}
+	if any(limit < 1 for limit in limits.values()):
+		raise ValueError("Database limits must be at least 1.")
+	pending = list(jobs)
+	running = {}
+	results = {}
+	condition = threading.Condition()
+
+	def next_job():
+		# Called holding condition. Returns None once no job is left to start.
+		while pending:
+			for job in pending:
+				statuses = [results[name]['status'] if name in results else None
+							for name in job.get('depends_on', [])]
+				if FAILED in statuses or SKIPPED in statuses:
+					logger.warning("Skipping job {name}, a job it depends on did not "
+								   "succeed.".format(name=job['name']))
+					pending.remove(job)
+					results[job['name']] = __result(job, SKIPPED)
+					condition.notify_all()
+					break
+				urls = __job_urls(job)
+				if (all(status == SUCCEEDED for status in statuses) and
+						all(running.get(url, 0) < limits[url] for url in urls if url in limits)):
+					pending.remove(job)
+					for url in urls:
+						running[url] = running.get(url, 0) + 1
+					return job
+			else:
+				condition.wait()
+		return None
+
+	def work():
+		while True:
+			with condition:
+				job = next_job()
+			if job is None:
+				return
+			result = __run_job(job)
+			with condition:
+				results[job['name']] = result
+				for url in __job_urls(job):
+					running[url] -= 1
+				condition.notify_all()
+
+	with io.shared_databases():
+		threads = [threading.Thread(target=work, name='job-worker-{0}'.format(i))
+				   for i in range(max(1, min(workers, len(jobs))))]
+		for thread in threads:
+			thread.daemon = True
+			thread.start()
+		for thread in threads:
+			thread.join()
+
+	return [results[job['name']] for job in jobs]
+
+
+def format_summary(results):
+	""" :returns: A text table of the results of :py:func:`run_jobs`. """
+	lines = ['{0:<24} {1:<10} {2:<10} {3:>10} {4:>12} {5:>12}'.format(
+		'job', 'operation', 'status', 'seconds', 'rows', 'rows/s')]
+	for result in results:
+		rows = result['rows']
+		seconds = result['seconds']
+		if rows is None:
+			rows_text = rate_text = '-'
+		else:
+			rows_text = '{0:,}'.format(rows)
+			rate_text = '{0:,.0f}'.format(rows / seconds) if seconds else '-'
+		lines.append('{0:<24} {1:<10} {2:<10} {3:>10} {4:>12} {5:>12}'.format(
+			result['name'], result['operation'], result['status'],
+			'-' if seconds is None else '{0:.2f}'.format(seconds), rows_text, rate_text))
+	return '\n'.join(lines)
+
+
+def __check_jobs(jobs):
+	names = set()
+	for job in jobs:
+		if 'name' not in job or 'operation' not in job:
+			raise ValueError("Every job needs a name and an operation.")
+		if job['name'] in names:
+			raise ValueError("Job name {name} is used twice.".format(name=job['name']))
+		if job['operation'] not in OPERATIONS:
+			raise ValueError("Job {name} has an unknown operation {operation}.".format(
+							 name=job['name'], operation=job['operation']))
+		if job.get('method', 'threaded') not in REPLICATE_METHODS:
+			raise ValueError("Job {name} has an unknown method {method}.".format(
+							 name=job['name'], method=job['method']))
+		for name in job.get('depends_on', []):
+			# Jobs can only depend on those before them, which rules out cycles.
+			if name not in names:
+				raise ValueError("Job {name} depends on {other}, which is not listed "
+								 "before it.".format(name=job['name'], other=name))
+		names.add(job['name'])
+
+
+def __job_urls(job):
+	return sorted(set(job[arg] for arg in URL_ARGS if arg in job))
+
+
+def __result(job, status, seconds=None, rows=None, error=None, timings=None):
+	return {'name' : job['name'], 'operation' : job['operation'], 'status' : status,
+			'seconds' : seconds, 'rows' : rows, 'error' : error,
+			'phases' : None if timings is None else timings.phases}
+
+
+def __run_job(job):
+	kwargs = dict((key, value) for key, value in job.items() if key not in JOB_KEYS)
+	operation = job['operation']
+	if operation == 'query':
+		function = io.query
+	elif operation == 'snapshot':
+		function = io.query_snapshot
+	elif operation == 'sync':
+		function = io.sync
+	else:
+		kwargs.setdefault('append', False)
+		if operation == 'load':
+			function = io.load
+		elif 'chunk_by' in kwargs:
+			function = io.replicate_chunked
+			kwargs['method'] = job.get('method', 'threaded')
+		else:
+			function = REPLICATE_METHODS[job.get('method', 'threaded')]
+
+	timings = None
+	if function in TIMED_FUNCTIONS:
+		timings = Timings()
+		kwargs['timings'] = timings
+
+	logger.info("Starting job {name}.".format(name=job['name']))
+	start = time.time()
+	try:
+		returned = function(**kwargs)
+	except Exception as e:
+		logger.exception("Job {name} failed.".format(name=job['name']))
+		return __result(job, FAILED, time.time() - start, error=str(e), timings=timings)
+	seconds = time.time() - start
+	logger.info("Job {name} succeeded in {seconds:.2f} seconds.".format(name=job['name'],
+																		seconds=seconds))
+
+	# Operations return the number of rows, when they know it, or for snapshot a list of them.
+	if isinstance(returned, list):
+		returned = sum(returned)
+	rows = None
+	if isinstance(returned, (int, long)) and not isinstance(returned, bool) and returned >= 0:
+		rows = returned
+	return __result(job, SUCCEEDED, seconds, rows, timings=timings)
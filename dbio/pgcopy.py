@@ -0,0 +1,289 @@
+# Python standard library
+import datetime
+import decimal
+import json
+import struct
+import uuid
+
+""" Encoding of query results into the binary format of PostgreSQL's COPY, so that the server
+	does not have to parse text for numbers, timestamps or bytea. Each value is encoded
+	according to the type of the column it is loaded into, which must therefore be known. """
+
+HEADER = 'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)
+TRAILER = struct.pack('>h', -1)
+
+NULL_FIELD = struct.pack('>i', -1)
+
+# Day 0 of dates and timestamps.
+POSTGRES_EPOCH = datetime.datetime(2000, 1, 1)
+POSTGRES_EPOCH_DATE = POSTGRES_EPOCH.date()
+
+NUMERIC_POSITIVE = 0x0000
+NUMERIC_NEGATIVE = 0x4000
+NUMERIC_NAN = 0xC000
+
+__int2 = struct.Struct('>ih').pack
+__int4 = struct.Struct('>ii').pack
+__int8 = struct.Struct('>iq').pack
+__float4 = struct.Struct('>if').pack
+__float8 = struct.Struct('>id').pack
+__length = struct.Struct('>i').pack
+
+
+def __encode_bool(value):
+	return '\x00\x00\x00\x01\x01' if value else '\x00\x00\x00\x01\x00'
+
+
+def __encode_int2(value):
+	return __int2(2, value)
+
+
+def __encode_int4(value):
+	return __int4(4, value)
+
+
+def __encode_int8(value):
+	return __int8(8, value)
+
+
+def __encode_float4(value):
+	return __float4(4, value)
+
+
+def __encode_float8(value):
+	return __float8(8, value)
+
+
+def __encode_bytes(data):
+	return __length(len(data)) + data
+
+
+def __encode_text(value):
+	if isinstance(value, unicode):
+		value = value.encode('utf-8')
+	elif not isinstance(value, str):
+		value = str(value)
+	return __encode_bytes(value)
+
+
+def __encode_bytea(value):
+	return __encode_bytes(str(value))
+
+
+def __encode_json(value):
+	if not isinstance(value, basestring):
+		value = json.dumps(value)
+	return __encode_text(value)
+
+
+def __encode_jsonb(value):
+	if not isinstance(value, basestring):
+		value = json.dumps(value)
+	elif isinstance(value, unicode):
+		value = value.encode('utf-8')
+	# jsonb is sent as a version number followed by the JSON text.
+	return __encode_bytes('\x01' + value)
+
+
+def __encode_uuid(value):
+	if not isinstance(value, uuid.UUID):
+		value = uuid.UUID(str(value))
+	return __encode_bytes(value.bytes)
+
+
+def __encode_date(value):
+	if isinstance(value, datetime.datetime):
+		value = value.date()
+	return __int4(4, (value - POSTGRES_EPOCH_DATE).days)
+
+
+def __encode_timestamp(value):
+	if not isinstance(value, datetime.datetime):
+		value = datetime.datetime.combine(value, datetime.time())
+	delta = value.replace(tzinfo=None) - POSTGRES_EPOCH
+	return __int8(8, (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds)
+
+
+def __encode_timestamptz(value):
+	# Sent in UTC. Naive datetimes are taken to be UTC already.
+	if isinstance(value, datetime.datetime) and value.utcoffset() is not None:
+		value = value.replace(tzinfo=None) - value.utcoffset()
+	return __encode_timestamp(value)
+
+
+def __encode_numeric(value):
+	if not isinstance(value, decimal.Decimal):
+		value = decimal.Decimal(repr(value) if isinstance(value, float) else value)
+	# str() of a Decimal is much cheaper than as_tuple(), and is plain positional notation
+	# unless the exponent is large or the value is special.
+	text = str(value)
+	if 'E' in text or not text.lstrip('-')[:1].isdigit():
+		sign, digits, exponent = value.as_tuple()
+		if exponent == 'n' or exponent == 'N':
+			return __encode_bytes(struct.pack('>hhHh', 0, 0, NUMERIC_NAN, 0))
+		if exponent == 'F':
+			raise ValueError("Infinite numeric values cannot be copied.")
+		text = ''.join(map(str, digits))
+		if exponent >= 0:
+			integer, fraction = text + '0' * exponent, ''
+		elif -exponent >= len(text):
+			integer, fraction = '', '0' * (-exponent - len(text)) + text
+		else:
+			integer, fraction = text[:exponent], text[exponent:]
+	else:
+		sign = text[0] == '-'
+		integer, _, fraction = text.lstrip('-').partition('.')
+
+	# Base 10000 digits, aligned so that the decimal point falls between two of them.
+	scale = len(fraction)
+	integer = '0' * (-len(integer) % 4) + integer
+	text = integer + fraction + '0' * (-scale % 4)
+	groups = [int(text[i:i + 4]) for i in xrange(0, len(text), 4)]
+	weight = len(integer) // 4 - 1
+	while groups and groups[-1] == 0:
+		groups.pop()
+	while groups and groups[0] == 0:
+		groups.pop(0)
+		weight -= 1
+	if not groups:
+		weight = 0
+		sign = 0
+
+	return __encode_bytes(struct.pack('>hhHh' + 'H' * len(groups), len(groups), weight,
+									  NUMERIC_NEGATIVE if sign else NUMERIC_POSITIVE, scale,
+									  *groups))
+
+
+TYPE_ENCODERS = {
+	'bool' : __encode_bool,
+	'int2' : __encode_int2,
+	'int4' : __encode_int4,
+	'int8' : __encode_int8,
+	'float4' : __encode_float4,
+	'float8' : __encode_float8,
+	'numeric' : __encode_numeric,
+	'text' : __encode_text,
+	'varchar' : __encode_text,
+	'bpchar' : __encode_text,
+	'name' : __encode_text,
+	'bytea' : __encode_bytea,
+	'date' : __encode_date,
+	'timestamp' : __encode_timestamp,
+	'timestamptz' : __encode_timestamptz,
+	'uuid' : __encode_uuid,
+	'json' : __encode_json,
+	'jsonb' : __encode_jsonb
+}
+
+# SQL spellings of the types above, as found in information_schema or written by hand.
+TYPE_ALIASES = {
+	'boolean' : 'bool',
+	'smallint' : 'int2',
+	'integer' : 'int4',
+	'int' : 'int4',
+	'bigint' : 'int8',
+	'real' : 'float4',
+	'double precision' : 'float8',
+	'decimal' : 'numeric',
+	'character varying' : 'varchar',
+	'character' : 'bpchar',
+	'timestamp without time zone' : 'timestamp',
+	'timestamp with time zone' : 'timestamptz'
+}
+
+
+def infer_type(value):
+	""" :returns: The PostgreSQL type a Python value is copied as when the column type is
+		not given. """
+	if isinstance(value, bool):
+		return 'bool'
+	if isinstance(value, (int, long)):
+		return 'int8'
+	if isinstance(value, float):
+		return 'float8'
+	if isinstance(value, decimal.Decimal):
+		return 'numeric'
+	if isinstance(value, datetime.datetime):
+		return 'timestamp' if value.utcoffset() is None else 'timestamptz'
+	if isinstance(value, datetime.date):
+		return 'date'
+	if isinstance(value, uuid.UUID):
+		return 'uuid'
+	if isinstance(value, (bytearray, buffer)):
+		return 'bytea'
+	if isinstance(value, (dict, list)):
+		return 'jsonb'
+	return 'text'
+
+
+class BinaryCopyEncoder(object):
+	""" Encodes batches of rows into PGCOPY binary tuples. The output of a whole query is
+		header, then the encoded batches, then trailer. """
+
+	header = HEADER
+
+	trailer = TRAILER
+
+	def __init__(self, column_types=None):
+		"""
+			:param column_types: List of PostgreSQL type names of the target columns, e.g.
+						['int4', 'numeric', 'timestamptz']. If None, each column's type is
+						inferred from the first non-null value in it (see infer_type), which
+						only suits columns of those exact types.
+
+		"""
+		if column_types is None:
+			self.encoders = None
+		else:
+			self.encoders = [get_type_encoder(column_type) for column_type in column_types]
+
+
+	def encode(self, rows):
+		""" Encodes a batch of rows.
+
+			:param rows: Sequence of rows, e.g. the result of fetchmany().
+
+			:returns: Byte string of binary tuples.
+
+		"""
+		if not rows:
+			return ''
+		if self.encoders is None or None in self.encoders:
+			self.__infer_encoders(rows)
+		encoders = self.encoders
+		num_fields = len(encoders)
+		if len(rows[0]) != num_fields:
+			raise ValueError("Rows have {actual} fields, expected {expected}.".format(
+							 actual=len(rows[0]), expected=num_fields))
+
+		field_count = struct.pack('>h', num_fields)
+		parts = []
+		append = parts.append
+		for row in rows:
+			append(field_count)
+			for encode, value in zip(encoders, row):
+				append(NULL_FIELD if value is None else encode(value))
+		return ''.join(parts)
+
+
+	def __infer_encoders(self, rows):
+		# Columns with only NULLs so far stay None; NULL is encoded the same for any type.
+		if self.encoders is None:
+			self.encoders = [None] * len(rows[0])
+		for i, encoder in enumerate(self.encoders):
+			if encoder is None:
+				for row in rows:
+					if row[i] is not None:
+						self.encoders[i] = TYPE_ENCODERS[infer_type(row[i])]
+						break
+
+
+def get_type_encoder(column_type):
+	""" :returns: The function encoding values of a PostgreSQL type into a binary COPY field.
+		:raises ValueError: The type is not supported. """
+	column_type = column_type.lower()
+	column_type = TYPE_ALIASES.get(column_type, column_type)
+	try:
+		return TYPE_ENCODERS[column_type]
+	except KeyError:
+		raise ValueError(column_type + " columns cannot be copied in binary format.")
@@ -0,0 +1,245 @@
+# Python standard library
+import errno
+import os
+import time
+
+# Local modules
+from compression import open_file
+
+""" Spools: a query's output written to a directory as a series of segment files, which a
+	load reads while they are still being written. Only finished segments are read, each
+	is deleted once read, and the writer waits while too many are left unread, so disk use
+	stays bounded. Needs neither mkfifo() nor a driver that reads from named pipes. """
+
+SEGMENT_BYTES = 16 * 1024 * 1024
+MAX_SEGMENTS = 8
+POLL_INTERVAL = 0.05
+
+SEGMENT_NAME = 'segment.{index:06d}'
+PARTIAL_SUFFIX = '.partial'
+END_MARKER = 'end'
+FAILED_MARKER = 'failed'
+
+READ_SIZE = 1024 * 1024
+
+
+def segment_path(directory, index):
+	return os.path.join(directory, SEGMENT_NAME.format(index=index))
+
+
+class SpoolWriter(object):
+	""" File object writing to the segments of a spool. A segment is finished, and so
+		becomes visible to the reader, once at least segment_bytes have been written to it.
+		Data passed to a single write() call never spans two segments. """
+
+	def __init__(self, directory, segment_bytes=SEGMENT_BYTES, max_segments=MAX_SEGMENTS,
+				 compression=None, level=None, stop=None):
+		"""
+			:param directory: Existing, empty directory to write the segments to.
+			:param segment_bytes: Size of each segment, before compression.
+			:param max_segments: Number of finished segments left unread before write()
+						waits for the reader.
+			:param compression: Codec to compress each segment with.
+			:param level: Codec specific compression level.
+			:param stop: threading.Event set if the reader has stopped. write() then raises
+						IOError with errno EPIPE, like writing to a pipe without a reader.
+
+		"""
+		self.directory = directory
+		self.segment_bytes = segment_bytes
+		self.max_segments = max_segments
+		self.compression = compression
+		self.level = level
+		self.stop = stop
+		self.index = 0
+		self.size = 0
+		self.segment = None
+		self.closed = False
+
+
+	def write(self, data):
+		if not data:
+			return
+		if self.segment is None:
+			self.__open_segment()
+		self.segment.write(data)
+		self.size += len(data)
+		if self.size >= self.segment_bytes:
+			self.__finish_segment()
+
+
+	def flush(self):
+		# Segments only become visible once finished.
+		pass
+
+
+	def close(self):
+		""" Finishes the last segment and marks the end of the spool. """
+		if not self.closed:
+			self.closed = True
+			if self.segment is not None:
+				self.__finish_segment()
+			self.__mark(END_MARKER)
+
+
+	def abort(self):
+		""" Marks the spool as failed, which the reader raises as an IOError. """
+		if not self.closed:
+			self.closed = True
+			if self.segment is not None:
+				try:
+					self.segment.close()
+				except IOError:
+					pass
+			self.__mark(FAILED_MARKER)
+
+
+	def __enter__(self):
+		return self
+
+
+	def __exit__(self, type, value, traceback):
+		if type is None:
+			self.close()
+		else:
+			self.abort()
+
+
+	def __open_segment(self):
+		# Wait for the reader while max_segments finished segments are still unread.
+		waiting_for = segment_path(self.directory, self.index - self.max_segments)
+		while self.index >= self.max_segments and os.path.exists(waiting_for):
+			self.__check_stop()
+			time.sleep(POLL_INTERVAL)
+		self.__check_stop()
+		self.segment = open_file(segment_path(self.directory, self.index) + PARTIAL_SUFFIX,
+								 'wb', self.compression, self.level)
+
+
+	def __finish_segment(self):
+		self.segment.close()
+		path = segment_path(self.directory, self.index)
+		os.rename(path + PARTIAL_SUFFIX, path)
+		self.segment = None
+		self.size = 0
+		self.index += 1
+
+
+	def __check_stop(self):
+		if self.stop is not None and self.stop.is_set():
+			raise IOError(errno.EPIPE, "The spool reader has stopped.")
+
+
+	def __mark(self, name):
+		open(os.path.join(self.directory, name), 'w').close()
+
+
+class SpoolReader(object):
+	""" File object reading the segments of a spool in order as they are finished, and
+		deleting each once read. Reads block until the next segment is finished, and
+		return '' once the writer has marked the end of the spool. """
+
+	def __init__(self, directory, compression=None, poll_interval=POLL_INTERVAL):
+		"""
+			:param directory: Directory the segments are written to.
+			:param compression: Codec the segments are compressed with.
+			:param poll_interval: Seconds to wait before looking for a segment again.
+
+		"""
+		self.directory = directory
+		self.compression = compression
+		self.poll_interval = poll_interval
+		self.index = 0
+		self.segment = None
+		self.buffer = ''
+		self.closed = False
+		self.ended = False
+
+
+	def read(self, size=-1):
+		if size is None or size < 0:
+			chunks = [self.buffer]
+			self.buffer = ''
+			chunk = self.__read_chunk(READ_SIZE)
+			while chunk:
+				chunks.append(chunk)
+				chunk = self.__read_chunk(READ_SIZE)
+			return ''.join(chunks)
+
+		if self.buffer:
+			data, self.buffer = self.buffer[:size], self.buffer[size:]
+			return data
+		return self.__read_chunk(size)
+
+
+	def readline(self):
+		# Lines may span segments when the writer does not write whole records.
+		end = self.buffer.find('\n')
+		while end < 0:
+			chunk = self.__read_chunk(READ_SIZE)
+			if not chunk:
+				break
+			end = chunk.find('\n')
+			if end >= 0:
+				end += len(self.buffer)
+			self.buffer += chunk
+		if end < 0:
+			line, self.buffer = self.buffer, ''
+		else:
+			line, self.buffer = self.buffer[:end + 1], self.buffer[end + 1:]
+		return line
+
+
+	def __iter__(self):
+		line = self.readline()
+		while line:
+			yield line
+			line = self.readline()
+
+
+	def close(self):
+		if not self.closed:
+			self.closed = True
+			if self.segment is not None:
+				self.segment.close()
+
+
+	def __enter__(self):
+		return self
+
+
+	def __exit__(self, type, value, traceback):
+		self.close()
+
+
+	def __read_chunk(self, size):
+		""" Reads up to size bytes from the current segment, moving on to the next ones as
+			they are used up. :returns: '' at the end of the spool. """
+		while not self.ended:
+			if self.segment is None and not self.__open_segment():
+				self.ended = True
+				break
+			data = self.segment.read(size)
+			if data:
+				return data
+			self.segment.close()
+			self.segment = None
+			os.remove(segment_path(self.directory, self.index))
+			self.index += 1
+		return ''
+
+
+	def __open_segment(self):
+		""" Waits for the next segment. :returns: False if the spool has ended instead. """
+		path = segment_path(self.directory, self.index)
+		while not os.path.exists(path):
+			if os.path.exists(os.path.join(self.directory, FAILED_MARKER)):
+				raise IOError("The spool writer failed.")
+			if os.path.exists(os.path.join(self.directory, END_MARKER)):
+				# The last segment is finished before the end is marked.
+				if os.path.exists(path):
+					break
+				return False
+			time.sleep(self.poll_interval)
+		self.segment = open_file(path, 'rb', self.compression)
+		return True
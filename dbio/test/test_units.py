@@ -1,9 +1,17 @@
 # Python standard library
+import datetime
+import decimal
+import os
 import random
+import signal
+import threading
 import tempfile
 import filecmp
+import json
 import subprocess
+import sys
 import string
+import StringIO
 import sqlite3
 
 # PyPI packages
@@ -13,7 +21,15 @@ import sqlalchemy
 
 # Local modules
 import dbio
+import dbio.compression
 import dbio.databases
+import dbio.databases.engines
+import dbio.databases.mysql
+import dbio.databases.postgresql
+import dbio.encoder
+import dbio.jobs
+import dbio.pgcopy
+import dbio.timing
 
 
 
@@ -105,33 +121,19 @@ def test_replicate(monkeypatch):
 	mock_reader = MockPopen()
 	mock_writer = MockPopen()
 
-	mock_db = MockDatabase(mock_url)
-
-	def mockdb(url):
-		return mock_db
-
-	monkeypatch.setattr(dbio.io, '__get_database', mockdb)
-
-	def mockpopen(args, **kwargs):
-		# Check that Popen is called correcty.
-		assert args[0] == 'dbio'
-		if 'load' in args:
-			return mock_reader
-		elif 'query' in args:
-			return mock_writer
-		else:
-			assert False, "Unexpected dbio script called." + str(args)
-
-
-	monkeypatch.setattr(subprocess, 'Popen', mockpopen)
+	mock_processes(monkeypatch, mock_url, mock_reader, mock_writer)
 
 	# Tested method
-	dbio.replicate(mock_url, mock_url, mock_query, mock_table, mock_append)
+	usage = dbio.replicate(mock_url, mock_url, mock_query, mock_table, mock_append)
 
 	# Both processes have terminated with success
 	assert mock_reader.returncode == 0
 	assert mock_writer.returncode == 0
 
+	# Resource usage is collected for both processes
+	assert usage['reader'] == {'returncode' : 0, 'cpu_time' : 1.5, 'max_rss' : 1024}
+	assert usage['writer'] == {'returncode' : 0, 'cpu_time' : 1.5, 'max_rss' : 1024}
+
 
 def test_replicate_with_failing_reader(monkeypatch):
 	""" Test that replicate fails nicely when the reader process fails. """
@@ -141,38 +143,20 @@ def test_replicate_with_failing_reader(monkeypatch):
 	mock_table = 'mock_table'
 	mock_append = True
 
-	mock_reader = MockPopen()
-	mock_reader.returncode = -1
-	mock_writer = MockPopen()
+	mock_reader = MockPopen(exit_status=1)
+	# The writer blocks until it is killed.
+	mock_writer = MockPopen(exit_status=None)
 
-	mock_db = MockDatabase(mock_url)
-
-	def mockdb(url):
-		return mock_db
-
-	monkeypatch.setattr(dbio.io, '__get_database', mockdb)
-
-	def mockpopen(args, **kwargs):
-		# Check that Popen is called correcty.
-		assert args[0] == 'dbio'
-		if 'load' in args:
-			return mock_reader
-		elif 'query' in args:
-			return mock_writer
-		else:
-			assert False, "Unexpected dbio script called." + str(args)
-
-
-	monkeypatch.setattr(subprocess, 'Popen', mockpopen)
+	mock_processes(monkeypatch, mock_url, mock_reader, mock_writer)
 
 	# Tested method
 	with pytest.raises(RuntimeError):
 		dbio.replicate(mock_url, mock_url, mock_query, mock_table, mock_append)
 
 	# Reader should show failure
-	assert mock_reader.returncode != 0
-	# Writer should not be alive
-	assert mock_writer.returncode is not None
+	assert mock_reader.returncode == 1
+	# Writer should have been killed
+	assert mock_writer.returncode == -signal.SIGKILL
 
 
 def test_replicate_with_failing_writer(monkeypatch):
@@ -183,38 +167,20 @@ def test_replicate_with_failing_writer(monkeypatch):
 	mock_table = 'mock_table'
 	mock_append = True
 
-	mock_reader = MockPopen()
-	mock_writer = MockPopen()
-	mock_writer.returncode = -1
-
-	mock_db = MockDatabase(mock_url)
+	# The reader blocks until it is killed.
+	mock_reader = MockPopen(exit_status=None)
+	mock_writer = MockPopen(exit_status=1)
 
-	def mockdb(url):
-		return mock_db
-
-	monkeypatch.setattr(dbio.io, '__get_database', mockdb)
-
-	def mockpopen(args, **kwargs):
-		# Check that Popen is called correcty.
-		assert args[0] == 'dbio'
-		if 'load' in args:
-			return mock_reader
-		elif 'query' in args:
-			return mock_writer
-		else:
-			assert False, "Unexpected dbio script called." + str(args)
-
-
-	monkeypatch.setattr(subprocess, 'Popen', mockpopen)
+	mock_processes(monkeypatch, mock_url, mock_reader, mock_writer)
 
 	# Tested method
 	with pytest.raises(RuntimeError):
 		dbio.replicate(mock_url, mock_url, mock_query, mock_table, mock_append)
 
-	# Reader should not be alive
-	assert mock_reader.returncode is not None
+	# Reader should have been killed
+	assert mock_reader.returncode == -signal.SIGKILL
 	# Writer should show failure
-	assert mock_writer.returncode != 0
+	assert mock_writer.returncode == 1
 
 
 def test_replicate_with_failing_rw(monkeypatch):
@@ -225,30 +191,10 @@ def test_replicate_with_failing_rw(monkeypatch):
 	mock_table = 'mock_table'
 	mock_append = True
 
-	mock_reader = MockPopen()
-	mock_reader.returncode = -1
-	mock_writer = MockPopen()
-	mock_writer.returncode = -1
-
-	mock_db = MockDatabase(mock_url)
-
-	def mockdb(url):
-		return mock_db
-
-	monkeypatch.setattr(dbio.io, '__get_database', mockdb)
-
-	def mockpopen(args, **kwargs):
-		# Check that Popen is called correcty.
-		assert args[0] == 'dbio'
-		if 'load' in args:
-			return mock_reader
-		elif 'query' in args:
-			return mock_writer
-		else:
-			assert False, "Unexpected dbio script called." + str(args)
-
+	mock_reader = MockPopen(exit_status=1)
+	mock_writer = MockPopen(exit_status=1)
 
-	monkeypatch.setattr(subprocess, 'Popen', mockpopen)
+	mock_processes(monkeypatch, mock_url, mock_reader, mock_writer)
 
 	# Tested method
 	with pytest.raises(RuntimeError):
@@ -290,7 +236,7 @@ def test_replicate_no_fifo(monkeypatch):
 		load_called_with['kwargs'] = kwargs
 
 	monkeypatch.setattr(dbio.io, 'load', mock_load)
-	monkeypatch.setattr(dbio.io, 'query', mock_query)
+	monkeypatch.setattr(dbio.io, '__query_to_file', mock_query)
 
 	dbio.replicate_no_fifo(mock_url, mock_url, mock_query, mock_table, 
 						mock_append, query_is_file=mock_query_is_file, 
@@ -301,13 +247,18 @@ def test_replicate_no_fifo(monkeypatch):
 
 	correct_query_args = (mock_url, mock_query, fname)
 	correct_query_kwargs = {'query_is_file' : mock_query_is_file, 'csv_params' : dbio.databases.DEFAULT_CSV_PARAMS,
-							'null_string' : dbio.databases.DEFAULT_NULL_STRING}
+							'null_string' : dbio.databases.DEFAULT_NULL_STRING,
+							'compression' : None, 'compression_level' : None, 'batch_bytes' : None,
+							'pipeline_depth' : None, 'native_export' : False,
+							'copy_format' : 'csv', 'column_types' : None, 'timings' : None}
 	correct_load_args = (mock_url, mock_table, fname, mock_append)
 	correct_load_kwargs = {'analyze' : mock_analyze, 'csv_params' : dbio.databases.DEFAULT_CSV_PARAMS,
 							'null_string' : dbio.databases.DEFAULT_NULL_STRING,
 							'disable_indices' : mock_disable_indices,
 							'create_staging' : mock_create_staging,
-							'expected_rowcount' : None}
+							'expected_rowcount' : None,
+							'compression' : None, 'copy_format' : 'csv', 'watermark' : None,
+							'timings' : None}
 
 	assert load_called_with['args'] == correct_load_args
 	assert load_called_with['kwargs'] == correct_load_kwargs
@@ -360,6 +311,996 @@ def test_sqlite():
 	data_file.close()
 
 
+def test_sqlite_load():
+	""" The SQLite loader binds values, so quotes survive and null_string becomes NULL, and
+		bulk pragmas are only in effect during the load. """
+	db_file = tempfile.NamedTemporaryFile()
+	db_url = 'sqlite:///' + db_file.name
+	create_sqlite_table(3, 20, 'load_table', db_url)
+	engine = sqlalchemy.create_engine(db_url)
+
+	rows = [(u"it's", u'"quoted"', u'NULL'), (u'\u4e2d', u'', u'x')]
+	data_file = tempfile.NamedTemporaryFile()
+	write_rows_to_file(rows, data_file.name, dbio.databases.DEFAULT_CSV_PARAMS)
+
+	dbio.load(db_url, 'load_table', data_file.name, False, bulk_pragmas=True)
+	engine.execute("CREATE INDEX load_index ON load_table (field0)")
+	dbio.load(db_url, 'load_table', data_file.name, True, disable_indices=True,
+			  bulk_pragmas={'cache_size' : 1000})
+
+	expected = [(u"it's", u'"quoted"', None), (u'\u4e2d', u'', u'x')]
+	assert engine.execute("SELECT * FROM load_table").fetchall() == expected * 2
+	assert engine.execute("SELECT name FROM sqlite_master WHERE type='index'").fetchall() == [
+		(u'load_index',)]
+	assert engine.execute("PRAGMA journal_mode").fetchone()[0] == u'delete'
+
+	db_file.close()
+	data_file.close()
+
+
+def test_replicate_threaded():
+	""" Replicates between two sqlite databases on threads and checks the loaded data,
+		through a pipe of the default size, an enlarged one, and one too large to be set. """
+	num_rows = 250
+	num_fields = 5
+	max_field_length = 20
+
+	query_db_file = tempfile.NamedTemporaryFile()
+	query_db_url = 'sqlite:///' + query_db_file.name
+	create_sqlite_table(num_fields, max_field_length, 'query_table', query_db_url)
+
+	import_db_file = tempfile.NamedTemporaryFile()
+	import_db_url =  'sqlite:///' + import_db_file.name
+	create_sqlite_table(num_fields, max_field_length, 'import_table', import_db_url)
+
+	data_file = tempfile.NamedTemporaryFile()
+	row_data = get_rows(num_rows, num_fields, max_field_length, string.digits, True)
+	write_rows_to_file(row_data, data_file.name, dbio.databases.DEFAULT_CSV_PARAMS)
+	dbio.load(query_db_url, 'query_table', data_file.name, False)
+
+	check_file = tempfile.NamedTemporaryFile()
+	for pipe_size in (None, 256 * 1024, 2 ** 30):
+		dbio.replicate_threaded(query_db_url, import_db_url, 'SELECT * FROM query_table',
+								'import_table', False, do_rowcount_check=True, pipe_size=pipe_size)
+
+		dbio.query(import_db_url, 'SELECT * FROM import_table', check_file.name)
+		assert filecmp.cmp(data_file.name, check_file.name, shallow=False)
+
+	query_db_file.close()
+	import_db_file.close()
+	check_file.close()
+	data_file.close()
+
+
+@pytest.mark.skipif(not sys.platform.startswith('linux'), reason="Pipe sizes are Linux only.")
+def test_pipe_size(monkeypatch, caplog):
+	""" Pipes are enlarged to pipe_size, or keep their size with a warning, and are written
+		in batches of half as many bytes, on threads and by the query process of a FIFO. """
+	import fcntl
+	set_pipe_size = getattr(dbio.io, '__set_pipe_size')
+
+	read_fd, write_fd = os.pipe()
+	assert set_pipe_size(write_fd, 256 * 1024) == 256 * 1024
+	assert fcntl.fcntl(write_fd, dbio.io.F_GETPIPE_SZ) == 256 * 1024
+
+	# A pipe cannot shrink below what it holds, even with CAP_SYS_RESOURCE.
+	os.write(write_fd, 'x' * 128 * 1024)
+	assert set_pipe_size(write_fd, 4096) == 256 * 1024
+	assert fcntl.fcntl(write_fd, dbio.io.F_GETPIPE_SZ) == 256 * 1024
+	assert "Could not set the pipe size to 4096 bytes" in caplog.text
+	os.close(read_fd)
+	os.close(write_fd)
+
+	query_db_file = tempfile.NamedTemporaryFile()
+	query_db_url = 'sqlite:///' + query_db_file.name
+	create_sqlite_table(2, 10, 'query_table', query_db_url)
+	rows = [(str(i), 'value' + str(i)) for i in range(1000)]
+	sqlalchemy.create_engine(query_db_url).execute("INSERT INTO query_table VALUES (?, ?)", rows)
+
+	import_db_file = tempfile.NamedTemporaryFile()
+	import_db_url =  'sqlite:///' + import_db_file.name
+	create_sqlite_table(2, 10, 'import_table', import_db_url)
+	import_engine = sqlalchemy.create_engine(import_db_url)
+
+	write_to_pipe = getattr(dbio.io, '__write_to_pipe')
+	writes = []
+	def checked_write_to_pipe(db, query_str, write_fd, batch_size, csv_params, null_string,
+							  aborted, batch_bytes, *args, **kwargs):
+		writes.append((fcntl.fcntl(write_fd, dbio.io.F_GETPIPE_SZ), batch_bytes))
+		return write_to_pipe(db, query_str, write_fd, batch_size, csv_params, null_string,
+							 aborted, batch_bytes, *args, **kwargs)
+	monkeypatch.setattr(dbio.io, '__write_to_pipe', checked_write_to_pipe)
+
+	dbio.replicate_threaded(query_db_url, import_db_url, 'SELECT * FROM query_table',
+							'import_table', False, do_rowcount_check=True, pipe_size=256 * 1024)
+	assert writes == [(256 * 1024, 128 * 1024)]
+	assert import_engine.execute("SELECT * FROM import_table ORDER BY rowid").fetchall() == rows
+
+	popen = subprocess.Popen
+	calls = []
+	def recording_popen(args, *popen_args, **kwargs):
+		calls.append(args)
+		return popen(args, *popen_args, **kwargs)
+	monkeypatch.setattr(subprocess, 'Popen', recording_popen)
+
+	dbio.replicate(query_db_url, import_db_url, 'SELECT * FROM query_table', 'import_table',
+				   False, do_rowcount_check=True, pipe_size=256 * 1024)
+	query_args = [args for args in calls if 'query' in args][0]
+	assert query_args[query_args.index('--pipe-size') + 1] == str(256 * 1024)
+	assert import_engine.execute("SELECT * FROM import_table ORDER BY rowid").fetchall() == rows
+
+	query_db_file.close()
+	import_db_file.close()
+
+
+def test_replicate_threaded_with_failing_query():
+	""" A failing query is raised as is and the partial load is not swapped in. """
+	query_db_file = tempfile.NamedTemporaryFile()
+	query_db_url = 'sqlite:///' + query_db_file.name
+
+	import_db_file = tempfile.NamedTemporaryFile()
+	import_db_url =  'sqlite:///' + import_db_file.name
+	create_sqlite_table(2, 10, 'import_table', import_db_url)
+	engine = sqlalchemy.create_engine(import_db_url)
+	engine.execute("INSERT INTO import_table VALUES ('a', 'b')")
+
+	with pytest.raises(sqlalchemy.exc.OperationalError):
+		dbio.replicate_threaded(query_db_url, import_db_url, 'SELECT * FROM missing_table',
+								'import_table', False)
+
+	assert engine.execute("SELECT * FROM import_table").fetchall() == [('a', 'b')]
+
+	query_db_file.close()
+	import_db_file.close()
+
+
+def test_replicate_through_pipe_uncompressed():
+	""" Compression options are rejected by replication through a pipe, rather than passed
+		on to the load of the pipe. """
+	db_file = tempfile.NamedTemporaryFile()
+	db_url = 'sqlite:///' + db_file.name
+	create_sqlite_table(2, 10, 'import_table', db_url)
+
+	for replicate in (dbio.replicate, dbio.replicate_threaded):
+		with pytest.raises(ValueError):
+			replicate(db_url, db_url, 'SELECT * FROM import_table', 'import_table', False,
+					  compression='gzip')
+	with pytest.raises(ValueError):
+		dbio.replicate_fanout(db_url, 'SELECT * FROM import_table',
+							  [{'load_db_url' : db_url, 'table' : 'import_table',
+								'compression' : 'gzip'}])
+
+	db_file.close()
+
+
+def test_rowcount_check(monkeypatch):
+	""" Row counts come from the query and the load themselves, not from COUNT queries. """
+	def fail_count(*args):
+		raise AssertionError("The query was run again to count its rows.")
+	monkeypatch.setattr(dbio.databases.base.Exportable, 'get_query_rowcount', fail_count)
+
+	query_db_file = tempfile.NamedTemporaryFile()
+	query_db_url = 'sqlite:///' + query_db_file.name
+	create_sqlite_table(2, 10, 'query_table', query_db_url)
+	query_engine = sqlalchemy.create_engine(query_db_url)
+	query_engine.execute("INSERT INTO query_table VALUES (?, ?)", [('a', 'b'), ('c', None)])
+
+	import_db_file = tempfile.NamedTemporaryFile()
+	import_db_url =  'sqlite:///' + import_db_file.name
+	create_sqlite_table(2, 10, 'import_table', import_db_url)
+	import_engine = sqlalchemy.create_engine(import_db_url)
+
+	dbio.replicate_threaded(query_db_url, import_db_url, 'SELECT * FROM query_table',
+							'import_table', False, do_rowcount_check=True)
+	assert import_engine.execute("SELECT COUNT(*) FROM import_table").fetchone()[0] == 2
+
+	# Appended rows are checked on their own, not against the whole table.
+	dbio.replicate_threaded(query_db_url, import_db_url, 'SELECT * FROM query_table',
+							'import_table', True, do_rowcount_check=True)
+	assert import_engine.execute("SELECT COUNT(*) FROM import_table").fetchone()[0] == 4
+
+	data_file = tempfile.NamedTemporaryFile()
+	rowcount_file = tempfile.NamedTemporaryFile()
+	dbio.query(query_db_url, 'SELECT * FROM query_table', data_file.name,
+			   rowcount_file=rowcount_file.name)
+	assert rowcount_file.read() == '2'
+
+	# A mismatch leaves the table as it was.
+	with pytest.raises(dbio.databases.base.Importable.UnexpectedRowcountError):
+		dbio.load(import_db_url, 'import_table', data_file.name, False,
+				  expected_rowcount=lambda: 3)
+	assert import_engine.execute("SELECT COUNT(*) FROM import_table").fetchone()[0] == 4
+
+	query_db_file.close()
+	import_db_file.close()
+	data_file.close()
+	rowcount_file.close()
+
+
+def test_phase_timings():
+	""" Replication returns the phases of both sides through timings, and profiles each
+		side to a file of its own. """
+	query_db_file = tempfile.NamedTemporaryFile()
+	query_db_url = 'sqlite:///' + query_db_file.name
+	create_sqlite_table(2, 10, 'query_table', query_db_url)
+	sqlalchemy.create_engine(query_db_url).execute("INSERT INTO query_table VALUES (?, ?)",
+												   [('a', 'b'), ('c', None)])
+
+	import_db_file = tempfile.NamedTemporaryFile()
+	import_db_url =  'sqlite:///' + import_db_file.name
+	create_sqlite_table(2, 10, 'import_table', import_db_url)
+
+	profile_dir = tempfile.mkdtemp()
+	profile = os.path.join(profile_dir, 'out.pstats')
+	timings = dbio.timing.Timings()
+	dbio.replicate_threaded(query_db_url, import_db_url, 'SELECT * FROM query_table',
+							'import_table', False, do_rowcount_check=True, timings=timings,
+							profile=profile)
+
+	phases = set((phase['side'], phase['phase']) for phase in timings.phases)
+	assert set([('query', 'connect'), ('query', 'first_row'), ('query', 'transfer'),
+				('load', 'connect'), ('load', 'staging'), ('load', 'transfer'),
+				('load', 'rowcount_check'), ('load', 'swap'), ('load', 'drop')]) <= phases
+	assert all(phase['wall'] >= 0 and phase['cpu'] >= 0 for phase in timings.phases)
+	assert sorted(os.listdir(profile_dir)) == ['out.load.pstats', 'out.query.pstats']
+
+	# Through a named pipe, the processes of both sides save their phases for the caller.
+	timings = dbio.timing.Timings()
+	usage = dbio.replicate(query_db_url, import_db_url, 'SELECT * FROM query_table',
+						   'import_table', False, do_rowcount_check=True, timings=timings)
+	assert usage['phases'] == timings.phases
+	assert set([('query', 'transfer'), ('load', 'transfer'), ('load', 'swap')]) <= set(
+		(phase['side'], phase['phase']) for phase in timings.phases)
+
+	# Failed operations still return the phases they went through.
+	timings = dbio.timing.Timings()
+	with pytest.raises(sqlalchemy.exc.OperationalError):
+		dbio.query(query_db_url, 'SELECT * FROM missing_table', os.devnull, timings=timings)
+	assert [phase['phase'] for phase in timings.phases] == ['connect', 'first_row']
+
+	for filename in os.listdir(profile_dir):
+		os.remove(os.path.join(profile_dir, filename))
+	os.rmdir(profile_dir)
+	query_db_file.close()
+	import_db_file.close()
+
+
+def test_replicate_incremental():
+	""" Only rows past the saved watermark are appended, and the watermark follows them. """
+	query_db_file = tempfile.NamedTemporaryFile()
+	query_db_url = 'sqlite:///' + query_db_file.name
+	query_engine = sqlalchemy.create_engine(query_db_url)
+	query_engine.execute("CREATE TABLE events (id integer, value varchar(10))")
+
+	import_db_file = tempfile.NamedTemporaryFile()
+	import_db_url =  'sqlite:///' + import_db_file.name
+	import_engine = sqlalchemy.create_engine(import_db_url)
+	import_engine.execute("CREATE TABLE events (id integer, value varchar(10))")
+
+	with pytest.raises(ValueError):
+		dbio.replicate_threaded(query_db_url, import_db_url, 'SELECT * FROM events', 'events',
+								False, watermark_column='id')
+
+	rows = [(i, 'value' + str(i)) for i in range(10)]
+	query_engine.execute("INSERT INTO events VALUES (?, ?)", rows[:5])
+	dbio.replicate_threaded(query_db_url, import_db_url, 'SELECT * FROM events', 'events',
+							True, watermark_column='id', watermark_key='events')
+	query_engine.execute("INSERT INTO events VALUES (?, ?)", rows[5:])
+	dbio.replicate_no_fifo(query_db_url, import_db_url, 'SELECT * FROM events', 'events',
+						   True, watermark_column='id', watermark_key='events',
+						   do_rowcount_check=True)
+	# Nothing new.
+	dbio.replicate_threaded(query_db_url, import_db_url, 'SELECT * FROM events', 'events',
+							True, watermark_column='id', watermark_key='events')
+
+	assert import_engine.execute("SELECT * FROM events ORDER BY id").fetchall() == rows
+	assert import_engine.execute("SELECT * FROM dbio_watermarks").fetchall() == [
+		(u'events', u'events', u'id', u'9')]
+
+	query_db_file.close()
+	import_db_file.close()
+
+
+def test_replicate_chunked(monkeypatch):
+	""" A failed chunked replication resumes after the last committed chunk. """
+	query_db_file = tempfile.NamedTemporaryFile()
+	query_db_url = 'sqlite:///' + query_db_file.name
+	query_engine = sqlalchemy.create_engine(query_db_url)
+	query_engine.execute("CREATE TABLE events (id integer, value varchar(10))")
+	rows = [(i, 'value' + str(i)) for i in range(100)]
+	query_engine.execute("INSERT INTO events VALUES (?, ?)", rows)
+
+	import_db_file = tempfile.NamedTemporaryFile()
+	import_db_url =  'sqlite:///' + import_db_file.name
+	import_engine = sqlalchemy.create_engine(import_db_url)
+	import_engine.execute("CREATE TABLE events (id integer, value varchar(10))")
+	import_engine.execute("INSERT INTO events VALUES (-1, 'old')")
+
+	replicate_threaded = dbio.io.replicate_threaded
+	calls = []
+	def failing_replicate(*args, **kwargs):
+		calls.append(args[2])
+		if len(calls) in (3, 6, 7):
+			raise RuntimeError("Chunk failed.")
+		replicate_threaded(*args, **kwargs)
+	monkeypatch.setattr(dbio.io, 'replicate_threaded', failing_replicate)
+
+	with pytest.raises(RuntimeError):
+		dbio.replicate_chunked(query_db_url, import_db_url, 'SELECT * FROM events', 'events',
+							   False, 'id', chunks=5, method='threaded', max_attempts=1)
+	assert import_engine.execute("SELECT * FROM events").fetchall() == [(-1, 'old')]
+	assert import_engine.execute("SELECT * FROM events_staging ORDER BY id").fetchall() == rows[:39]
+
+	# Resumed from the third chunk, retrying the failures.
+	dbio.replicate_chunked(query_db_url, import_db_url, 'SELECT * FROM events', 'events',
+						   False, 'id', chunks=5, method='threaded', retry_delay=0)
+	assert len(calls) == 10
+	assert import_engine.execute("SELECT * FROM events ORDER BY id").fetchall() == rows
+	assert import_engine.execute("SELECT name FROM sqlite_master WHERE name = 'events_staging'").fetchall() == []
+	assert import_engine.execute("SELECT * FROM dbio_watermarks").fetchall() == []
+
+	# Only temporary files are compressed, and the command line always passes the options.
+	with pytest.raises(ValueError):
+		dbio.replicate_chunked(query_db_url, import_db_url, 'SELECT * FROM events', 'events',
+							   True, 'id', chunks=2, method='threaded', compression='gzip')
+	for method, compression in (('threaded', None), ('no_fifo', 'gzip')):
+		import_engine.execute("DELETE FROM events")
+		dbio.replicate_chunked(query_db_url, import_db_url, 'SELECT * FROM events', 'events',
+							   True, 'id', chunks=2, method=method, compression=compression,
+							   compression_level=None)
+		assert import_engine.execute("SELECT * FROM events ORDER BY id").fetchall() == rows
+
+	query_db_file.close()
+	import_db_file.close()
+
+
+def test_run_manifest():
+	""" Jobs run after those they depend on, and a failure only skips its dependents. """
+	query_db_file = tempfile.NamedTemporaryFile()
+	query_db_url = 'sqlite:///' + query_db_file.name
+	query_engine = sqlalchemy.create_engine(query_db_url)
+	query_engine.execute("CREATE TABLE events (id integer, value varchar(10))")
+	rows = [(i, 'value' + str(i)) for i in range(100)]
+	query_engine.execute("INSERT INTO events VALUES (?, ?)", rows)
+
+	import_db_file = tempfile.NamedTemporaryFile()
+	import_db_url =  'sqlite:///' + import_db_file.name
+	import_engine = sqlalchemy.create_engine(import_db_url)
+	for table in ('events', 'copies', 'missing_copies'):
+		import_engine.execute("CREATE TABLE {0} (id integer, value varchar(10))".format(table))
+
+	def replicate_job(name, query, table, **job):
+		job.update(name=name, operation='replicate', query_db_url=query_db_url,
+				   load_db_url=import_db_url, query=query, table=table)
+		return job
+	manifest = {
+		'workers' : 3,
+		'limits' : {import_db_url : 1},
+		'jobs' : [
+			replicate_job('events', 'SELECT * FROM events', 'events', method='no_fifo'),
+			replicate_job('copies', 'SELECT * FROM events WHERE id < 10', 'copies',
+						  depends_on=['events']),
+			replicate_job('missing', 'SELECT * FROM missing', 'missing_copies'),
+			replicate_job('missing_copies', 'SELECT * FROM missing', 'missing_copies',
+						  depends_on=['missing'])
+		]
+	}
+	manifest_file = tempfile.NamedTemporaryFile(suffix='.json')
+	manifest_file.write(json.dumps(manifest))
+	manifest_file.flush()
+
+	results = dbio.run_manifest(manifest_file.name)
+	assert [(result['name'], result['status'], result['rows']) for result in results] == [
+		('events', 'succeeded', 100), ('copies', 'succeeded', 10), ('missing', 'failed', None),
+		('missing_copies', 'skipped', None)]
+	assert import_engine.execute("SELECT * FROM events ORDER BY id").fetchall() == rows
+	assert import_engine.execute("SELECT * FROM copies ORDER BY id").fetchall() == rows[:10]
+	assert 'events' in dbio.jobs.format_summary(results)
+
+	with pytest.raises(ValueError):
+		dbio.run_jobs([replicate_job('copies', 'SELECT 1', 'copies', depends_on=['later']),
+					   replicate_job('later', 'SELECT 1', 'copies')])
+
+	manifest_file.close()
+	query_db_file.close()
+	import_db_file.close()
+
+
+def test_query_snapshot():
+	""" Databases without shared snapshots run every query in one transaction. """
+	db_file = tempfile.NamedTemporaryFile()
+	db_url = 'sqlite:///' + db_file.name
+	engine = sqlalchemy.create_engine(db_url)
+	engine.execute("CREATE TABLE accounts (id integer, name varchar(10))")
+	engine.execute("INSERT INTO accounts VALUES (?, ?)", [(1, 'a'), (2, 'b')])
+	engine.execute("CREATE TABLE users (id integer, account_id integer)")
+	engine.execute("INSERT INTO users VALUES (?, ?)", [(10, 1), (11, 2), (12, 2)])
+
+	accounts_file = tempfile.NamedTemporaryFile()
+	users_file = tempfile.NamedTemporaryFile(suffix='.gz')
+	rowcounts = dbio.query_snapshot(db_url, [('SELECT * FROM accounts', accounts_file.name),
+											 ('SELECT * FROM users', users_file.name)], parallel=2)
+	assert rowcounts == [2, 3]
+	with dbio.compression.open_file(users_file.name, 'rb') as f:
+		assert f.read() == '10,1\n11,2\n12,2\n'
+
+	class MockConnection(object):
+		def __init__(self):
+			self.executed_commands = []
+		def execute(self, cmd):
+			self.executed_commands.append(cmd)
+	connection = MockConnection()
+	postgres = dbio.databases.postgresql.PostgreSQL('postgresql://mock')
+	postgres.begin_snapshot(connection, '00000003-0000001B-1')
+	assert connection.executed_commands == ["SET TRANSACTION ISOLATION LEVEL REPEATABLE READ",
+											"SET TRANSACTION SNAPSHOT '00000003-0000001B-1';"]
+	sqlite = dbio.databases.sqlite.SQLite(db_url)
+	with pytest.raises(NotImplementedError):
+		sqlite.begin_snapshot(connection, '00000003-0000001B-1')
+
+	accounts_file.close()
+	users_file.close()
+	db_file.close()
+
+
+def test_replicate_fanout():
+	""" One query loads several tables, and a failed target does not stop the others. """
+	query_db_file = tempfile.NamedTemporaryFile()
+	query_db_url = 'sqlite:///' + query_db_file.name
+	query_engine = sqlalchemy.create_engine(query_db_url)
+	query_engine.execute("CREATE TABLE events (id integer, value varchar(10))")
+	rows = [(i, 'value' + str(i)) for i in range(1000)]
+	query_engine.execute("INSERT INTO events VALUES (?, ?)", rows)
+
+	import_db_file = tempfile.NamedTemporaryFile()
+	import_db_url =  'sqlite:///' + import_db_file.name
+	import_engine = sqlalchemy.create_engine(import_db_url)
+	import_engine.execute("CREATE TABLE events (id integer, value varchar(10))")
+	import_engine.execute("CREATE TABLE copies (id integer, value varchar(10))")
+
+	results = dbio.replicate_fanout(query_db_url, 'SELECT * FROM events',
+									[{'load_db_url' : import_db_url, 'table' : 'events'},
+									 {'load_db_url' : import_db_url, 'table' : 'missing'},
+									 {'load_db_url' : import_db_url, 'table' : 'copies',
+									  'append' : True}],
+									do_rowcount_check=True, batch_bytes=1024)
+	assert [(result['table'], result['rows']) for result in results] == [
+		('events', 1000), ('missing', None), ('copies', 1000)]
+	assert results[1]['error'] is not None
+	assert import_engine.execute("SELECT * FROM events ORDER BY id").fetchall() == rows
+	assert import_engine.execute("SELECT * FROM copies ORDER BY id").fetchall() == rows
+
+	# Options that the fan-out cannot honour fail instead of appending every row again.
+	target = {'load_db_url' : import_db_url, 'table' : 'copies', 'append' : True}
+	for options in ({'watermark_column' : 'id'}, {'pipe_size' : 65536}, {'copy_format' : 'binary'}):
+		with pytest.raises(ValueError):
+			dbio.replicate_fanout(query_db_url, 'SELECT * FROM events', [target], **options)
+		with pytest.raises(ValueError):
+			dbio.replicate_fanout(query_db_url, 'SELECT * FROM events', [dict(target, **options)])
+	assert import_engine.execute("SELECT COUNT(*) FROM copies").fetchall() == [(1000,)]
+
+	query_db_file.close()
+	import_db_file.close()
+
+
+def test_replicate_fanin():
+	""" Several sources are loaded together, and a failed source fails the whole load. """
+	query_db_files = [tempfile.NamedTemporaryFile() for _ in range(3)]
+	query_db_urls = ['sqlite:///' + query_db_file.name for query_db_file in query_db_files]
+	rows = [(i, 'value' + str(i)) for i in range(3000)]
+	for i, query_db_url in enumerate(query_db_urls):
+		query_engine = sqlalchemy.create_engine(query_db_url)
+		query_engine.execute("CREATE TABLE events (id integer, value varchar(10))")
+		query_engine.execute("INSERT INTO events VALUES (?, ?)", rows[i * 1000:(i + 1) * 1000])
+
+	import_db_file = tempfile.NamedTemporaryFile()
+	import_db_url =  'sqlite:///' + import_db_file.name
+	import_engine = sqlalchemy.create_engine(import_db_url)
+	import_engine.execute("CREATE TABLE events (id integer, value varchar(10))")
+
+	rowcounts = dbio.replicate_fanin(query_db_urls, import_db_url, 'SELECT * FROM events',
+									 'events', False, do_rowcount_check=True, batch_bytes=1024,
+									 queue_depth=2)
+	assert rowcounts == [1000, 1000, 1000]
+	assert import_engine.execute("SELECT * FROM events ORDER BY id").fetchall() == rows
+
+	# Options that the fan-in cannot honour fail instead of appending every row again.
+	for options in ({'watermark_column' : 'id'}, {'pipeline_depth' : 2}, {'native_export' : True}):
+		with pytest.raises(ValueError):
+			dbio.replicate_fanin(query_db_urls, import_db_url, 'SELECT * FROM events', 'events',
+								 True, **options)
+	assert import_engine.execute("SELECT COUNT(*) FROM events").fetchall() == [(3000,)]
+
+	sqlalchemy.create_engine(query_db_urls[1]).execute("DROP TABLE events")
+	with pytest.raises(sqlalchemy.exc.OperationalError):
+		dbio.replicate_fanin(query_db_urls, import_db_url, 'SELECT * FROM events', 'events',
+							 True)
+	assert import_engine.execute("SELECT COUNT(*) FROM events").fetchall() == [(3000,)]
+
+	for query_db_file in query_db_files:
+		query_db_file.close()
+	import_db_file.close()
+
+
+def test_replicate_spooled():
+	""" Loads from a spool of small segments while the query writes it. A failed load stops
+		the query instead of leaving it waiting for segments to be read. """
+	query_db_file = tempfile.NamedTemporaryFile()
+	query_db_url = 'sqlite:///' + query_db_file.name
+	query_engine = sqlalchemy.create_engine(query_db_url)
+	query_engine.execute("CREATE TABLE events (id integer, value varchar(10))")
+	rows = [(i, 'value' + str(i)) for i in range(5000)]
+	query_engine.execute("INSERT INTO events VALUES (?, ?)", rows)
+
+	import_db_file = tempfile.NamedTemporaryFile()
+	import_db_url =  'sqlite:///' + import_db_file.name
+	import_engine = sqlalchemy.create_engine(import_db_url)
+	import_engine.execute("CREATE TABLE events (id integer, value varchar(10))")
+
+	for compression in (None, 'gzip'):
+		rowcount = dbio.replicate_no_fifo(query_db_url, import_db_url, 'SELECT * FROM events',
+										  'events', False, do_rowcount_check=True,
+										  compression=compression, batch_bytes=1024, spool=True,
+										  segment_bytes=4096, max_segments=2)
+		assert rowcount == 5000
+		assert import_engine.execute("SELECT * FROM events ORDER BY id").fetchall() == rows
+
+	with pytest.raises(sqlite3.OperationalError):
+		dbio.replicate_no_fifo(query_db_url, import_db_url, 'SELECT * FROM events', 'missing',
+							   True, batch_bytes=1024, spool=True, segment_bytes=4096,
+							   max_segments=2)
+
+	query_db_file.close()
+	import_db_file.close()
+
+
+def test_engine_registry(monkeypatch):
+	""" Repeated loads and their row count checks reuse one engine per URL and options. """
+	db_file = tempfile.NamedTemporaryFile()
+	db_url = 'sqlite:///' + db_file.name
+	sqlalchemy.create_engine(db_url).execute("CREATE TABLE loaded (id integer, value varchar(10))")
+	data_file = tempfile.NamedTemporaryFile()
+	write_rows_to_file([(1, 'a'), (2, 'b')], data_file.name, dbio.databases.DEFAULT_CSV_PARAMS)
+
+	created = []
+	create_engine = sqlalchemy.create_engine
+	def mock_create_engine(*args, **kwargs):
+		created.append((args, kwargs))
+		return create_engine(*args, **kwargs)
+	monkeypatch.setattr(sqlalchemy, 'create_engine', mock_create_engine)
+
+	for _ in range(3):
+		dbio.load(db_url, 'loaded', data_file.name, True, expected_rowcount=None)
+		dbio.query(db_url, 'SELECT * FROM loaded', os.devnull)
+	# One import engine, and one export engine with the SQLite functions registered.
+	assert len(created) == 2
+
+	try:
+		dbio.configure_engines(pool_pre_ping=True)
+		dbio.load(db_url, 'loaded', data_file.name, True)
+		assert created[-1][1] == {'pool_pre_ping' : True}
+		# pool_size only applies to pools of a fixed size, which SQLite files do not use.
+		dbio.configure_engines(pool_size=2)
+		dbio.load(db_url, 'loaded', data_file.name, True)
+		assert created[-1][1] == {'pool_pre_ping' : True}
+		assert len(created) == 4
+		with pytest.raises(ValueError):
+			dbio.configure_engines(pool_sise=2)
+	finally:
+		dbio.configure_engines(pool_size=None, pool_pre_ping=None)
+	assert sqlalchemy.create_engine(db_url).execute("SELECT COUNT(*) FROM loaded").fetchall() == [(10,)]
+
+	dbio.dispose_engines()
+	db_file.close()
+	data_file.close()
+
+
+def test_lazy_backends():
+	""" Backends are imported when first used, and importing dbio imports no database
+		module. """
+	imported = subprocess.check_output([sys.executable, '-c',
+		"import sys, dbio.__main__; print sorted(name for name in ('sqlalchemy', 'unicodecsv', "
+		"'dbio.databases.base', 'dbio.databases.mysql') if name in sys.modules)"])
+	assert imported.strip() == '[]'
+
+	dbio.databases.register_backend('sqlite', 'lazy', 'dbio.databases.sqlite:SQLite')
+	assert dbio.databases.get_backend('sqlite', 'lazy') is dbio.databases.sqlite.SQLite
+	with pytest.raises(dbio.io.UnsupportedDatabaseError):
+		dbio.query('oracle://', 'SELECT 1', os.devnull)
+	del dbio.databases.dialect_driver_class_map['sqlite']['lazy']
+
+
+def test_merge_load():
+	""" Merges update rows by primary key, insert new ones and optionally delete the rest. """
+	db_file = tempfile.NamedTemporaryFile()
+	db_url = 'sqlite:///' + db_file.name
+	engine = sqlalchemy.create_engine(db_url)
+	engine.execute("CREATE TABLE merged (id integer PRIMARY KEY, value varchar(10))")
+	engine.execute("INSERT INTO merged VALUES (?, ?)", [(1, 'a'), (2, 'b'), (3, 'c')])
+
+	data_file = tempfile.NamedTemporaryFile()
+	write_rows_to_file([(2, 'B'), (4, 'd')], data_file.name, dbio.databases.DEFAULT_CSV_PARAMS)
+	dbio.load(db_url, 'merged', data_file.name, False, merge=True)
+	assert engine.execute("SELECT * FROM merged ORDER BY id").fetchall() == [
+		(1, 'a'), (2, 'B'), (3, 'c'), (4, 'd')]
+
+	dbio.load(db_url, 'merged', data_file.name, False, merge=True, merge_keys=['id'],
+			  delete_missing=True)
+	assert engine.execute("SELECT * FROM merged ORDER BY id").fetchall() == [(2, 'B'), (4, 'd')]
+	assert engine.execute("SELECT name FROM sqlite_master WHERE name = 'merged_staging'").fetchall() == []
+
+	postgres = dbio.databases.postgresql.PostgreSQL('postgresql://mock')
+	assert postgres.get_merge_cmd('t', 't_staging', ['id', 'value'], ['id']) == (
+		"INSERT INTO t (id, value) SELECT id, value FROM t_staging "
+		"ON CONFLICT (id) DO UPDATE SET value = EXCLUDED.value;")
+	standard = dbio.databases.base.Importable('mock://')
+	assert standard.get_merge_cmd('t', 't_staging', ['id', 'value'], ['id']) == (
+		"MERGE INTO t USING t_staging ON t.id = t_staging.id "
+		"WHEN MATCHED THEN UPDATE SET value = t_staging.value "
+		"WHEN NOT MATCHED THEN INSERT (id, value) VALUES (t_staging.id, t_staging.value);")
+
+	db_file.close()
+	data_file.close()
+
+
+def test_sync():
+	""" Only the key ranges that differ are copied, and then the tables match. """
+	query_db_file = tempfile.NamedTemporaryFile()
+	query_db_url = 'sqlite:///' + query_db_file.name
+	query_engine = sqlalchemy.create_engine(query_db_url)
+	query_engine.execute("CREATE TABLE synced (id integer PRIMARY KEY, value varchar(10), x real)")
+	rows = [(i, 'value' + str(i), i / 4.0) for i in range(100)]
+	query_engine.execute("INSERT INTO synced VALUES (?, ?, ?)", rows)
+
+	import_db_file = tempfile.NamedTemporaryFile()
+	import_db_url =  'sqlite:///' + import_db_file.name
+	import_engine = sqlalchemy.create_engine(import_db_url)
+	import_engine.execute("CREATE TABLE synced (id integer PRIMARY KEY, value varchar(10), x real)")
+	import_engine.execute("INSERT INTO synced VALUES (?, ?, ?)", rows)
+	import_engine.execute("UPDATE synced SET value = 'changed' WHERE id = 5")
+	import_engine.execute("UPDATE synced SET x = NULL WHERE id = 55")
+	import_engine.execute("INSERT INTO synced VALUES (150, 'extra', 0)")
+
+	stats = dbio.sync(query_db_url, import_db_url, 'synced', chunks=10)
+
+	assert stats['chunks'] == 10
+	assert stats['changed'] == 3
+	assert stats['bytes_saved'] > stats['bytes_copied'] > 0
+	assert import_engine.execute("SELECT * FROM synced ORDER BY id").fetchall() == rows
+	assert dbio.sync(query_db_url, import_db_url, 'synced', chunks=10)['changed'] == 0
+
+	query_db_file.close()
+	import_db_file.close()
+
+
+def test_query_partitioned():
+	""" Queries a sqlite table in ranges of its id column, both merged and as shards. """
+	db_file = tempfile.NamedTemporaryFile()
+	db_url = 'sqlite:///' + db_file.name
+	engine = sqlalchemy.create_engine(db_url)
+	engine.execute("CREATE TABLE partitioned (id integer, value varchar(10))")
+	rows = [(i, 'value' + str(i)) for i in range(100)] + [(None, 'null id')]
+	engine.execute("INSERT INTO partitioned VALUES (?, ?)", rows)
+	expected_lines = sorted('{0},{1}\n'.format('NULL' if i is None else i, value) for i, value in rows)
+
+	out_file = tempfile.NamedTemporaryFile()
+	rowcount = dbio.query(db_url, 'SELECT * FROM partitioned', out_file.name,
+						  partition_by='id', parallel=4)
+
+	assert rowcount == len(rows)
+	with open(out_file.name, 'rb') as f:
+		assert sorted(f.readlines()) == expected_lines
+	assert not os.path.exists(out_file.name + '.0000')
+
+	rowcount = dbio.query(db_url, 'SELECT * FROM partitioned', out_file.name,
+						  partition_by='id', parallel=2, boundaries=[10, 50], shard_files=True)
+
+	assert rowcount == len(rows)
+	shard_lines = []
+	for i, shard_rowcount in enumerate([11, 40, 50]):
+		shard_name = '{0}.{1:04d}'.format(out_file.name, i)
+		with open(shard_name, 'rb') as f:
+			lines = f.readlines()
+		os.remove(shard_name)
+		assert len(lines) == shard_rowcount
+		shard_lines.extend(lines)
+	assert sorted(shard_lines) == expected_lines
+
+	# Float bounds keep their full precision in the range conditions.
+	assert getattr(dbio.io, '__sql_literal')(0.1 + 0.2) == '0.30000000000000004'
+
+	db_file.close()
+	out_file.close()
+
+
+def test_compression():
+	""" Queries a sqlite table to a gzip file and loads it back into another table. """
+	db_file = tempfile.NamedTemporaryFile()
+	db_url = 'sqlite:///' + db_file.name
+	create_sqlite_table(3, 10, 'query_table', db_url)
+	create_sqlite_table(3, 10, 'import_table', db_url)
+	rows = get_rows(100, 3, 10, string.ascii_letters, True)
+	engine = sqlalchemy.create_engine(db_url)
+	engine.execute("INSERT INTO query_table VALUES (?, ?, ?)", rows)
+
+	data_file = tempfile.NamedTemporaryFile(suffix='.csv.gz')
+	dbio.query(db_url, 'SELECT * FROM query_table', data_file.name, compression_level=1)
+	with open(data_file.name, 'rb') as f:
+		assert f.read(2) == '\x1f\x8b'
+
+	dbio.load(db_url, 'import_table', data_file.name, True)
+	assert engine.execute("SELECT * FROM import_table").fetchall() == rows
+
+	# Loaders that need a file name read the decompressed data through a named pipe.
+	with dbio.compression.decompressed_path(data_file.name) as path:
+		with open(path, 'rb') as f:
+			lines = f.readlines()
+	assert lines == [','.join(row) + '\n' for row in rows]
+
+	db_file.close()
+	data_file.close()
+
+
+def test_batch_encoder():
+	""" The batch encoder writes exactly what unicodecsv.writer writes. """
+	rows = [(1, u'plain', 2.5, None, decimal.Decimal('1.10'), True),
+			(2 ** 70, u'comma, quote " backslash \\', -0.1, 'bytes\n', None, False),
+			(None, u'\xe9\u4e2d\r\n', float('inf'), '', datetime.date(2015, 8, 4), None),
+			(3, u'nul \x00 and \x01', 1e100, 'x', decimal.Decimal('-0'), 1)]
+
+	for csv_params, null_string in ((dbio.databases.DEFAULT_CSV_PARAMS, 'NULL'),
+									(dbio.databases.mysql.MySQL.DEFAULT_CSV_PARAMS, '\\N'),
+									(dbio.databases.DEFAULT_CSV_PARAMS, '')):
+		encoder = dbio.encoder.BatchEncoder(csv_params, null_string)
+		for batch in (rows, rows[:2], rows[1:2]):
+			check_file = tempfile.NamedTemporaryFile()
+			write_rows_to_file([[null_string if field is None else field for field in row]
+								for row in batch], check_file.name, csv_params)
+			assert encoder.encode(batch) == check_file.read()
+			check_file.close()
+
+
+def test_query_batch_bytes(monkeypatch):
+	""" With a byte budget, batch sizes follow the encoded row size instead of batch_size. """
+	mock_url = 'mock_url'
+	mock_db = MockDatabase(mock_url)
+	monkeypatch.setattr(dbio.io, '__get_database', lambda url: mock_db)
+
+	# Every row encodes to 10 fields of 10 characters plus separators: 110 bytes.
+	mock_results = get_rows(1000, 10, 10, string.ascii_letters, True)
+	mock_db.engine.connection.results.rows = mock_results
+	test_file = tempfile.NamedTemporaryFile()
+
+	rowcount = dbio.query(mock_url, 'mock_query', test_file.name, batch_bytes=2200)
+
+	assert rowcount == len(mock_results)
+	fetch_sizes = mock_db.engine.connection.results.fetch_sizes
+	assert fetch_sizes[0] == dbio.encoder.BatchSizer.INITIAL_ROWS
+	assert set(fetch_sizes[1:]) == set([20])
+
+	check_file = tempfile.NamedTemporaryFile()
+	write_rows_to_file(mock_results, check_file.name, dbio.databases.DEFAULT_CSV_PARAMS)
+	assert filecmp.cmp(test_file.name, check_file.name, shallow=False)
+
+	# Narrow rows under a large budget grow the batches gradually.
+	sizer = dbio.encoder.BatchSizer(1024 * 1024)
+	assert [sizer.update(sizer.rows, sizer.rows * 10) for _ in range(4)] == [400, 1600, 6400, 25600]
+	assert sizer.update(10, 10000) == 1048
+
+	test_file.close()
+	check_file.close()
+
+
+def test_query_pipelined(monkeypatch):
+	""" The pipelined query writes the same file as the serial one, and a failing stage
+		stops the others and is re-raised. """
+	mock_url = 'mock_url'
+	mock_db = MockDatabase(mock_url)
+	monkeypatch.setattr(dbio.io, '__get_database', lambda url: mock_db)
+
+	mock_results = get_rows(1000, 10, 10, get_unicode_alphabet(1000, 2000), True)
+	mock_db.engine.connection.results.rows = mock_results
+	test_file = tempfile.NamedTemporaryFile()
+
+	rowcount = dbio.query(mock_url, 'mock_query', test_file.name, batch_size=7, pipeline_depth=2)
+
+	assert rowcount == len(mock_results)
+	assert mock_db.engine.connection.results.all_rows_fetched
+	assert mock_db.engine.connection.results.closed
+	check_file = tempfile.NamedTemporaryFile()
+	write_rows_to_file(mock_results, check_file.name, dbio.databases.DEFAULT_CSV_PARAMS)
+	assert filecmp.cmp(test_file.name, check_file.name, shallow=False)
+
+	def failing_fetchmany(rows_to_fetch):
+		raise ValueError("fetch failed")
+
+	mock_db.engine.connection.results = MockResults()
+	mock_db.engine.connection.results.fetchmany = failing_fetchmany
+	with pytest.raises(ValueError):
+		dbio.query(mock_url, 'mock_query', test_file.name, batch_size=7, pipeline_depth=2)
+	assert mock_db.engine.connection.results.closed
+
+	class FailingFile():
+		def __enter__(self):
+			return self
+
+		def __exit__(self, type, value, traceback):
+			pass
+
+		def write(self, data):
+			raise IOError("write failed")
+
+	monkeypatch.setattr(dbio.io, 'open_file', lambda *args: FailingFile())
+	mock_db.engine.connection.results = MockResults()
+	mock_db.engine.connection.results.rows = mock_results
+	with pytest.raises(IOError):
+		dbio.query(mock_url, 'mock_query', test_file.name, batch_size=7, pipeline_depth=2)
+	assert mock_db.engine.connection.results.closed
+
+	test_file.close()
+	check_file.close()
+
+
+def test_query_native_export(monkeypatch):
+	""" With native_export, PostgreSQL writes the file with COPY TO STDOUT. """
+	pg_db = dbio.databases.postgresql.PostgreSQL('postgresql://mock')
+	raw_connection = MockCopyConnection('1,a\n2,NULL\n')
+	monkeypatch.setattr(pg_db, 'get_export_engine', lambda: MockCopyEngine(raw_connection))
+	monkeypatch.setattr(dbio.io, '__get_database', lambda url: pg_db)
+	test_file = tempfile.NamedTemporaryFile()
+
+	rowcount = dbio.query('postgresql://mock', 'SELECT * FROM t', test_file.name,
+						  native_export=True)
+
+	assert rowcount == 2
+	assert test_file.read() == '1,a\n2,NULL\n'
+	assert raw_connection.copy_commands == ["COPY (SELECT * FROM t) TO STDOUT WITH (FORMAT text, "
+		"DELIMITER ',', NULL 'NULL', ENCODING 'utf-8');"]
+	assert raw_connection.closed
+
+	with pytest.raises(NotImplementedError):
+		dbio.databases.base.Exportable('mock_url').execute_export('SELECT 1', test_file, {}, 'NULL')
+
+	# Only the dialect the rows are encoded in without native_export can be written.
+	with pytest.raises(ValueError):
+		dbio.query('postgresql://mock', 'SELECT * FROM t', test_file.name, native_export=True,
+				   csv_params={'quoting' : unicodecsv.QUOTE_ALL, 'lineterminator' : '\n'})
+
+	test_file.close()
+
+
+def test_query_native_export_dialect(monkeypatch):
+	""" The output of COPY TO STDOUT is converted to the file the rows would be encoded to
+		without native_export. """
+	rows = [(1, 'a,b', True), (2, 'say "hi"', None), (3, 'back\\slash\nline', False)]
+	# COPY's text format, for the query with its boolean column converted to text.
+	copy_output = ('1,a\\,b,True\n'
+				   '2,say "hi",NULL\n'
+				   '3,back\\\\slash\\nline,False\n')
+
+	pg_db = dbio.databases.postgresql.PostgreSQL('postgresql://mock')
+	raw_connection = MockCopyConnection(copy_output, [('id', 23), ('name', 25), ('flag', 16)])
+	monkeypatch.setattr(pg_db, 'get_export_engine', lambda: MockCopyEngine(raw_connection))
+	monkeypatch.setattr(dbio.io, '__get_database', lambda url: pg_db)
+	test_file = tempfile.NamedTemporaryFile()
+	dbio.query('postgresql://mock', 'SELECT * FROM t', test_file.name, native_export=True)
+
+	assert raw_connection.copy_commands == ["COPY (SELECT \"id\", \"name\", "
+		"CASE WHEN \"flag\" THEN 'True' WHEN NOT \"flag\" THEN 'False' END AS \"flag\" "
+		"FROM (SELECT * FROM t) AS query_columns) TO STDOUT WITH (FORMAT text, "
+		"DELIMITER ',', NULL 'NULL', ENCODING 'utf-8');"]
+
+	mock_db = MockDatabase('mock_url')
+	mock_db.engine.connection.results.rows = rows
+	check_file = tempfile.NamedTemporaryFile()
+	getattr(dbio.io, '__write_query_results')(mock_db, 'SELECT * FROM t', check_file, 100,
+											  dbio.databases.DEFAULT_CSV_PARAMS,
+											  dbio.databases.DEFAULT_NULL_STRING)
+	check_file.flush()
+	assert test_file.read() == open(check_file.name).read()
+
+	# An escape split between two writes.
+	buf = StringIO.StringIO()
+	writer = dbio.databases.postgresql.TextCopyWriter(buf, dbio.databases.DEFAULT_CSV_PARAMS)
+	writer.write('a\\')
+	writer.write('n"\n')
+	writer.finish()
+	assert buf.getvalue() == 'a\\\n\\"\n'
+
+	test_file.close()
+	check_file.close()
+
+
+def test_copy_format(monkeypatch):
+	""" Binary COPY files are only loaded into PostgreSQL, and natively exported only from
+		PostgreSQL queries with matching column types. """
+	db_file = tempfile.NamedTemporaryFile()
+	with pytest.raises(ValueError):
+		dbio.load('sqlite:///' + db_file.name, 'table', 'data.bin', False, copy_format='binary')
+	db_file.close()
+
+	pg_db = dbio.databases.postgresql.PostgreSQL('postgresql://mock')
+	raw_connection = MockCopyConnection('PGCOPY\n')
+	monkeypatch.setattr(pg_db, 'get_export_engine', lambda: MockCopyEngine(raw_connection))
+	monkeypatch.setattr(dbio.io, '__get_database', lambda url: pg_db)
+	test_file = tempfile.NamedTemporaryFile()
+
+	dbio.query('postgresql://mock', 'SELECT * FROM t', test_file.name, native_export=True,
+			   copy_format='binary')
+	assert raw_connection.copy_commands == ["COPY (SELECT * FROM t) TO STDOUT WITH (FORMAT binary);"]
+
+	type_oids = {'SELECT * FROM t' : [23, 25], 'SELECT * FROM t2' : [20, 25]}
+	monkeypatch.setattr(pg_db, 'get_column_type_oids', lambda query: type_oids[query])
+	with pytest.raises(ValueError):
+		dbio.replicate_threaded('postgresql://mock', 'postgresql://mock', 'SELECT * FROM t', 't2',
+								False, native_export=True, copy_format='binary')
+
+	test_file.close()
+
+
+def test_native_export_load_db():
+	""" Native exports are only replicated into PostgreSQL. """
+	db_file = tempfile.NamedTemporaryFile()
+	load_db_url = 'sqlite:///' + db_file.name
+	create_sqlite_table(2, 10, 'import_table', load_db_url)
+
+	for replicate in (dbio.replicate, dbio.replicate_no_fifo, dbio.replicate_threaded):
+		with pytest.raises(ValueError):
+			replicate('postgresql://mock', load_db_url, 'SELECT * FROM t', 'import_table',
+					  False, native_export=True)
+	with pytest.raises(ValueError):
+		dbio.replicate_chunked('postgresql://mock', load_db_url, 'SELECT * FROM t',
+							   'import_table', False, 'id', native_export=True)
+	with pytest.raises(ValueError):
+		dbio.replicate_fanout('postgresql://mock', 'SELECT * FROM t',
+							  [{'load_db_url' : load_db_url, 'table' : 'import_table'}],
+							  native_export=True)
+
+	db_file.close()
+
+
+def test_pgcopy_encoder():
+	""" Queries a sqlite table into the binary COPY format. """
+	db_file = tempfile.NamedTemporaryFile()
+	db_url = 'sqlite:///' + db_file.name
+	engine = sqlalchemy.create_engine(db_url)
+	engine.execute("CREATE TABLE binary_table (id integer, name text)")
+	engine.execute("INSERT INTO binary_table VALUES (?, ?)", [(1, 'a'), (2, None)])
+	out_file = tempfile.NamedTemporaryFile()
+
+	rowcount = dbio.query(db_url, 'SELECT * FROM binary_table', out_file.name, copy_format='binary',
+						  column_types=['integer', 'text'])
+
+	assert rowcount == 2
+	assert out_file.read() == ('PGCOPY\n\xff\r\n\x00' + '\x00' * 8 +
+		'\x00\x02' '\x00\x00\x00\x04\x00\x00\x00\x01' '\x00\x00\x00\x01a' +
+		'\x00\x02' '\x00\x00\x00\x04\x00\x00\x00\x02' '\xff\xff\xff\xff' +
+		'\xff\xff')
+
+	with pytest.raises(ValueError):
+		dbio.query(db_url, 'SELECT * FROM binary_table', out_file.name, copy_format='binary',
+				   partition_by='id')
+
+	encoder = dbio.pgcopy.BinaryCopyEncoder(['numeric', 'timestamptz', 'date', 'bool', 'jsonb'])
+	tz = MockTimezone(datetime.timedelta(hours=2))
+	row = (decimal.Decimal('-12345.678'), datetime.datetime(2000, 1, 1, 2, 0, 1, tzinfo=tz),
+		   datetime.date(1999, 12, 31), True, {'a' : 1})
+	assert encoder.encode([row]) == ('\x00\x05' +
+		'\x00\x00\x00\x0e' '\x00\x03\x00\x01\x40\x00\x00\x03' '\x00\x01\x09\x29\x1a\x7c' +
+		'\x00\x00\x00\x08' '\x00\x00\x00\x00\x00\x0f\x42\x40' +
+		'\x00\x00\x00\x04' '\xff\xff\xff\xff' +
+		'\x00\x00\x00\x01' '\x01' +
+		'\x00\x00\x00\x09' '\x01{"a": 1}')
+
+	# Without column types, they are inferred from the first non-null values.
+	encoder = dbio.pgcopy.BinaryCopyEncoder()
+	assert encoder.encode([(None,)]) == '\x00\x01\xff\xff\xff\xff'
+	assert encoder.encode([(1.5,)]) == '\x00\x01\x00\x00\x00\x08\x3f\xf8' + '\x00' * 6
+
+	db_file.close()
+	out_file.close()
+
+
 ####################
 ### Mock Classes ###
 ####################
@@ -372,10 +1313,12 @@ class MockResults():
 		self.rows_fetched = 0
 		self.all_rows_fetched = False
 		self.closed = False
+		self.fetch_sizes = []
 
 
 	def fetchmany(self, rows_to_fetch):
 		assert not self.all_rows_fetched
+		self.fetch_sizes.append(rows_to_fetch)
 
 		new_rows_fetched = self.rows_fetched + rows_to_fetch
 		results = self.rows[self.rows_fetched:new_rows_fetched]
@@ -450,6 +1393,8 @@ class MockDatabase():
 
 	DEFAULT_NULL_STRING = dbio.databases.DEFAULT_NULL_STRING
 
+	COPY_FORMATS = ('csv',)
+
 	def __init__(self, url):
 		self.url = url
 		self.engine = MockEngine()
@@ -467,39 +1412,138 @@ class MockDatabase():
 
 	def execute_import(self, table, data_file, append, csv_params, null_string, 
 						analyze=False, disable_indices=False, create_staging=True,
-						expected_rowcount=None):
+						expected_rowcount=None, timings=None):
 		self.execute_import_args = [table, data_file, append, csv_params, 
 									null_string, analyze, disable_indices,
 									create_staging, expected_rowcount]
 
 
-class MockPopen():
-	""" Mocks subprocess Popen objects. """
+class MockCopyEngine():
+	""" Mocks an engine whose raw DB API connection supports copy_expert(). """
+
+	def __init__(self, connection):
+		self.connection = connection
+
+
+	def raw_connection(self):
+		return self.connection
 
-	def __init__(self):
-		self.returncode = None
 
+class MockCopyConnection():
+	""" Mocks a psycopg2 connection and its cursor, answering COPY TO STDOUT with data. """
 
-	def poll(self):
-		if self.returncode is None:
-			self.returncode = 0
+	def __init__(self, data, description=()):
+		self.data = data
+		self.description = description
+		self.copy_commands = []
+		self.rowcount = -1
+		self.closed = False
+
+
+	def cursor(self):
+		return self
+
+
+	def execute(self, sql):
+		pass
+
+
+	def copy_expert(self, sql, f):
+		self.copy_commands.append(sql)
+		# psycopg2 writes one row at a time.
+		for line in self.data.splitlines(True):
+			f.write(line)
+		self.rowcount = self.data.count('\n')
+
+
+	def close(self):
+		self.closed = True
+
+
+class MockTimezone(datetime.tzinfo):
+	""" Fixed offset time zone. """
+
+	def __init__(self, offset):
+		self.offset = offset
+
+
+	def utcoffset(self, dt):
+		return self.offset
+
+
+	def dst(self, dt):
+		return datetime.timedelta(0)
+
+
+class MockPopen():
+	""" Mocks subprocess Popen objects. The process exits with exit_status when waited on
+		with mock_wait4, or runs until it is killed if exit_status is None. """
+
+	processes = {}
+
+	def __init__(self, exit_status=0):
+		self.pid = len(self.processes) + 1
+		self.processes[self.pid] = self
+		self.returncode = None
+		self.exit_status = exit_status
+		self.exited = threading.Event()
+		if exit_status is not None:
+			self.exited.set()
 
 
 	def kill(self):
 		if self.returncode is not None:
 			assert False, "Attempted to kill a dead process."
-		self.returncode = -1
+		self.exit_status = -signal.SIGKILL
+		self.exited.set()
+
+
+def mock_wait4(pid, options):
+	""" Mocks os.wait4 for MockPopen processes. """
+	process = MockPopen.processes[pid]
+	process.exited.wait()
+	if process.exit_status < 0:
+		status = -process.exit_status
+	else:
+		status = process.exit_status << 8
+	return pid, status, MockRusage()
 
 
-	def communicate(self):
-		if self.returncode is None:
-			self.returncode = 0
+class MockRusage():
+	""" Mocks the resource usage returned by os.wait4. """
+
+	ru_utime = 1.0
+	ru_stime = 0.5
+	ru_maxrss = 1024
 
 
 ########################
 ### Helper Functions ###
 ########################
 
+def mock_processes(monkeypatch, mock_url, mock_reader, mock_writer):
+	""" Patches in a mock database, and mock load and query processes for replicate. """
+	mock_db = MockDatabase(mock_url)
+
+	def mockdb(url):
+		return mock_db
+
+	monkeypatch.setattr(dbio.io, '__get_database', mockdb)
+
+	def mockpopen(args, **kwargs):
+		# Check that Popen is called correcty.
+		assert args[0] == 'dbio'
+		if 'load' in args:
+			return mock_reader
+		elif 'query' in args:
+			return mock_writer
+		else:
+			assert False, "Unexpected dbio script called." + str(args)
+
+	monkeypatch.setattr(subprocess, 'Popen', mockpopen)
+	monkeypatch.setattr(os, 'wait4', mock_wait4)
+
+
 def create_sqlite_table(num_fields, max_field_length, table, url):
 	engine = sqlalchemy.create_engine(url)
 	fields_list = ['field{i} varchar({length})'.format(i=i, length=max_field_length) for i in xrange(num_fields)]
@@ -0,0 +1,133 @@
+# Python standard library
+import contextlib
+import json
+import os
+import sys
+import time
+
+""" Wall and CPU time of the phases of an operation, e.g. connecting, creating the staging
+	table, transferring the rows or swapping the tables, to see where a slow replication
+	spends its time. Also runs functions under cProfile. """
+
+# getrusage() of the calling thread only. Linux only, and not named by Python 2's resource.
+RUSAGE_THREAD = 1
+
+
+class Timings(object):
+	""" Phases recorded by an operation, in the order they finished. Each is a dictionary of
+		the 'side' ('query' or 'load') and 'phase' names, and the 'wall' and 'cpu' seconds
+		spent. CPU time is that of the thread running the phase, where the platform reports
+		it, otherwise that of the whole process.
+
+		Pass one to an operation with its timings argument to get its phases back. The query
+		and load sides of a replication may record phases at the same time. """
+
+	def __init__(self, side=None, phases=None):
+		self.side = side
+		self.phases = [] if phases is None else phases
+
+
+	def for_side(self, side):
+		""" :returns: Timings recording phases of side into the same list. """
+		return Timings(side, self.phases)
+
+
+	@contextlib.contextmanager
+	def phase(self, name):
+		""" Records the time spent in the with block as the phase name, also on failure. """
+		wall = time.time()
+		cpu = thread_cpu_time()
+		try:
+			yield
+		finally:
+			# list.append() is atomic, so both sides may record at once.
+			self.phases.append({'side' : self.side, 'phase' : name,
+								'wall' : time.time() - wall, 'cpu' : thread_cpu_time() - cpu})
+
+
+	def totals(self):
+		""" :returns: Dictionary of (side, phase) and the summed (wall, cpu) seconds of every
+				phase recorded under these names. """
+		totals = {}
+		for phase in self.phases:
+			key = (phase['side'], phase['phase'])
+			wall, cpu = totals.get(key, (0.0, 0.0))
+			totals[key] = (wall + phase['wall'], cpu + phase['cpu'])
+		return totals
+
+
+	def save(self, filename):
+		""" Saves the phases to filename as JSON, e.g. for the process that started this one.
+		"""
+		with open(filename, 'w') as f:
+			json.dump(self.phases, f)
+
+
+	@classmethod
+	def read(cls, filename):
+		""" :returns: Timings of the phases saved to filename by :py:meth:`save`, or of none if
+				the file is empty, e.g. because the process saving them was killed. """
+		with open(filename) as f:
+			text = f.read()
+		return cls(phases=json.loads(text) if text else [])
+
+
+	def format(self):
+		""" :returns: One line listing each phase with its wall and CPU seconds. """
+		return ', '.join('{name} {wall:.3f}s ({cpu:.3f}s cpu)'.format(
+						 name=' '.join(name for name in (phase['side'], phase['phase']) if name),
+						 wall=phase['wall'], cpu=phase['cpu'])
+						 for phase in self.phases)
+
+
+def phase(timings, name):
+	""" :returns: timings.phase(name), or a context doing nothing if timings is None. """
+	if timings is None:
+		return __nothing()
+	return timings.phase(name)
+
+
+def thread_cpu_time():
+	""" :returns: User and system seconds of the calling thread, or of the process if the
+			platform does not report them per thread. """
+	if sys.platform.startswith('linux'):
+		import resource
+		usage = resource.getrusage(RUSAGE_THREAD)
+		return usage.ru_utime + usage.ru_stime
+	times = os.times()
+	return times[0] + times[1]
+
+
+def profile_path(filename, side):
+	""" :returns: filename with side added before its extension, e.g. out.load.pstats, so
+			that each side of a replication is profiled to a file of its own, or None if
+			filename is None. """
+	if filename is None:
+		return None
+	root, extension = os.path.splitext(filename)
+	return root + '.' + side + extension
+
+
+def profiled(filename, function, *args, **kwargs):
+	""" Calls function under cProfile, saving the statistics to filename for pstats or
+		snakeviz. cProfile only sees the calling thread, so threads started by function are
+		not profiled.
+
+		:param filename: Statistics file, or None to call function without profiling.
+
+		:returns: What function returns.
+
+	"""
+	if filename is None:
+		return function(*args, **kwargs)
+	import cProfile
+	profiler = cProfile.Profile()
+	try:
+		return profiler.runcall(function, *args, **kwargs)
+	finally:
+		profiler.dump_stats(filename)
+
+
+@contextlib.contextmanager
+def __nothing():
+	yield
@@ -66,6 +66,9 @@ setup(
         'Vertica': ['vertica-python', 'sqlalchemy-vertica-python'],
         'VerticaODBC': ['pyodbc', 'vertica-sqlalchemy'],
         'PostgreSQL': ['psycopg2'],
+        'zstd': ['zstandard'],
+        'lz4': ['lz4'],
+        'yaml': ['PyYAML'],
     },
     tests_require=[
         'pytest',